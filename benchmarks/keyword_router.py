@@ -0,0 +1,85 @@
+"""
+Benchmark ContentKeywordRouter inbound message routing with many rules.
+"""
+
+import sys
+import time
+
+from vumi.dispatchers.base import ContentKeywordRouter
+from vumi.message import TransportUserMessage
+from vumi.utils import get_first_word
+
+
+class BenchDispatcher(object):
+
+    def __init__(self):
+        self.published = 0
+
+    def publish_inbound_message(self, name, msg):
+        self.published += 1
+
+
+def make_router(num_rules):
+    rules = [{
+        'app': 'app%d' % (i % 10,),
+        'keyword': 'keyword%d' % (i,),
+        'to_addr': '%d' % (8000 + i % 100,),
+        'prefix': '+27%d' % (i % 10,),
+    } for i in range(num_rules)]
+    router = ContentKeywordRouter(BenchDispatcher(), {
+        'dispatcher_name': 'bench',
+        'redis_manager': {'FAKE_REDIS': True},
+        'transport_mappings': {},
+        'fallback_application': 'fallback',
+        'rules': rules,
+    })
+    router.setup_routing()
+    return router
+
+
+def make_msgs(num_rules, num_msgs):
+    return [TransportUserMessage(
+        content='keyword%d rest of message' % (i % num_rules,),
+        to_addr='%d' % (8000 + i % 100,),
+        from_addr='+27%d1234567' % (i % 10,),
+        transport_name='bench',
+        transport_type='sms',
+    ) for i in range(num_msgs)]
+
+
+def linear_scan(router, msg):
+    """
+    Rule matching as it was done before rules were compiled into a routing
+    table.
+    """
+    keyword = get_first_word(msg['content']).lower()
+    return [rule['app'] for rule in router.rules
+            if router.is_msg_matching_routing_rules(keyword, msg, rule)]
+
+
+def compiled_table(router, msg):
+    keyword = get_first_word(msg['content']).lower()
+    return router.get_matching_apps(keyword, msg)
+
+
+def run_bench(name, func, router, msgs):
+    start = time.time()
+    for msg in msgs:
+        func(router, msg)
+    total = time.time() - start
+    print "%s:" % (name,)
+    print "  Total time: %.2f" % (total,)
+    print "  Time per message: %g" % (total / len(msgs),)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    num_rules = int(args[0]) if len(args) > 0 else 10000
+    num_msgs = int(args[1]) if len(args) > 1 else 1000
+    print "Routing %d messages with %d rules ..." % (num_msgs, num_rules)
+    router = make_router(num_rules)
+    msgs = make_msgs(num_rules, num_msgs)
+    for msg in msgs:
+        assert linear_scan(router, msg) == compiled_table(router, msg)
+    run_bench("Linear scan", linear_scan, router, msgs)
+    run_bench("Compiled routing table", compiled_table, router, msgs)
@@ -1,5 +1,11 @@
 """
 Benchmark sandbox message processing round trip.
+
+Usage: python benchmarks/sandbox.py [log] [per-message] [pooled] [loops]
+
+Both the per-message mode, which spawns a new sandbox process for every
+message, and the pooled mode, which reuses sandbox processes, are run unless
+one of them is given.
 """
 
 import sys
@@ -76,48 +82,44 @@ class Timer(object):
         return min(self.times)
 
 
-@inlineCallbacks
-def run_bench(loops):
-    opts = VumiOptions()
-    opts.postOptions()
-    worker_creator = WorkerCreator(opts.vumi_options)
-
-    app = worker_creator.create_worker_by_class(BenchApp, {
-        "transport_name": "dummy",
-        "javascript": """
-            api.on_inbound_message = function(command) {
-                this.request('outbound.reply_to', {
-                    content: 'reply',
-                    in_reply_to: command.msg.message_id,
-                },
-                function (reply) {
-                    this.done();
-                });
-            };
-        """,
-        "sandbox": {
-            'log': {
-                'cls': 'vumi.application.sandbox.LoggingResource',
-            },
-            'outbound': {
-                'cls': 'vumi.application.sandbox.OutboundResource',
+APP_CONFIG = {
+    "transport_name": "dummy",
+    "javascript": """
+        api.on_inbound_message = function(command) {
+            this.request('outbound.reply_to', {
+                content: 'reply',
+                in_reply_to: command.msg.message_id,
             },
+            function (reply) {
+                this.done();
+            });
+        };
+    """,
+    "sandbox": {
+        'log': {
+            'cls': 'vumi.application.sandbox.LoggingResource',
         },
-    })
+        'outbound': {
+            'cls': 'vumi.application.sandbox.OutboundResource',
+        },
+    },
+}
 
-    transport = worker_creator.create_worker_by_class(BenchTransport, {
-        "transport_name": "dummy",
-    })
+MODES = {
+    "per-message": {},
+    "pooled": {"pool_max_uses": 1000},
+}
 
-    yield transport.startService()
-    log.msg("Waiting for transport ...")
-    yield BenchTransport.WORKER_QUEUE.get()
 
+@inlineCallbacks
+def run_mode(worker_creator, transport, mode, loops):
+    config = dict(APP_CONFIG, **MODES[mode])
+    app = worker_creator.create_worker_by_class(BenchApp, config)
     yield app.startService()
     log.msg("Waiting for worker ...")
     yield BenchApp.WORKER_QUEUE.get()
 
-    print "Starting %d loops ..." % (loops,)
+    print "Starting %d loops in %s mode ..." % (loops, mode)
     timer = Timer()
     for i in range(loops):
         with timer:
@@ -135,8 +137,27 @@ def run_bench(loops):
     print "  max: %g, min: %g" % (timer.max(), timer.min())
     print "  loops: %d" % timer.loops()
 
-    yield transport.stopService()
     yield app.stopService()
+
+
+@inlineCallbacks
+def run_bench(loops, modes):
+    opts = VumiOptions()
+    opts.postOptions()
+    worker_creator = WorkerCreator(opts.vumi_options)
+
+    transport = worker_creator.create_worker_by_class(BenchTransport, {
+        "transport_name": "dummy",
+    })
+
+    yield transport.startService()
+    log.msg("Waiting for transport ...")
+    yield BenchTransport.WORKER_QUEUE.get()
+
+    for mode in modes:
+        yield run_mode(worker_creator, transport, mode, loops)
+
+    yield transport.stopService()
     reactor.stop()
 
 
@@ -145,9 +166,14 @@ if __name__ == "__main__":
     if "log" in args:
         log.startLogging(sys.stdout)
         args.remove("log")
+    modes = [mode for mode in sorted(MODES) if mode in args]
+    for mode in modes:
+        args.remove(mode)
+    if not modes:
+        modes = ["per-message", "pooled"]
     if args:
         loops = int(args[0])
     else:
         loops = 100
-    reactor.callLater(0, run_bench, loops=loops)
+    reactor.callLater(0, run_bench, loops=loops, modes=modes)
     reactor.run()
@@ -71,7 +71,8 @@ class HTTPRelayApplication(ApplicationWorker):
         headers = self.get_auth_headers(config)
         response = yield http_request_full(
             config.url.geturl(), message.to_json(), headers,
-            config.http_method, agent_class=self.agent_factory)
+            config.http_method, agent_class=self.agent_factory,
+            pool=self.http_pool)
         headers = response.headers
         if response.code == http.OK:
             if headers.hasHeader(self.reply_header):
@@ -89,7 +90,8 @@ class HTTPRelayApplication(ApplicationWorker):
         headers = self.get_auth_headers(config)
         yield http_request_full(
             config.event_url.geturl(), event.to_json(), headers,
-            config.http_method, agent_class=self.agent_factory)
+            config.http_method, agent_class=self.agent_factory,
+            pool=self.http_pool)
 
     @inlineCallbacks
     def consume_ack(self, event):
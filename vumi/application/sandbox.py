@@ -3,6 +3,7 @@
 """An application for sandboxing message processing."""
 
 import base64
+import hashlib
 import resource
 import os
 import json
@@ -11,6 +12,8 @@ import logging
 import operator
 from uuid import uuid4
 from StringIO import StringIO
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
 import warnings
 
 from treq.client import HTTPClient
@@ -93,19 +96,30 @@ class SandboxProtocol(ProcessProtocol):
 
     Incoming commands are dispatched to :class:`SandboxResource` instances
     via the supplied :class:`SandboxApi`.
+
+    A `reusable` sandbox process doesn't exit once it has finished processing
+    a message. Instead it sends a `done` command and waits for the next
+    message, which is given a new :class:`SandboxApi` via :meth:`reuse`.
+    The timeout and the receive limit apply to each message separately.
     """
 
     def __init__(self, sandbox_id, api, executable, spawn_kwargs,
-                 rlimits, timeout, recv_limit):
+                 rlimits, timeout, recv_limit, reusable=False):
         self.sandbox_id = sandbox_id
         self.api = api
         self.executable = executable
         self.spawn_kwargs = spawn_kwargs
         self.rlimits = rlimits
+        self.reusable = reusable
+        self.spawned_at = None
+        self.uses = 1
+        self.pool_key = None
         self._started = MultiDeferred()
         self._done = MultiDeferred()
+        self._run_done = MultiDeferred()
         self._pending_requests = []
         self.exit_reason = None
+        self.timeout = timeout
         self.timeout_task = reactor.callLater(timeout, self.kill)
         self.recv_limit = recv_limit
         self.recv_bytes = 0
@@ -115,13 +129,34 @@ class SandboxProtocol(ProcessProtocol):
         api.set_sandbox(self)
 
     def spawn(self):
+        self.spawned_at = reactor.seconds()
         SandboxRlimiter.spawn(
             reactor, self, self.executable, self.rlimits, **self.spawn_kwargs)
 
+    def reuse(self, api):
+        """Prepare a running reusable sandbox to process another message."""
+        self.api = api
+        api.set_sandbox(self)
+        self.uses += 1
+        self.recv_bytes = 0
+        self._run_done = MultiDeferred()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+
     def done(self):
         """Returns a deferred that will be called when the process ends."""
         return self._done.get()
 
+    def run_done(self):
+        """Returns a deferred that will be called when the process has
+        finished processing the current message.
+
+        This is the same as :meth:`done` unless the sandbox is reusable.
+        """
+        return self._run_done.get()
+
+    def ended(self):
+        return self._done.fired()
+
     def started(self):
         """Returns a deferred that will be called once the process starts."""
         return self._started.get()
@@ -163,11 +198,18 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def _dispatch_command(self, command):
+        if (self.reusable and command['cmd'] == 'done' and
+                not command['reply']):
+            self._finish_run()
+            return
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
         lines = self._process_data(self.chunk, data)
         for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
+            self._dispatch_command(self._parse_command(lines[i]))
         self.chunk = lines[-1]
 
     def outConnectionLost(self):
@@ -197,6 +239,21 @@ class SandboxProtocol(ProcessProtocol):
                 # api so that the sandbox owner gets to see them too
                 self.api.log(result.getErrorMessage(), logging.ERROR)
 
+    def _log_error_lines(self):
+        if self.error_lines:
+            self.api.log("\n".join(self.error_lines), logging.ERROR)
+            self.error_lines = []
+
+    def _finish_run(self):
+        if self.timeout_task.active():
+            self.timeout_task.cancel()
+        self._log_error_lines()
+        pending_requests, self._pending_requests = self._pending_requests, []
+        run_done = self._run_done
+        requests_done = DeferredList(pending_requests)
+        requests_done.addCallback(self._process_request_results)
+        requests_done.addCallback(lambda _r: run_done.callback(0))
+
     def processEnded(self, reason):
         if self.timeout_task.active():
             self.timeout_task.cancel()
@@ -207,12 +264,13 @@ class SandboxProtocol(ProcessProtocol):
         if not self._started.fired():
             self._started.callback(Failure(
                 SandboxError("Process failed to start.")))
-        if self.error_lines:
-            self.api.log("\n".join(self.error_lines), logging.ERROR)
-            self.error_lines = []
+        self._log_error_lines()
+        run_done = self._run_done
         requests_done = DeferredList(self._pending_requests)
         requests_done.addCallback(self._process_request_results)
         requests_done.addCallback(lambda _r: self._done.callback(result))
+        if not run_done.fired():
+            requests_done.addCallback(lambda _r: run_done.callback(result))
 
 
 class SandboxResources(object):
@@ -266,6 +324,11 @@ class SandboxResource(object):
     def sandbox_init(self, api):
         pass
 
+    def sandbox_reuse(self, api):
+        """Called instead of :meth:`sandbox_init` when a reusable sandbox
+        process that is already running is given a new message."""
+        pass
+
     def reply(self, command, **kwargs):
         return SandboxCommand(cmd=command['cmd'], reply=True,
                               cmd_id=command['cmd_id'], **kwargs)
@@ -338,8 +401,34 @@ class RedisResource(SandboxResource):
     def check_keys(self, api, key):
         if (yield self.redis.exists(key)):
             returnValue(True)
+        returnValue((yield self.reserve_keys(api, 1)))
+
+    @inlineCallbacks
+    def check_batch_keys(self, api, keys):
+        """
+        Check that the keys in a batch may be written, counting the ones that
+        don't exist yet against the sandbox's key limit. Existence is checked
+        for all the keys in a single pipelined request.
+        """
+        keys = set(keys)
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        existing = yield pipe.execute()
+        new_keys = len([exists for exists in existing if not exists])
+        if new_keys == 0:
+            returnValue(True)
+        returnValue((yield self.reserve_keys(api, new_keys)))
+
+    @inlineCallbacks
+    def reserve_keys(self, api, new_keys):
+        """
+        Add `new_keys` to the sandbox's key count, logging a warning if the
+        soft limit is exceeded. If the hard limit is reached, the count is
+        restored and `False` is returned.
+        """
         count_key = self._count_key(api.sandbox_id)
-        key_count = yield self.redis.incr(count_key, 1)
+        key_count = yield self.redis.incr(count_key, new_keys)
         if key_count > self.keys_per_user_soft:
             if key_count < self.keys_per_user_hard:
                 api.log('Redis soft limit of %s keys reached for sandbox %s. '
@@ -355,7 +444,7 @@ class RedisResource(SandboxResource):
                             self.keys_per_user_hard,
                             api.sandbox_id),
                         logging.ERROR)
-                yield self.redis.incr(count_key, -1)
+                yield self.redis.incr(count_key, -new_keys)
                 returnValue(False)
         returnValue(True)
 
@@ -508,6 +597,149 @@ class RedisResource(SandboxResource):
             returnValue(self.reply(command, success=False, reason=unicode(e)))
         returnValue(self.reply(command, value=int(value), success=True))
 
+    @inlineCallbacks
+    def handle_mget(self, api, command):
+        """
+        Retrieve the values of several keys in a single request.
+
+        Command fields:
+            - ``keys``: A list of the keys whose values should be retrieved.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``values``: A list of the values retrieved, in the same order as
+              ``keys``. The value of a key that doesn't exist is ``null``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mget',
+                {keys: ['foo', 'bar']},
+                function(reply) {
+                    api.log_info(
+                        'Values retrieved: ' +
+                        JSON.stringify(reply.values));
+                }
+            );
+        """
+        keys = command.get('keys')
+        if not isinstance(keys, list):
+            returnValue(self.reply_error(command, "keys must be a list"))
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.get(self._sandboxed_key(api.sandbox_id, key))
+        raw_values = yield pipe.execute()
+        values = [json.loads(raw_value) if raw_value is not None else None
+                  for raw_value in raw_values]
+        returnValue(self.reply(command, success=True, values=values))
+
+    @inlineCallbacks
+    def handle_mset(self, api, command):
+        """
+        Set the values of several keys in a single request.
+
+        Either all of the keys are set or, if setting them would exceed the
+        sandbox's key limit, none of them are.
+
+        Command fields:
+            - ``items``: An object mapping keys to the values to store. The
+              values may be any JSON serializable objects.
+            - ``seconds``: Lifetime of the keys in seconds. The default
+              ``null`` indicates that the keys should not expire.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mset',
+                {items: {foo: {x: '42'}, bar: 'baz'}},
+                function(reply) { api.log_info('Values stored: ' +
+                                               reply.success); });
+        """
+        items = command.get('items')
+        if not isinstance(items, dict):
+            returnValue(self.reply_error(command, "items must be an object"))
+        seconds = command.get('seconds')
+        if not (seconds is None or isinstance(seconds, (int, long))):
+            returnValue(self.reply_error(
+                command, "seconds must be a number or null"))
+        items = dict(
+            (self._sandboxed_key(api.sandbox_id, key), json.dumps(value))
+            for key, value in items.iteritems())
+        if not (yield self.check_batch_keys(api, items.keys())):
+            returnValue(self._too_many_keys(command))
+        pipe = self.redis.pipeline()
+        for key, json_value in items.iteritems():
+            if seconds is None:
+                pipe.set(key, json_value)
+            else:
+                pipe.setex(key, seconds, json_value)
+        yield pipe.execute()
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_mincr(self, api, command):
+        """
+        Atomically increment the values of several integer keys in a single
+        request.
+
+        The current value of each key must be an integer. Keys that do not
+        exist are set to zero before being incremented. If the key limit
+        would be exceeded, none of the keys are incremented. Each increment
+        is atomic, but the batch is not, so if one of the keys holds a value
+        that isn't an integer the other keys are still incremented.
+
+        Command fields:
+            - ``amounts``: An object mapping keys to the integer amounts to
+              increment them by.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``values``: An object mapping keys to their new values.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mincr',
+                {amounts: {foo: 3, bar: -1}},
+                function(reply) {
+                    api.log_info('New values: ' +
+                                 JSON.stringify(reply.values));
+                }
+            );
+        """
+        amounts = command.get('amounts')
+        if not isinstance(amounts, dict):
+            returnValue(self.reply_error(command, "amounts must be an object"))
+        if not all(isinstance(amount, (int, long))
+                   for amount in amounts.itervalues()):
+            returnValue(self.reply_error(command, "amounts must be integers"))
+        keys = amounts.keys()
+        sandboxed_keys = [
+            self._sandboxed_key(api.sandbox_id, key) for key in keys]
+        if not (yield self.check_batch_keys(api, sandboxed_keys)):
+            returnValue(self._too_many_keys(command))
+        pipe = self.redis.pipeline()
+        for key, sandboxed_key in zip(keys, sandboxed_keys):
+            pipe.incr(sandboxed_key, amount=amounts[key])
+        try:
+            values = yield pipe.execute()
+        except Exception, e:
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        returnValue(self.reply(command, success=True, values=dict(
+            (key, int(value)) for key, value in zip(keys, values))))
+
 
 class OutboundResource(SandboxResource):
     """
@@ -627,13 +859,115 @@ class JsSandboxResource(SandboxResource):
     a simple node.js based Javascript sandbox.
 
     Requires the worker to have a `javascript_for_api` method.
+
+    The Javascript is identified by a hash of its contents. Reusable sandbox
+    processes keep the scripts they have compiled in a least recently used
+    cache, and this resource keeps track of what each process has cached so
+    that the Javascript is only sent to processes that need to compile it.
+
+    Configuration options:
+
+    :param int code_cache_size:
+        Maximum number of compiled scripts each reusable sandbox process
+        keeps, and of code hashes this resource keeps. Default: 10.
+    :param str metrics_prefix:
+        If set, code cache hit and miss metrics are published with this
+        prefix. Default: no metrics.
     """
+
+    @inlineCallbacks
+    def setup(self):
+        self.code_cache_size = self.config.get('code_cache_size', 10)
+        self.hits = 0
+        self.misses = 0
+        self.metric_manager = None
+        self._metrics = None
+        self._code_hashes = OrderedDict()  # javascript -> code hash
+        self._code_caches = WeakKeyDictionary()  # sandbox -> code hashes
+        metrics_prefix = self.config.get('metrics_prefix')
+        if metrics_prefix is not None:
+            from vumi.blinkenlights.metrics import MetricManager
+            self.metric_manager = yield self.app_worker.start_publisher(
+                MetricManager, metrics_prefix)
+            self.register_metrics(self.metric_manager)
+
+    def teardown(self):
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
+            self.metric_manager = None
+
+    def register_metrics(self, metric_manager, prefix='js_code_cache.'):
+        """
+        Register code cache hit and miss metrics with a
+        :class:`vumi.blinkenlights.metrics.MetricManager`.
+        """
+        from vumi.blinkenlights.metrics import Count
+        self._metrics = {
+            'hits': metric_manager.register(Count(prefix + 'hits')),
+            'misses': metric_manager.register(Count(prefix + 'misses')),
+        }
+
+    def _lru_add(self, cache, key, value):
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > self.code_cache_size:
+            cache.popitem(last=False)
+
+    def code_hash(self, javascript):
+        """Return the hash that identifies `javascript`.
+
+        Hashes are cached so that the same code doesn't have to be hashed
+        for every message.
+        """
+        code_hash = self._code_hashes.get(javascript)
+        if code_hash is None:
+            data = javascript
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            code_hash = hashlib.sha1(data).hexdigest()
+        self._lru_add(self._code_hashes, javascript, code_hash)
+        return code_hash
+
+    def code_cached(self, api, code_hash):
+        """Return `True` if the sandbox process for `api` has already
+        compiled the code identified by `code_hash`, and record that it has
+        it now.
+
+        This mirrors the cache in sandboxer.js, which is updated in the same
+        way when it receives an `initialize` command.
+        """
+        if not getattr(api, 'reusable', False):
+            cached = False
+        else:
+            code_cache = self._code_caches.setdefault(
+                api.sandbox, OrderedDict())
+            cached = code_hash in code_cache
+            self._lru_add(code_cache, code_hash, True)
+        metric = 'hits' if cached else 'misses'
+        setattr(self, metric, getattr(self, metric) + 1)
+        if self._metrics is not None:
+            self._metrics[metric].inc()
+        return cached
+
     def sandbox_init(self, api):
         javascript = self.app_worker.javascript_for_api(api)
         app_context = self.app_worker.app_context_for_api(api)
+        code_hash = self.code_hash(javascript)
+        extra = {}
+        if not self.code_cached(api, code_hash):
+            extra['javascript'] = javascript
+        if getattr(api, 'reusable', False):
+            extra['reusable'] = True
+            extra['code_cache_size'] = self.code_cache_size
         api.sandbox_send(SandboxCommand(cmd="initialize",
-                                        javascript=javascript,
-                                        app_context=app_context))
+                                        code_hash=code_hash,
+                                        app_context=app_context,
+                                        **extra))
+
+    def sandbox_reuse(self, api):
+        # Reused processes are initialized again for each message so that
+        # they run the current code, which is usually already compiled.
+        self.sandbox_init(api)
 
 
 class LoggingResource(SandboxResource):
@@ -1051,6 +1385,14 @@ class SandboxApi(object):
     def sandbox_id(self):
         return self._sandbox.sandbox_id
 
+    @property
+    def reusable(self):
+        return self._sandbox.reusable
+
+    @property
+    def sandbox(self):
+        return self._sandbox
+
     def set_sandbox(self, sandbox):
         if self._sandbox is not None:
             raise SandboxError("Sandbox already set ("
@@ -1062,6 +1404,10 @@ class SandboxApi(object):
         for resource in self.resources.resources.values():
             resource.sandbox_init(self)
 
+    def sandbox_reuse(self):
+        for resource in self.resources.resources.values():
+            resource.sandbox_reuse(self)
+
     def sandbox_inbound_message(self, msg):
         self._inbound_messages[msg['message_id']] = msg
         self.sandbox_send(SandboxCommand(cmd="inbound-message",
@@ -1116,6 +1462,81 @@ class SandboxApi(object):
             self.sandbox_send(reply)
 
 
+class SandboxPool(object):
+    """Idle sandbox processes that are kept running so that they can process
+    later messages.
+
+    Processes are pooled by a key that identifies both the sandbox and the
+    code it runs, so that processes are never shared between sandboxes and
+    are replaced when the code changes.
+
+    :param int max_uses:
+        Number of messages a process may handle before it is retired.
+    :param int max_age:
+        Number of seconds after which a process is retired.
+    :param int max_idle:
+        Maximum number of idle processes kept for each key.
+    """
+
+    def __init__(self, max_uses, max_age, max_idle):
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self._idle = {}  # pool key -> list of idle sandbox protocols
+        self._retiring = set()
+
+    def _expired(self, protocol):
+        return (protocol.ended() or protocol.uses >= self.max_uses or
+                reactor.seconds() - protocol.spawned_at >= self.max_age)
+
+    def retire(self, protocol):
+        if protocol.ended():
+            return
+        self._retiring.add(protocol)
+        d = protocol.done()
+        d.addBoth(lambda _r: self._retiring.discard(protocol))
+        protocol.kill()
+
+    def acquire(self, key):
+        """Return an idle sandbox protocol for `key`, or `None` if there
+        isn't one."""
+        idle = self._idle.get(key)
+        while idle:
+            protocol = idle.pop()
+            if not idle:
+                del self._idle[key]
+            if not self._expired(protocol):
+                return protocol
+            self.retire(protocol)
+        return None
+
+    def release(self, protocol):
+        """Return a sandbox protocol to the pool once it has finished
+        processing a message."""
+        if self._expired(protocol):
+            self.retire(protocol)
+            return
+        idle = self._idle.setdefault(protocol.pool_key, [])
+        if len(idle) >= self.max_idle:
+            self.retire(protocol)
+            return
+        idle.append(protocol)
+
+    def close(self):
+        """Retire all idle sandbox processes.
+
+        :returns: A Deferred that fires once all the retired processes
+                  have ended.
+        """
+        idle, self._idle = self._idle, {}
+        for protocols in idle.itervalues():
+            for protocol in protocols:
+                self.retire(protocol)
+        return DeferredList(
+            [protocol.done() for protocol in self._retiring],
+            consumeErrors=True)
+
+
 class SandboxCommand(Message):
     @staticmethod
     def generate_id():
@@ -1179,6 +1600,20 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " these directly using Twisted logging instead.",
         default=None)
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pool_max_uses = ConfigInt(
+        "Maximum number of messages a sandboxed process may process before"
+        " it is replaced. If this is greater than 1, processes are kept"
+        " running between messages and reused by later messages for the"
+        " same sandbox id and code. The sandboxed program must then send a"
+        " `done` command instead of exiting once it has finished processing"
+        " a message. Resource limits apply to the process as a whole rather"
+        " than to each message.", default=1, static=True)
+    pool_max_age = ConfigInt(
+        "Maximum number of seconds a reused sandboxed process is kept for.",
+        default=300, static=True)
+    pool_max_idle = ConfigInt(
+        "Maximum number of idle sandboxed processes kept for each sandbox id"
+        " and code.", default=1, static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -1186,6 +1621,8 @@ class Sandbox(ApplicationWorker):
 
     CONFIG_CLASS = SandboxConfig
 
+    sandbox_pool = None
+
     KB, MB = 1024, 1024 * 1024
     DEFAULT_RLIMITS = {
         resource.RLIMIT_CORE: (1 * MB, 1 * MB),
@@ -1205,9 +1642,8 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        return succeed(self.get_cached_config(
+            sandbox_id=self.sandbox_id_for_message(msg)))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -1218,10 +1654,18 @@ class Sandbox(ApplicationWorker):
         return rlimits
 
     def setup_application(self):
+        config = self.get_static_config()
+        if config.pool_max_uses > 1:
+            self.sandbox_pool = SandboxPool(
+                config.pool_max_uses, config.pool_max_age,
+                config.pool_max_idle)
         return self.resources.setup_resources()
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self.sandbox_pool is not None:
+            yield self.sandbox_pool.close()
+        yield self.resources.teardown_resources()
 
     def setup_connectors(self):
         # Set the default event handler so we can handle events from any
@@ -1245,14 +1689,26 @@ class Sandbox(ApplicationWorker):
         rlimits.update(self._convert_rlimits(config.rlimits))
         return rlimits
 
-    def create_sandbox_protocol(self, api):
+    def create_sandbox_protocol(self, api, reusable=False):
         executable, args = self.get_executable_and_args(api.config)
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
             args=args, env=api.config.env, path=api.config.path)
         return SandboxProtocol(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
-            api.config.timeout, api.config.recv_limit)
+            api.config.timeout, api.config.recv_limit, reusable=reusable)
+
+    def sandbox_code_for_api(self, api):
+        """Return a JSON-serializable description of the code the sandbox
+        runs. Pooled processes are only reused if this hasn't changed.
+        """
+        executable, args = self.get_executable_and_args(api.config)
+        return [executable, args, api.config.env, api.config.path,
+                api.config.rlimits]
+
+    def sandbox_pool_key(self, api):
+        code = json.dumps(self.sandbox_code_for_api(api), sort_keys=True)
+        return (api.config.sandbox_id, hashlib.sha1(code).hexdigest())
 
     def create_sandbox_api(self, resources, config):
         return SandboxApi(resources, config)
@@ -1270,17 +1726,39 @@ class Sandbox(ApplicationWorker):
         Sub-classes may override this to retrieve an appropriate protocol.
         """
         api = self.create_sandbox_api(self.resources, config)
-        protocol = self.create_sandbox_protocol(api)
+        if self.sandbox_pool is None:
+            return self.create_sandbox_protocol(api)
+        pool_key = self.sandbox_pool_key(api)
+        protocol = self.sandbox_pool.acquire(pool_key)
+        if protocol is not None:
+            protocol.reuse(api)
+            return protocol
+        protocol = self.create_sandbox_protocol(api, reusable=True)
+        protocol.pool_key = pool_key
         return protocol
 
+    def _release_sandbox_protocol(self, result, sandbox_protocol):
+        if self.sandbox_pool is not None:
+            self.sandbox_pool.release(sandbox_protocol)
+        return result
+
     def _process_in_sandbox(self, sandbox_protocol, api_callback):
-        sandbox_protocol.spawn()
+        # Reused sandboxes are already running and initialized.
+        new_sandbox = sandbox_protocol.spawned_at is None
+        if new_sandbox:
+            sandbox_protocol.spawn()
 
         def on_start(_result):
-            sandbox_protocol.api.sandbox_init()
+            if new_sandbox:
+                sandbox_protocol.api.sandbox_init()
+            else:
+                sandbox_protocol.api.sandbox_reuse()
             api_callback()
-            d = sandbox_protocol.done()
+            d = sandbox_protocol.run_done()
             d.addErrback(log.error)
+            if sandbox_protocol.reusable:
+                d.addCallback(
+                    self._release_sandbox_protocol, sandbox_protocol)
             return d
 
         d = sandbox_protocol.started()
@@ -1356,6 +1834,9 @@ class JsSandbox(Sandbox):
     * An extra 'javascript' parameter specifies the javascript to execute.
     * An extra optional 'app_context' parameter specifying a custom
       context for the 'javascript' application to execute with.
+    * Pooled sandbox processes (see `pool_max_uses`) are reused when the
+      'javascript' changes. They keep recently compiled code so that
+      switching back to it doesn't require recompiling it.
 
     Example 'javascript' that logs information via the sandbox API
     (provided as 'this' to 'on_inbound_message') and checks that logging
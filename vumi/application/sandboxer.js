@@ -53,16 +53,28 @@ var SandboxRunner = function (api) {
     var self = this;
     self.emitter = new EventEmitter();
 
-    self.api = api;
+    self.api = null;
     self.chunk = "";
     self.pending_requests = {};
     self.loaded = false;
+    // reusable sandboxes handle many messages. Each message gets a fresh
+    // api and context to run the already compiled app code in.
+    self.reusable = false;
+    self.needs_reset = false;
+    self.script = null;
+    self.app_context = null;
+    // compiled scripts by code hash, with the hashes in least recently
+    // used order. The parent process keeps track of what is cached here and
+    // only sends the code if it isn't.
+    self.scripts = {};
+    self.script_hashes = [];
+    self.code_cache_size = 1;
 
     self.emitter.on('command', function (command) {
         var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
-        var handler = api[handler_name];
+        var handler = self.api[handler_name];
         if (!handler) {
-            handler = api.on_unknown_command;
+            handler = self.api.on_unknown_command;
         }
         if (handler) {
             handler.call(self.api, command);
@@ -76,39 +88,107 @@ var SandboxRunner = function (api) {
         }
     });
 
-    self.api.emitter.on('request', function(request) {
-        setImmediate(function() {
-            if (request.callback) {
-                self.pending_requests[request.msg.cmd_id] = {
-                    callback: request.callback
-                };
-            }
+    self.set_api = function (new_api) {
+        if (self.api) {
+            self.api.emitter.removeAllListeners();
+        }
+        self.api = new_api;
+
+        self.api.emitter.on('request', function(request) {
+            setImmediate(function() {
+                if (request.callback) {
+                    self.pending_requests[request.msg.cmd_id] = {
+                        callback: request.callback
+                    };
+                }
 
-            self.send_command(request.msg);
+                self.send_command(request.msg);
+            });
         });
-    });
 
-    self.api.emitter.on('done', function() {
-        self.exit();
-    });
+        self.api.emitter.on('done', function() {
+            if (self.reusable) {
+                self.finish();
+            }
+            else {
+                self.exit();
+            }
+        });
+    };
 
     self.exit = function() {
         process.exit(0);
     };
 
+    self.finish = function() {
+        // Tell the parent we're ready for the next message. The app is
+        // reset when the next message arrives so that anything it does
+        // while starting up belongs to that message.
+        self.needs_reset = true;
+        self.send_command(self.api.populate_command("done", {}));
+    };
+
+    self.reset = function() {
+        self.needs_reset = false;
+        self.pending_requests = {};
+        self.set_api(new SandboxApi());
+        self.run_code();
+    };
+
+    self.compile_code = function (command) {
+        var script;
+        if (command.javascript === undefined) {
+            script = self.scripts.hasOwnProperty(command.code_hash) ?
+                self.scripts[command.code_hash] : undefined;
+            if (!script) {
+                throw new Error("Code not cached: " + command.code_hash);
+            }
+        }
+        else {
+            script = vm.createScript(command.javascript);
+        }
+        if (command.code_hash !== undefined) {
+            var index = self.script_hashes.indexOf(command.code_hash);
+            if (index !== -1) {
+                self.script_hashes.splice(index, 1);
+            }
+            self.script_hashes.push(command.code_hash);
+            self.scripts[command.code_hash] = script;
+            while (self.script_hashes.length > self.code_cache_size) {
+                delete self.scripts[self.script_hashes.shift()];
+            }
+        }
+        return script;
+    };
+
     self.load_code = function (command) {
         self.log("Loading sandboxed code ...");
+        if (command.code_cache_size) {
+            self.code_cache_size = command.code_cache_size;
+        }
+        self.script = self.compile_code(command);
+        self.app_context = command.app_context;
+        self.reusable = !!command.reusable;
+        if (self.loaded) {
+            // A reused sandbox is initialized again for each message.
+            self.reset();
+        }
+        else {
+            self.run_code();
+            self.loaded = true;
+        }
+    };
+
+    self.run_code = function () {
         var ctxt;
-        var loaded_module = vm.createScript(command.javascript);
-        if (command.app_context) {
+        if (self.app_context) {
             // TODO use vm stuff instead of eval
-            eval("ctxt = " + command.app_context + ";");  // jshint ignore:line
+            eval("ctxt = " + self.app_context + ";");  // jshint ignore:line
         } else {
             ctxt = {};
         }
         ctxt.api = self.api;
-        loaded_module.runInNewContext(ctxt);
-        self.loaded = true;
+        self.script.runInNewContext(ctxt);
     };
 
     self.send_command = function (cmd) {
@@ -134,7 +214,13 @@ var SandboxRunner = function (api) {
                     self.load_code(msg);
                 }
             }
+            else if (msg.cmd == 'initialize') {
+                self.load_code(msg);
+            }
             else if (!msg.reply) {
+                if (self.needs_reset) {
+                    self.reset();
+                }
                 self.emitter.emit('command', msg);
             }
             else {
@@ -144,6 +230,8 @@ var SandboxRunner = function (api) {
         self.chunk = parts[parts.length - 1];
     };
 
+    self.set_api(api);
+
     self.run = function () {
         process.stdin.resume();
         process.stdin.setEncoding('ascii');
@@ -1,6 +1,7 @@
 """Tests for vumi.application.sandbox."""
 
 import base64
+import hashlib
 import os
 import sys
 import json
@@ -15,18 +16,20 @@ from OpenSSL.SSL import (
     VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_NONE,
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, fail, succeed, DeferredQueue)
+    inlineCallbacks, returnValue, fail, succeed, DeferredQueue)
 from twisted.internet.error import ProcessTerminated
 from twisted.web.http_headers import Headers
 
 from vumi.application.sandbox import (
-    Sandbox, SandboxApi, SandboxCommand, SandboxResources,
+    Sandbox, SandboxApi, SandboxCommand, SandboxResources, SandboxPool,
     SandboxResource, RedisResource, OutboundResource, JsSandboxResource,
     LoggingResource, HttpClientResource, JsSandbox, JsFileSandbox,
     HttpClientContextFactory, HttpClientPolicyForHTTPS, make_context_factory)
 from vumi.application.tests.helpers import (
     ApplicationHelper, find_nodejs_or_skip_test)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
@@ -389,6 +392,88 @@ class TestSandbox(SandboxTestCaseBase):
         ack.set_routing_endpoint('foo')
         return self.event_dispatch_check(ack)
 
+    REUSABLE_SANDBOX = (
+        "import sys, os, json\n"
+        "for line in iter(sys.stdin.readline, ''):\n"
+        "    cmd = json.loads(line)\n"
+        "    if cmd['reply']:\n"
+        "        continue\n"
+        "    log = {'cmd': 'log.info', 'cmd_id': '1', 'reply': False,\n"
+        "           'msg': '%s %s' % (os.getpid(), cmd['cmd'])}\n"
+        "    done = {'cmd': 'done', 'cmd_id': '2', 'reply': False}\n"
+        "    sys.stdout.write(json.dumps(log) + '\\n')\n"
+        "    sys.stdout.write(json.dumps(done) + '\\n')\n"
+        "    sys.stdout.flush()\n"
+    )
+
+    def setup_pooled_app(self, **pool_config):
+        pool_config.setdefault('pool_max_uses', 10)
+        pool_config['sandbox'] = {
+            'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+        }
+        return self.setup_app(self.REUSABLE_SANDBOX, pool_config)
+
+    @inlineCallbacks
+    def process_in_pooled_sandbox(self, app, sandbox_id):
+        with LogCatcher() as lc:
+            status = yield app.process_event_in_sandbox(
+                self.app_helper.make_ack(sandbox_id=sandbox_id))
+            [log_msg] = lc.messages()
+        self.assertEqual(status, 0)
+        pid, cmd = log_msg.split()
+        self.assertEqual(cmd, 'inbound-event')
+        returnValue(pid)
+
+    @inlineCallbacks
+    def test_pooled_sandbox_reused(self):
+        app = yield self.setup_pooled_app()
+        pid1 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        pid2 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        self.assertEqual(pid1, pid2)
+        [protocol] = app.sandbox_pool._idle[protocol_key(app, 'sandbox1')]
+        self.assertEqual(protocol.uses, 2)
+        self.assertFalse(protocol.ended())
+
+    @inlineCallbacks
+    def test_pooled_sandbox_per_sandbox_id(self):
+        app = yield self.setup_pooled_app()
+        pid1 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        pid2 = yield self.process_in_pooled_sandbox(app, 'sandbox2')
+        pid3 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        self.assertNotEqual(pid1, pid2)
+        self.assertEqual(pid1, pid3)
+
+    @inlineCallbacks
+    def test_pooled_sandbox_max_uses(self):
+        app = yield self.setup_pooled_app(pool_max_uses=2)
+        pid1 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        pid2 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        pid3 = yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        self.assertEqual(pid1, pid2)
+        self.assertNotEqual(pid2, pid3)
+
+    @inlineCallbacks
+    def test_pooled_sandbox_timeout(self):
+        app = yield self.setup_app(
+            "import time\n"
+            "time.sleep(5)\n",
+            {'pool_max_uses': 10, 'timeout': 1})
+        status = yield app.process_event_in_sandbox(
+            self.app_helper.make_ack(sandbox_id='sandbox1'))
+        self.assertEqual(status, None)
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+        self.assertEqual(app.sandbox_pool._idle, {})
+
+    @inlineCallbacks
+    def test_pooled_sandbox_teardown(self):
+        app = yield self.setup_pooled_app()
+        yield self.process_in_pooled_sandbox(app, 'sandbox1')
+        [protocol] = app.sandbox_pool._idle[protocol_key(app, 'sandbox1')]
+        yield app.teardown_application()
+        self.assertTrue(protocol.ended())
+        self.assertEqual(app.sandbox_pool._idle, {})
+
     def test_sandbox_command_does_not_parse_timestamps(self):
         # We should serialise datetime objects correctly.
         timestamp = datetime(2014, 07, 18, 15, 0, 0)
@@ -398,6 +483,84 @@ class TestSandbox(SandboxTestCaseBase):
         self.assertEqual(cmd['timestamp'], "2014-07-18 15:00:00.000000")
 
 
+def protocol_key(app, sandbox_id):
+    config = app.get_cached_config(sandbox_id=sandbox_id)
+    return app.sandbox_pool_key(app.create_sandbox_api(app.resources, config))
+
+
+class FakeSandboxProtocol(object):
+    def __init__(self, pool_key, uses=1, age=0):
+        self.pool_key = pool_key
+        self.uses = uses
+        self.spawned_at = reactor.seconds() - age
+        self.killed = False
+
+    def ended(self):
+        return self.killed
+
+    def done(self):
+        return succeed(None)
+
+    def kill(self):
+        self.killed = True
+
+
+class TestSandboxPool(VumiTestCase):
+
+    def test_acquire_empty(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=1)
+        self.assertEqual(pool.acquire('key'), None)
+
+    def test_release_and_acquire(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=1)
+        protocol = FakeSandboxProtocol('key')
+        pool.release(protocol)
+        self.assertEqual(pool.acquire('other'), None)
+        self.assertEqual(pool.acquire('key'), protocol)
+        self.assertEqual(pool.acquire('key'), None)
+        self.assertFalse(protocol.killed)
+
+    def test_release_max_uses(self):
+        pool = SandboxPool(max_uses=2, max_age=300, max_idle=1)
+        protocol = FakeSandboxProtocol('key', uses=2)
+        pool.release(protocol)
+        self.assertTrue(protocol.killed)
+        self.assertEqual(pool.acquire('key'), None)
+
+    def test_release_max_age(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=1)
+        protocol = FakeSandboxProtocol('key', age=300)
+        pool.release(protocol)
+        self.assertTrue(protocol.killed)
+
+    def test_release_max_idle(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=1)
+        protocol1 = FakeSandboxProtocol('key')
+        protocol2 = FakeSandboxProtocol('key')
+        pool.release(protocol1)
+        pool.release(protocol2)
+        self.assertFalse(protocol1.killed)
+        self.assertTrue(protocol2.killed)
+
+    def test_acquire_skips_ended(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=2)
+        protocol1 = FakeSandboxProtocol('key')
+        protocol2 = FakeSandboxProtocol('key')
+        pool.release(protocol1)
+        pool.release(protocol2)
+        protocol2.killed = True
+        self.assertEqual(pool.acquire('key'), protocol1)
+
+    @inlineCallbacks
+    def test_close(self):
+        pool = SandboxPool(max_uses=10, max_age=300, max_idle=1)
+        protocol = FakeSandboxProtocol('key')
+        pool.release(protocol)
+        yield pool.close()
+        self.assertTrue(protocol.killed)
+        self.assertEqual(pool.acquire('key'), None)
+
+
 class JsSandboxTestMixin(object):
 
     BIGGER_RLIMITS = {
@@ -428,6 +591,76 @@ class JsSandboxTestMixin(object):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            'pool_max_uses': 10,
+        })
+
+        for i in range(2):
+            with LogCatcher() as lc:
+                status = yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound(
+                        "foo", sandbox_id='sandbox1'))
+                failures = [log['failure'].value for log in lc.errors]
+                msgs = lc.messages()
+            self.assertEqual(failures, [])
+            self.assertEqual(status, 0)
+            if i == 0:
+                self.assertEqual(msgs[0], 'Starting sandbox ...')
+                msgs = msgs[1:]
+            self.assertEqual(msgs, [
+                'Loading sandboxed code ...',
+                'From init!',
+                'From command: inbound-message',
+                'Log successful: true',
+                'Done.',
+            ])
+        [protocol] = app.sandbox_pool._idle.values()[0]
+        self.assertEqual(protocol.uses, 2)
+
+    @inlineCallbacks
+    def test_js_sandboxer_pooled_code_change(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        new_javascript = """
+            api.on_inbound_message = function(command) {
+                this.log_info("From new code!", function (reply) {
+                    this.done();
+                });
+            };
+        """
+        app = yield self.setup_app(javascript, extra_config={
+            'pool_max_uses': 10,
+        })
+        js_resource = app.resources.resources['js']
+        original_javascript_for_api = app.javascript_for_api
+
+        for code in [javascript, new_javascript, javascript]:
+            app.javascript_for_api = lambda api, code=code: code
+            with LogCatcher() as lc:
+                status = yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound(
+                        "foo", sandbox_id='sandbox1'))
+                failures = [log['failure'].value for log in lc.errors]
+                msgs = lc.messages()
+            self.assertEqual(failures, [])
+            self.assertEqual(status, 0)
+            if code is new_javascript:
+                self.assertEqual(msgs[-2:], ['From new code!', 'Done.'])
+            else:
+                self.assertEqual(msgs[-2:], ['Log successful: true', 'Done.'])
+
+        app.javascript_for_api = original_javascript_for_api
+        [protocol] = app.sandbox_pool._idle.values()[0]
+        self.assertEqual(protocol.uses, 3)
+        self.assertEqual(js_resource.misses, 2)
+        self.assertEqual(js_resource.hits, 1)
+
     @inlineCallbacks
     def test_js_sandboxer_with_app_context(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
@@ -831,6 +1064,117 @@ class TestRedisResource(ResourceTestCaseBase):
             'Redis hard limit of 100 keys reached for sandbox test_id. '
             'No more keys can be written.')
 
+    @inlineCallbacks
+    def test_handle_mget(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.r_server.set('sandboxes#test_id#baz', json.dumps([1, 2]))
+        reply = yield self.dispatch_command(
+            'mget', keys=['foo', 'unknown', 'baz'])
+        self.check_reply(reply, success=True, values=['bar', None, [1, 2]])
+
+    @inlineCallbacks
+    def test_handle_mget_with_bad_keys(self):
+        reply = yield self.dispatch_command('mget', keys='foo')
+        self.check_reply(reply, success=False, reason="keys must be a list")
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        yield self.create_metric('foo', json.dumps('a'))
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': {'x': 1}})
+        self.check_reply(reply, success=True)
+        # Only the new key is counted.
+        yield self.check_metric('foo', json.dumps('bar'), 2)
+        yield self.check_metric('baz', json.dumps({'x': 1}), 2)
+
+    @inlineCallbacks
+    def test_handle_mset_with_expiry(self):
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': 'quux'}, seconds=5)
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps('bar'), 2, seconds=5)
+        yield self.check_metric('baz', json.dumps('quux'), 2, seconds=5)
+
+    @inlineCallbacks
+    def test_handle_mset_with_bad_items(self):
+        reply = yield self.dispatch_command('mset', items=['foo'])
+        self.check_reply(
+            reply, success=False, reason="items must be an object")
+
+    @inlineCallbacks
+    def test_handle_mset_with_bad_seconds(self):
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar'}, seconds='foo')
+        self.check_reply(
+            reply, success=False,
+            reason="seconds must be a number or null")
+        yield self.check_metric('foo', None, None)
+
+    @inlineCallbacks
+    def test_handle_mset_soft_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=79)
+        reply = yield self.dispatch_command(
+            'mset', items={'bar': 'bar', 'baz': 'baz'})
+        self.check_reply(reply, success=True)
+        yield self.check_metric('bar', json.dumps('bar'), 81)
+        self.assert_api_log(
+            logging.WARNING,
+            'Redis soft limit of 80 keys reached for sandbox test_id. '
+            'Once the hard limit of 100 is reached no more keys can '
+            'be written.'
+        )
+
+    @inlineCallbacks
+    def test_handle_mset_hard_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=98)
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'b', 'bar': 'bar', 'baz': 'baz'})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        # None of the keys are written and the count is unchanged.
+        yield self.check_metric('foo', 'a', 98)
+        yield self.check_metric('bar', None, 98)
+        yield self.check_metric('baz', None, 98)
+        self.assert_api_log(
+            logging.ERROR,
+            'Redis hard limit of 100 keys reached for sandbox test_id. '
+            'No more keys can be written.'
+        )
+
+    @inlineCallbacks
+    def test_handle_mincr(self):
+        yield self.create_metric('foo', '2')
+        reply = yield self.dispatch_command(
+            'mincr', amounts={'foo': 3, 'bar': -1})
+        self.check_reply(reply, success=True, values={'foo': 5, 'bar': -1})
+        yield self.check_metric('foo', '5', 2)
+        yield self.check_metric('bar', '-1', 2)
+
+    @inlineCallbacks
+    def test_handle_mincr_with_bad_amounts(self):
+        reply = yield self.dispatch_command('mincr', amounts={'foo': 'a'})
+        self.check_reply(
+            reply, success=False, reason="amounts must be integers")
+        yield self.check_metric('foo', None, None)
+
+    @inlineCallbacks
+    def test_handle_mincr_existing_non_int(self):
+        yield self.create_metric('foo', 'a')
+        reply = yield self.dispatch_command(
+            'mincr', amounts={'foo': 1, 'bar': 2})
+        self.check_reply(reply, success=False)
+        self.assertTrue(reply['reason'])
+        yield self.check_metric('foo', 'a', 2)
+        yield self.check_metric('bar', '2', 2)
+
+    @inlineCallbacks
+    def test_handle_mincr_hard_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=99)
+        reply = yield self.dispatch_command(
+            'mincr', amounts={'bar': 1, 'baz': 1})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_metric('bar', None, 99)
+        yield self.check_metric('baz', None, 99)
+
 
 class TestOutboundResource(ResourceTestCaseBase):
 
@@ -875,8 +1219,10 @@ class TestOutboundResource(ResourceTestCaseBase):
 
 
 class JsDummyAppWorker(DummyAppWorker):
+    javascript = 'testscript'
+
     def javascript_for_api(self, api):
-        return 'testscript'
+        return self.javascript
 
     def app_context_for_api(self, api):
         return 'appcontext'
@@ -893,14 +1239,107 @@ class TestJsSandboxResource(ResourceTestCaseBase):
         super(TestJsSandboxResource, self).setUp()
         yield self.create_resource({})
 
+    def code_hash(self, javascript):
+        return hashlib.sha1(javascript).hexdigest()
+
+    def make_api(self, reusable=True):
+        api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol(self.sandbox_id, api)
+        api.reusable = reusable
+        api.sent = []
+        api.sandbox_send = api.sent.append
+        return api
+
+    def assert_initialize(self, api, javascript=None, **kw):
+        [cmd] = api.sent
+        del api.sent[:]
+        if javascript is not None:
+            kw['javascript'] = javascript
+        self.assertEqual(cmd, SandboxCommand(
+            cmd='initialize', cmd_id=cmd['cmd_id'], app_context='appcontext',
+            code_hash=self.code_hash(self.app_worker.javascript), **kw))
+
     def test_sandbox_init(self):
         msgs = []
         self.api.sandbox_send = lambda msg: msgs.append(msg)
         self.resource.sandbox_init(self.api)
-        self.assertEqual(msgs, [SandboxCommand(cmd='initialize',
-                                               cmd_id=msgs[0]['cmd_id'],
-                                               javascript='testscript',
-                                               app_context='appcontext')])
+        self.assertEqual(msgs, [SandboxCommand(
+            cmd='initialize', cmd_id=msgs[0]['cmd_id'],
+            javascript='testscript', app_context='appcontext',
+            code_hash=self.code_hash('testscript'))])
+
+    def test_sandbox_init_not_reusable(self):
+        api = self.make_api(reusable=False)
+        self.resource.sandbox_init(api)
+        self.assert_initialize(api, 'testscript')
+        self.resource.sandbox_init(api)
+        self.assert_initialize(api, 'testscript')
+        self.assertEqual(self.resource.hits, 0)
+        self.assertEqual(self.resource.misses, 2)
+
+    def test_sandbox_reuse(self):
+        api = self.make_api()
+        self.resource.sandbox_init(api)
+        self.assert_initialize(
+            api, 'testscript', reusable=True, code_cache_size=10)
+        self.resource.sandbox_reuse(api)
+        self.assert_initialize(api, reusable=True, code_cache_size=10)
+        self.assertEqual(self.resource.hits, 1)
+        self.assertEqual(self.resource.misses, 1)
+
+    def test_sandbox_reuse_per_process(self):
+        api1 = self.make_api()
+        api2 = self.make_api()
+        self.resource.sandbox_init(api1)
+        self.assert_initialize(
+            api1, 'testscript', reusable=True, code_cache_size=10)
+        self.resource.sandbox_init(api2)
+        self.assert_initialize(
+            api2, 'testscript', reusable=True, code_cache_size=10)
+        self.resource.sandbox_reuse(api1)
+        self.assert_initialize(api1, reusable=True, code_cache_size=10)
+
+    @inlineCallbacks
+    def test_sandbox_reuse_evicts_least_recently_used(self):
+        yield self.create_resource({'code_cache_size': 2})
+        api = self.make_api()
+        for javascript in ['code1', 'code2', 'code1', 'code3', 'code1']:
+            self.app_worker.javascript = javascript
+            self.resource.sandbox_reuse(api)
+            api.sent[:] = []
+        self.app_worker.javascript = 'code2'
+        self.resource.sandbox_reuse(api)
+        self.assert_initialize(
+            api, 'code2', reusable=True, code_cache_size=2)
+        self.app_worker.javascript = 'code1'
+        self.resource.sandbox_reuse(api)
+        self.assert_initialize(api, reusable=True, code_cache_size=2)
+
+    def test_code_hash(self):
+        self.assertEqual(
+            self.resource.code_hash('testscript'),
+            self.code_hash('testscript'))
+        self.assertEqual(
+            self.resource.code_hash(u'caf\xe9'),
+            self.code_hash(u'caf\xe9'.encode('utf-8')))
+
+    def test_code_hash_cached(self):
+        self.resource.code_hash('testscript')
+        self.assertEqual(self.resource._code_hashes, {
+            'testscript': self.code_hash('testscript'),
+        })
+
+    def test_metrics(self):
+        mm = MetricManager("vumi.test.")
+        self.resource.register_metrics(mm)
+        api = self.make_api()
+        self.resource.sandbox_init(api)
+        self.resource.sandbox_reuse(api)
+        self.resource.sandbox_reuse(api)
+        hits = mm['js_code_cache.hits'].poll()
+        self.assertEqual([value for _, value in hits], [1.0, 1.0])
+        misses = mm['js_code_cache.misses'].poll()
+        self.assertEqual([value for _, value in misses], [1.0])
 
 
 class TestLoggingResource(ResourceTestCaseBase):
@@ -4,7 +4,7 @@ import time
 import collections
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, gatherResults, FirstError
 from twisted.internet.task import LoopingCall
 
 from vumi.worker import BaseWorker
@@ -62,6 +62,7 @@ class Worker(object):
         self._instances = set()
         self._instances_active = set()
         self.procs_count = 0
+        self._audited = False
 
     def to_dict(self):
         """Serializes information into basic dicts"""
@@ -92,12 +93,21 @@ class Worker(object):
             counts[ins.hostname] = counts[ins.hostname] + 1
         return counts
 
+    def needs_audit(self):
+        """
+        Whether the number of instances that checked in has changed since
+        the last audit. The audit result only depends on that number, so
+        there's no need to audit a worker whose count hasn't changed.
+        """
+        return not self._audited or len(self._instances) != self.procs_count
+
     @inlineCallbacks
     def audit(self, storage):
         """
         Verify whether enough workers checked in.
         Make sure to call snapshot() before running this method
         """
+        self._audited = True
         count = len(self._instances)
         # if there was previously a min-procs-fail, but now enough
         # instances checked in, then clear the worker issue
@@ -169,6 +179,7 @@ class HeartBeatMonitor(BaseWorker):
         config = self.get_static_config()
 
         self.deadline = config.deadline
+        self._discarded = collections.Counter()
 
         redis_config = config.redis_manager
         self._redis = yield TxRedisManager.from_config(redis_config)
@@ -222,36 +233,33 @@ class HeartBeatMonitor(BaseWorker):
     def update(self, msg):
         """
         Process a heartbeat message.
+
+        Discarded heartbeats are counted rather than logged, and the counts
+        are logged once per audit by :meth:`_log_discarded`.
         """
         worker_id = msg['worker_id']
-        timestamp = msg['timestamp']
-        hostname = msg['hostname']
-        pid = msg['pid']
-
         # A bunch of discard rules:
         # 1. Unknown worker (Monitored workers need to be in the config)
         # 2. Message which are too old.
         wkr = self._workers.get(worker_id, None)
         if wkr is None:
-            log.msg("Discarding message. worker '%s' is unknown" % worker_id)
-            return
-        if timestamp < (time.time() - self.deadline):
-            log.msg("Discarding heartbeat from '%s'. Too old" % worker_id)
-            return
-
-        wkr.record(hostname, pid)
+            self._discarded[(worker_id, "worker is unknown")] += 1
+        elif msg['timestamp'] < (time.time() - self.deadline):
+            self._discarded[(worker_id, "too old")] += 1
+        else:
+            wkr.record(msg['hostname'], msg['pid'])
+
+    def _log_discarded(self):
+        discarded, self._discarded = self._discarded, collections.Counter()
+        for (worker_id, reason), count in sorted(discarded.iteritems()):
+            log.msg("Discarded %d heartbeat(s) from '%s': %s" % (
+                count, worker_id, reason))
 
-    @inlineCallbacks
     def _sync_to_storage(self):
         """
         Write systems data to storage
         """
-        # write system ids
-        system_ids = [sys.system_id for sys in self._systems]
-        yield self._storage.add_system_ids(system_ids)
-        # dump each system
-        for sys in self._systems:
-            yield self._storage.write_system(sys)
+        return self._storage.write_systems(self._systems)
 
     @inlineCallbacks
     def _periodic_task(self):
@@ -262,12 +270,15 @@ class HeartBeatMonitor(BaseWorker):
         We call snapshot() first, since the execution of tasks here is
         interleaved with the processing of worker heartbeat messages.
         """
+        self._log_discarded()
         # snapshot the the set of checked-in instances
         for wkr in self._workers.values():
             wkr.snapshot()
-        # run diagnostic audits on all workers
-        for wkr in self._workers.values():
-            yield wkr.audit(self._storage)
+        # run diagnostic audits on workers whose state has changed
+        yield gatherResults([
+            wkr.audit(self._storage) for wkr in self._workers.values()
+            if wkr.needs_audit()], consumeErrors=True).addErrback(
+                lambda f: f.value.subFailure if f.check(FirstError) else f)
         # write everything to redis
         yield self._sync_to_storage()
 
@@ -280,5 +291,4 @@ class HeartBeatMonitor(BaseWorker):
         self._task_done.addErrback(errfn)
 
     def _consume_message(self, msg):
-        log.msg("Received message: %s" % msg)
         self.update(msg.payload)
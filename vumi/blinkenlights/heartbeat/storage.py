@@ -45,6 +45,18 @@ class Storage(object):
         key = system_key(sys.system_id)
         yield self._redis.set(key, sys.dumps())
 
+    @Manager.calls_manager
+    def write_systems(self, systems):
+        """Write the list of system ids and the state of each system in a
+        single pipelined request."""
+        if not systems:
+            return
+        pipe = self._redis.pipeline()
+        pipe.sadd(SYSTEMS_KEY, *[sys.system_id for sys in systems])
+        for sys in systems:
+            pipe.set(system_key(sys.system_id), sys.dumps())
+        yield pipe.execute()
+
     def _issue_to_dict(self, issue):
         return {
             'issue_type': issue.issue_type,
@@ -5,13 +5,14 @@
 import time
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, fail
 
 from vumi.blinkenlights.heartbeat import publisher
 from vumi.blinkenlights.heartbeat import monitor
 from vumi.blinkenlights.heartbeat.storage import issue_key
 from vumi.utils import generate_worker_id
 from vumi.tests.helpers import VumiTestCase, WorkerHelper, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 
 
 def expected_wkr_dict():
@@ -60,6 +61,17 @@ class TestWorkerInstance(VumiTestCase):
         self.assertNotEqual(hash(worker1), hash(worker4))
 
 
+class FakeStorage(object):
+    def __init__(self):
+        self.calls = []
+
+    def delete_worker_issue(self, worker_id):
+        self.calls.append(('delete_worker_issue', worker_id))
+
+    def open_or_update_issue(self, worker_id, issue):
+        self.calls.append(('open_or_update_issue', worker_id))
+
+
 class TestWorker(VumiTestCase):
 
     def test_to_dict(self):
@@ -81,6 +93,24 @@ class TestWorker(VumiTestCase):
         counts = wkr._compute_host_info(wkr._instances)
         self.assertEqual(counts['host-1'], 2)
 
+    def test_needs_audit(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.snapshot()
+        # The first audit always happens.
+        self.assertTrue(wkr.needs_audit())
+        wkr.audit(FakeStorage())
+        self.assertFalse(wkr.needs_audit())
+
+        wkr.record('host-1', 34)
+        wkr.snapshot()
+        self.assertTrue(wkr.needs_audit())
+        wkr.audit(FakeStorage())
+
+        # A different instance with the same count doesn't change the audit.
+        wkr.record('host-1', 35)
+        wkr.snapshot()
+        self.assertFalse(wkr.needs_audit())
+
     def test_snapshot(self):
         wkr = monitor.Worker('system-1', 'foo', 1)
 
@@ -272,3 +302,84 @@ class TestHeartBeatMonitor(VumiTestCase):
         system = json.loads((yield fkredis.get('system:system-1')))
         system['timestamp'] = 2
         self.assertEqual(system, expected)
+
+    @inlineCallbacks
+    def test_consume_message(self):
+        yield self.worker.startWorker()
+        wkr = self.worker._workers['system-1:twitter_transport']
+        now = time.time()
+
+        attrs = self.gen_fake_attrs(now)
+        self.worker._consume_message(publisher.HeartBeatMessage(**attrs))
+        old = self.gen_fake_attrs(now - 60)
+        self.worker._consume_message(publisher.HeartBeatMessage(**old))
+        unknown = self.gen_fake_attrs(now)
+        unknown['worker_id'] = 'system-1:unknown'
+        self.worker._consume_message(publisher.HeartBeatMessage(**unknown))
+
+        self.assertEqual(
+            wkr._instances_active,
+            set([monitor.WorkerInstance("test-host-1", 345)]))
+        self.assertEqual(self.worker._discarded, {
+            ('system-1:twitter_transport', "too old"): 1,
+            ('system-1:unknown', "worker is unknown"): 1,
+        })
+
+    @inlineCallbacks
+    def test_periodic_task_audit_failures(self):
+        yield self.worker.startWorker()
+        self.worker._workers['system-1:other'] = monitor.Worker(
+            'system-1', 'other', 1)
+
+        def audit(wkr, storage):
+            return fail(ValueError("Audit of %s failed." % (wkr.name,)))
+
+        self.patch(monitor.Worker, 'audit', audit)
+        yield self.assertFailure(self.worker._periodic_task(), ValueError)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 0)
+
+    @inlineCallbacks
+    def test_discarded_heartbeats_logged_once_per_audit(self):
+        yield self.worker.startWorker()
+        old = self.gen_fake_attrs(time.time() - 60)
+        unknown = self.gen_fake_attrs(time.time())
+        unknown['worker_id'] = 'system-1:unknown'
+        with LogCatcher() as lc:
+            for msg in [old, old, unknown]:
+                self.worker.update(msg)
+            self.assertEqual(lc.messages(), [])
+            yield self.worker._periodic_task()
+            yield self.worker._periodic_task()
+        self.assertEqual(lc.messages(), [
+            "Discarded 2 heartbeat(s) from 'system-1:twitter_transport':"
+            " too old",
+            "Discarded 1 heartbeat(s) from 'system-1:unknown':"
+            " worker is unknown",
+        ])
+
+    @inlineCallbacks
+    def test_periodic_task_audits_changed_workers(self):
+        yield self.worker.startWorker()
+        wkr = self.worker._workers['system-1:twitter_transport']
+        audits = []
+        orig_audit = wkr.audit
+
+        def audit(storage):
+            audits.append(len(wkr._instances))
+            return orig_audit(storage)
+
+        self.patch(wkr, 'audit', audit)
+        attrs = self.gen_fake_attrs(time.time())
+
+        self.worker.update(attrs)
+        yield self.worker._periodic_task()
+        self.assertEqual(audits, [1])
+
+        # Same number of instances, so no audit.
+        self.worker.update(attrs)
+        yield self.worker._periodic_task()
+        self.assertEqual(audits, [1])
+
+        # No instances checked in, so we audit again.
+        yield self.worker._periodic_task()
+        self.assertEqual(audits, [1, 0])
@@ -51,6 +51,24 @@ class TestStorage(VumiTestCase):
         res = yield self.redis.get(storage.system_key('haha'))
         self.assertEqual(res, 'Ha!')
 
+    @inlineCallbacks
+    def test_write_systems(self):
+        other = DummySystem()
+        other.system_id = 'hoho'
+        yield self.stg.write_systems([DummySystem(), other])
+        res = yield self.redis.smembers(storage.SYSTEMS_KEY)
+        self.assertEqual(sorted(res), ['haha', 'hoho'])
+        res = yield self.redis.get(storage.system_key('haha'))
+        self.assertEqual(res, 'Ha!')
+        res = yield self.redis.get(storage.system_key('hoho'))
+        self.assertEqual(res, 'Ha!')
+
+    @inlineCallbacks
+    def test_write_no_systems(self):
+        yield self.stg.write_systems([])
+        res = yield self.redis.smembers(storage.SYSTEMS_KEY)
+        self.assertEqual(res, set())
+
     @inlineCallbacks
     def test_delete_issue(self):
         iss = monitor.WorkerIssue('min-procs-fail', 5, 78)
@@ -3,26 +3,92 @@
 """Session management utilities."""
 
 import time
+from collections import OrderedDict
+from uuid import uuid4
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
+from vumi.persist.redis_base import Manager
+
+
+class SessionCache(object):
+    """A local cache of recently used sessions for a :class:`SessionManager`.
+
+    Sessions are kept in memory for `ttl` seconds after they were last read
+    from or written to redis, during which they are returned without asking
+    redis. After that, the session's version is checked and the session is
+    only loaded again if it has changed. A session changed by another process
+    may therefore be returned for up to `ttl` seconds after the change.
+
+    :param int max_size:
+        Maximum number of sessions to keep. The least recently used sessions
+        are removed first.
+    :param float ttl:
+        Number of seconds a cached session is used without checking its
+        version.
+    :param clock:
+        Provider of the current time. Defaults to the reactor.
+    """
+
+    def __init__(self, max_size, ttl, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # user_id -> (session, version, time checked)
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, user_id):
+        """Return a `(session, version, fresh)` tuple for a cached session,
+        or `None` if the session isn't cached. `fresh` is `False` if the
+        version should be checked before the session is used."""
+        entry = self._sessions.pop(user_id, None)
+        if entry is None:
+            return None
+        self._sessions[user_id] = entry
+        session, version, checked_at = entry
+        fresh = self.clock.seconds() - checked_at < self.ttl
+        return dict(session), version, fresh
+
+    def set(self, user_id, session, version):
+        self._sessions.pop(user_id, None)
+        self._sessions[user_id] = (
+            dict(session), version, self.clock.seconds())
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def remove(self, user_id):
+        self._sessions.pop(user_id, None)
 
 
 class SessionManager(object):
     """A manager for sessions.
 
+    If there is a :class:`SessionCache`, each time a session is written it
+    is given a new random version that is stored alongside it. This lets the
+    cache tell whether its copy of a session is still current without
+    loading the whole session.
+
     :param TxRedisManager redis:
         Redis manager object.
     :param int max_session_length:
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
         Deprecated and ignored.
+    :param SessionCache cache:
+        Local cache for sessions. Default is None (no cache).
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache=None):
         self.max_session_length = max_session_length
         self.redis = redis
+        self.cache = cache
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
 
@@ -33,37 +99,125 @@ class SessionManager(object):
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None,
+                          cache=None):
         """Create a `SessionManager` instance using `TxRedisManager`.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(
+            lambda m: cls(m, max_session_length, gc_period, cache=cache))
+
+    def _session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def _version_key(self, user_id):
+        return "%s:%s" % ('session_version', user_id)
+
+    def _set_version(self, pipe, user_id):
+        """Queue a new version for a session on a pipeline. The version
+        expires with the session.
+
+        Without a cache no version is stored. The old version is deleted
+        instead, so that processes caching the session still see that it
+        has changed."""
+        vkey = self._version_key(user_id)
+        if self.cache is None:
+            pipe.delete(vkey)
+            return None
+        version = uuid4().hex
+        pipe.set(vkey, version)
+        if self.max_session_length:
+            pipe.expire(vkey, int(self.max_session_length))
+        return version
 
     @inlineCallbacks
-    def active_sessions(self):
+    def active_sessions(self, batch_size=100):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        This fetches every page from :meth:`active_sessions_page`, so it is
+        O(n) over the total number of keys in redis and holds all the
+        sessions in memory. Use :meth:`active_sessions_page` directly to
+        process the sessions a batch at a time.
         """
-        keys = yield self.redis.keys('session:*')
         sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
-
+        cursor = None
+        while True:
+            cursor, page = yield self.active_sessions_page(cursor, batch_size)
+            sessions.extend(page)
+            if cursor is None:
+                break
         returnValue(sessions)
 
+    @inlineCallbacks
+    def active_sessions_page(self, cursor=None, batch_size=100):
+        """Return a batch of active user_ids and associated sessions.
+
+        Session keys are found with SCAN, so redis isn't blocked while all
+        its keys are looked at, and the batch of sessions is loaded in a
+        single pipelined request. As with SCAN, a session may be returned
+        more than once.
+
+        :param cursor:
+            The cursor returned with the previous batch, or `None` to start
+            at the beginning.
+        :param int batch_size:
+            The number of keys redis should look at for this batch. Batches
+            may contain fewer sessions than this, or none at all.
+
+        :returns:
+            A Deferred that fires with a `(cursor, sessions)` tuple, where
+            `cursor` is `None` once there are no more batches and `sessions`
+            is a list of `(user_id, session)` tuples.
+        """
+        cursor, keys = yield self.redis.scan(
+            cursor, match='session:*', count=batch_size)
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hgetall(key)
+        sessions = yield pipe.execute()
+        returnValue((cursor, [
+            (key.split(':', 1)[1], session)
+            for key, session in zip(keys, sessions)
+            # Sessions may have expired since they were scanned.
+            if session]))
+
+    @Manager.calls_manager('redis')
     def load_session(self, user_id):
         """
         Load session data from Redis
+
+        If there is a cache, a recently used session is returned from it
+        instead. Once the cached session is older than the cache's `ttl`,
+        only the session's version is loaded unless the version has changed.
+        Sessions last written without a cache have no version, and are
+        always loaded again.
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        if self.cache is None:
+            session = yield self.redis.hgetall(self._session_key(user_id))
+            returnValue(session)
 
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            session, version, fresh = cached
+            if fresh:
+                returnValue(session)
+            current_version = yield self.redis.get(
+                self._version_key(user_id))
+            if version is not None and current_version == version:
+                self.cache.set(user_id, session, version)
+                returnValue(session)
+
+        pipe = self.redis.pipeline()
+        pipe.get(self._version_key(user_id))
+        pipe.hgetall(self._session_key(user_id))
+        version, session = yield pipe.execute()
+        self.cache.set(user_id, session, version)
+        returnValue(session)
+
+    @Manager.calls_manager('redis')
     def schedule_session_expiry(self, user_id, timeout):
         """
         Schedule a session to timeout
@@ -75,28 +229,47 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        pipe = self.redis.pipeline()
+        pipe.expire(self._session_key(user_id), timeout)
+        pipe.expire(self._version_key(user_id), timeout)
+        results = yield pipe.execute()
+        returnValue(results[0])
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        Any existing session is replaced. The session is cleared, saved, given
+        an expiry time and loaded again in a single pipelined request.
         """
-        yield self.clear_session(user_id)
+        ukey = self._session_key(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        pipe = self.redis.pipeline()
+        pipe.delete(ukey)
+        pipe.hmset(ukey, defaults)
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            pipe.expire(ukey, int(self.max_session_length))
+        version = self._set_version(pipe, user_id)
+        pipe.hgetall(ukey)
+        results = yield pipe.execute()
+        session = results[-1]
+        if self.cache is not None:
+            self.cache.set(user_id, session, version)
+        returnValue(session)
 
+    @Manager.calls_manager('redis')
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        if self.cache is not None:
+            self.cache.remove(user_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._session_key(user_id))
+        pipe.delete(self._version_key(user_id))
+        results = yield pipe.execute()
+        returnValue(results[0])
 
     @inlineCallbacks
     def save_session(self, user_id, session):
@@ -112,7 +285,17 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        if not session:
+            returnValue(session)
+        ukey = self._session_key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.hmset(ukey, session)
+        version = self._set_version(pipe, user_id)
+        if self.cache is not None:
+            # Cache the session as redis returns it, with all the values
+            # converted to strings.
+            pipe.hgetall(ukey)
+        results = yield pipe.execute()
+        if self.cache is not None:
+            self.cache.set(user_id, results[-1], version)
         returnValue(session)
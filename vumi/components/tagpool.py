@@ -19,16 +19,27 @@ class TagpoolError(VumiError):
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
+    Each pool keeps its free tags in a set and in a sorted set whose scores
+    give the order in which they are handed out. Removing a tag from the
+    sorted set claims it, so acquiring any tag or a specific tag takes
+    O(log n) time in the size of the pool. Older versions kept the queue of
+    free tags in a list, which is moved into the sorted set the first time
+    each pool is used.
+
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
     """
 
     encoding = "UTF-8"
 
+    # Maximum number of tags to add in one pipelined request.
+    DECLARE_CHUNK_SIZE = 1000
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
                               #       the calls_manager decorator work
+        self._migrated_pools = set()
 
     def _encode(self, unicode_text):
         return unicode_text.encode(self.encoding)
@@ -83,7 +94,7 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def purge_pool(self, pool):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         metadata_key = self._tag_pool_metadata_key(pool)
         in_use_count = yield self.redis.scard(inuse_set_key)
         if in_use_count:
@@ -91,11 +102,29 @@ class TagpoolManager(object):
                                in_use_count, pool))
         else:
             yield self.redis.delete(free_set_key)
-            yield self.redis.delete(free_list_key)
+            yield self.redis.delete(free_zset_key)
+            yield self.redis.delete(self._tag_pool_counter_key(pool))
+            yield self.redis.delete(self._tag_pool_free_list_key(pool))
+            yield self.redis.delete(self._tag_pool_migrating_list_key(pool))
             yield self.redis.delete(inuse_set_key)
             yield self.redis.delete(metadata_key)
             yield self._unregister_pool(pool)
 
+    @Manager.calls_manager
+    def migrate_pool(self, pool):
+        """Move a pool's free tags from the free list used by older versions
+        of the tag pool manager to the free sorted set.
+
+        Tags keep their place in the queue of free tags. Pools are also
+        migrated the first time they are used, so this is only needed to
+        migrate pools ahead of time.
+
+        :returns: The number of free tags moved.
+        """
+        count = yield self._migrate_free_list(pool)
+        self._migrated_pools.add(pool)
+        returnValue(count)
+
     @Manager.calls_manager
     def list_pools(self):
         pool_list_key = self._pool_list_key()
@@ -104,14 +133,14 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def free_tags(self, pool):
-        _free_list, free_set_key, _inuse_set = self._tag_pool_keys(pool)
+        _free_zset, free_set_key, _inuse_set = self._tag_pool_keys(pool)
         free_tags = yield self.redis.smembers(free_set_key)
         returnValue([(pool, self._decode(local_tag))
                      for local_tag in free_tags])
 
     @Manager.calls_manager
     def inuse_tags(self, pool):
-        _free_list, _free_set, inuse_set_key = self._tag_pool_keys(pool)
+        _free_zset, _free_set, inuse_set_key = self._tag_pool_keys(pool)
         inuse_tags = yield self.redis.smembers(inuse_set_key)
         returnValue([(pool, self._decode(local_tag))
                      for local_tag in inuse_tags])
@@ -155,26 +184,96 @@ class TagpoolManager(object):
     def _tag_pool_keys(self, pool):
         pool = self._encode(pool)
         return tuple(":".join(["tagpools", pool, state])
-                     for state in ("free:list", "free:set", "inuse:set"))
+                     for state in ("free:zset", "free:set", "inuse:set"))
+
+    def _tag_pool_counter_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:counter"])
+
+    def _tag_pool_free_list_key(self, pool):
+        # Older versions of the tag pool manager kept free tags in a list.
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:list"])
+
+    def _tag_pool_migrating_list_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:list:migrating"])
 
     def _tag_pool_metadata_key(self, pool):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
+    @Manager.calls_manager
+    def _ensure_migrated(self, pool):
+        if pool not in self._migrated_pools:
+            yield self._migrate_free_list(pool)
+            self._migrated_pools.add(pool)
+
+    @Manager.calls_manager
+    def _migrate_free_list(self, pool):
+        # Finish off any migration that was interrupted before we start
+        # another one.
+        count = yield self._move_migrating_tags(pool)
+        # Move the old list out of the way first so that nothing is added to
+        # it while we migrate it. If the rename fails, there's nothing to do.
+        try:
+            yield self.redis.rename(
+                self._tag_pool_free_list_key(pool),
+                self._tag_pool_migrating_list_key(pool))
+        except self.redis.RESPONSE_ERROR:
+            returnValue(count)
+        count += yield self._move_migrating_tags(pool)
+        returnValue(count)
+
+    @Manager.calls_manager
+    def _move_migrating_tags(self, pool):
+        """Move the tags in the list being migrated into the free sorted set.
+
+        Only tags that are still free and aren't in the sorted set yet are
+        moved, so this is safe to run again if it is interrupted.
+        """
+        free_zset_key, free_set_key, _inuse = self._tag_pool_keys(pool)
+        migrating_key = self._tag_pool_migrating_list_key(pool)
+        local_tags = yield self.redis.lrange(migrating_key, 0, -1)
+        if not local_tags:
+            returnValue(0)
+        pipe = self.redis.pipeline()
+        for tag in local_tags:
+            pipe.sismember(free_set_key, tag)
+            pipe.zscore(free_zset_key, tag)
+        results = yield pipe.execute()
+        local_tags = [
+            tag for i, tag in enumerate(local_tags)
+            if results[2 * i] and results[2 * i + 1] is None]
+        if local_tags:
+            yield self._add_free_tags(pool, local_tags)
+        yield self.redis.delete(migrating_key)
+        returnValue(len(local_tags))
+
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        yield self._ensure_migrated(pool)
+        while True:
+            tags = yield self.redis.zrange(free_zset_key, 0, 0)
+            if not tags:
+                returnValue(None)
+            [tag] = tags
+            # Only one of several concurrent callers can remove the tag, so
+            # the others go around again for the next one.
+            claimed = yield self.redis.zrem(free_zset_key, tag)
+            if claimed:
+                break
+        yield self.redis.smove(free_set_key, inuse_set_key, tag)
+        yield self._store_reason(pool, tag, owner, reason)
+        returnValue(self._decode(tag))
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        yield self._ensure_migrated(pool)
+        moved = yield self.redis.zrem(free_zset_key, local_tag)
         if moved:
             yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
             yield self._store_reason(pool, local_tag, owner, reason)
@@ -183,21 +282,44 @@ class TagpoolManager(object):
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        yield self._ensure_migrated(pool)
         count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
         if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
+            # Released tags go to the back of the queue.
+            score = yield self.redis.incr(self._tag_pool_counter_key(pool))
+            yield self.redis.zadd(free_zset_key, **{local_tag: score})
             yield self._remove_reason(pool, local_tag)
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        _free_zset, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        yield self._ensure_migrated(pool)
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
         old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        new_tags = sorted(new_tags - old_tags)
+        if new_tags:
+            yield self._add_free_tags(pool, new_tags)
+
+    @Manager.calls_manager
+    def _add_free_tags(self, pool, local_tags):
+        """Add encoded tags to the back of the queue of free tags, in order.
+        """
+        free_zset_key, free_set_key, _inuse = self._tag_pool_keys(pool)
+        last_score = yield self.redis.incr(
+            self._tag_pool_counter_key(pool), len(local_tags))
+        score = last_score - len(local_tags)
+        pipe = self.redis.pipeline()
+        for i in xrange(0, len(local_tags), self.DECLARE_CHUNK_SIZE):
+            chunk = local_tags[i:i + self.DECLARE_CHUNK_SIZE]
+            scores = {}
+            for tag in chunk:
+                score += 1
+                scores[tag] = score
+            pipe.sadd(free_set_key, *chunk)
+            pipe.zadd(free_zset_key, **scores)
+            yield pipe.execute()
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
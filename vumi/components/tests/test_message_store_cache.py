@@ -514,3 +514,55 @@ class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
         self.assertEqual(
             set(cached_message_keys),
             set([m['message_id'] for m in received_messages[-truncate_at:]]))
+
+
+class TestMessageStoreCacheRoundTrips(VumiTestCase):
+    """
+    Round trip budgets for common message store cache operations. These
+    don't need Riak, so the cache is built directly on a Redis manager.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        from vumi.components.message_store_cache import MessageStoreCache
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.cache = MessageStoreCache(self.redis)
+        self.batch_id = 'a-batch-id'
+        self.msg_helper = self.add_helper(MessageHelper())
+
+    @inlineCallbacks
+    def assert_round_trips(self, expected, func, *args):
+        fake_redis = self.persistence_helper.get_fake_redis(self.redis)
+        fake_redis.reset_counts()
+        yield func(*args)
+        self.assertEqual(fake_redis.round_trips, expected)
+
+    @inlineCallbacks
+    def test_batch_round_trips(self):
+        yield self.assert_round_trips(
+            11, self.cache.batch_start, self.batch_id)
+        yield self.assert_round_trips(
+            1, self.cache.get_event_status, self.batch_id)
+        yield self.assert_round_trips(
+            10, self.cache.clear_batch, self.batch_id)
+
+    @inlineCallbacks
+    def test_message_round_trips(self):
+        yield self.cache.batch_start(self.batch_id)
+        outbound = self.msg_helper.make_outbound("outbound")
+        inbound = self.msg_helper.make_inbound("inbound")
+        ack = self.msg_helper.make_ack(outbound)
+        yield self.assert_round_trips(
+            6, self.cache.add_outbound_message, self.batch_id, outbound)
+        # A message we've already seen only updates the key and address.
+        yield self.assert_round_trips(
+            2, self.cache.add_outbound_message, self.batch_id, outbound)
+        yield self.assert_round_trips(
+            5, self.cache.add_inbound_message, self.batch_id, inbound)
+        yield self.assert_round_trips(
+            5, self.cache.add_event, self.batch_id, ack)
+        yield self.assert_round_trips(
+            2, self.cache.count_outbound_message_keys, self.batch_id)
+        yield self.assert_round_trips(
+            1, self.cache.get_outbound_message_keys, self.batch_id)
@@ -3,8 +3,9 @@
 import time
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
-from vumi.components.session import SessionManager
+from vumi.components.session import SessionManager, SessionCache
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -35,10 +36,44 @@ class TestSessionManager(VumiTestCase):
         s1, s2 = yield get_sessions()
         self.assertTrue(s1[1]['created_at'] < s2[1]['created_at'])
 
+    @inlineCallbacks
+    def test_active_sessions_page(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        yield self.sm.create_session("u3")
+        yield self.manager.set("other", "foo")
+        user_ids = []
+        cursor = None
+        while True:
+            cursor, sessions = yield self.sm.active_sessions_page(
+                cursor, batch_size=1)
+            for user_id, session in sessions:
+                self.assertTrue('created_at' in session)
+                user_ids.append(user_id)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(set(user_ids)), ["u1", "u2", "u3"])
+
+    @inlineCallbacks
+    def test_active_sessions_skips_cleared_sessions(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        yield self.sm.clear_session("u1")
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual([user_id for user_id, _ in sessions], ["u2"])
+
     @inlineCallbacks
     def test_schedule_session_expiry(self):
         self.sm.max_session_length = 60.0
         yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_create_session_without_expiry(self):
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertEqual(ttl, None)
 
     @inlineCallbacks
     def test_create_and_retrieve_session(self):
@@ -70,3 +105,199 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_empty_session(self):
+        session = yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {})
+        self.assertEqual((yield self.sm.load_session("u1")), session)
+
+    @inlineCallbacks
+    def test_no_version_without_cache(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual((yield self.manager.keys()), ["session:u1"])
+
+    @inlineCallbacks
+    def test_round_trips(self):
+        fake_redis = self.persistence_helper.get_fake_redis(self.manager)
+        for op, args in [
+                (self.sm.create_session, ("u1",)),
+                (self.sm.load_session, ("u1",)),
+                (self.sm.save_session, ("u1", {"foo": "bar"})),
+                (self.sm.schedule_session_expiry, ("u1", 10)),
+                (self.sm.clear_session, ("u1",))]:
+            fake_redis.reset_counts()
+            yield op(*args)
+            self.assertEqual(fake_redis.round_trips, 1, op.__name__)
+
+
+class TestSessionManagerSync(VumiTestCase):
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=True))
+        self.manager = self.persistence_helper.get_redis_manager()
+        self.manager._purge_all()  # Just in case
+        self.sm = SessionManager(self.manager)
+
+    def test_sync_calls(self):
+        self.manager.hmset("session:u1", {"foo": "bar"})
+        self.assertEqual(self.sm.load_session("u1"), {"foo": "bar"})
+        self.assertEqual(self.sm.schedule_session_expiry("u1", 10), True)
+        self.assertTrue(0 < self.manager.ttl("session:u1") <= 10)
+        self.assertEqual(self.sm.clear_session("u1"), 1)
+        self.assertEqual(self.sm.load_session("u1"), {})
+
+
+class TestSessionCache(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = SessionCache(2, 5, clock=self.clock)
+
+    def test_get_missing(self):
+        self.assertEqual(self.cache.get("u1"), None)
+
+    def test_set_and_get(self):
+        self.cache.set("u1", {"foo": "bar"}, "v1")
+        self.assertEqual(self.cache.get("u1"), ({"foo": "bar"}, "v1", True))
+        self.clock.advance(5)
+        self.assertEqual(self.cache.get("u1"), ({"foo": "bar"}, "v1", False))
+
+    def test_get_returns_copy(self):
+        self.cache.set("u1", {"foo": "bar"}, "v1")
+        session, _, _ = self.cache.get("u1")
+        session["foo"] = "baz"
+        self.assertEqual(self.cache.get("u1"), ({"foo": "bar"}, "v1", True))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("u1", {}, "v1")
+        self.cache.set("u2", {}, "v2")
+        self.cache.get("u1")
+        self.cache.set("u3", {}, "v3")
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get("u2"), None)
+        self.assertNotEqual(self.cache.get("u1"), None)
+
+    def test_remove(self):
+        self.cache.set("u1", {}, "v1")
+        self.cache.remove("u1")
+        self.cache.remove("u1")
+        self.assertEqual(self.cache.get("u1"), None)
+
+
+class TestSessionManagerWithCache(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.manager = yield self.persistence_helper.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.clock = Clock()
+        self.cache = SessionCache(10, 5, clock=self.clock)
+        self.sm = SessionManager(self.manager, cache=self.cache)
+        self.add_cleanup(self.sm.stop)
+        # Another process sharing the sessions, without a cache.
+        self.other_sm = SessionManager(self.manager)
+        self.add_cleanup(self.other_sm.stop)
+
+    @inlineCallbacks
+    def test_create_session_is_cached(self):
+        session = yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.delete("session:u1")
+        self.assertEqual((yield self.sm.load_session("u1")), session)
+
+    @inlineCallbacks
+    def test_save_session_is_cached(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"count": 1})
+        yield self.manager.delete("session:u1")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["count"], "1")
+
+    @inlineCallbacks
+    def test_load_session_is_cached(self):
+        yield self.other_sm.create_session("u1", foo="bar")
+        yield self.sm.load_session("u1")
+        self.assertEqual(len(self.cache), 1)
+        yield self.manager.delete("session:u1")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "bar")
+
+    @inlineCallbacks
+    def test_clear_session_removes_cached_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_unchanged_session_is_kept_after_ttl(self):
+        yield self.sm.create_session("u1", foo="bar")
+        self.clock.advance(5)
+        # Change the session without changing its version, so we can see
+        # that the cached copy is still used.
+        yield self.manager.hset("session:u1", "foo", "baz")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "bar")
+        self.assertEqual(self.cache.get("u1")[2], True)
+
+    @inlineCallbacks
+    def test_changed_session_is_reloaded_after_ttl(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.other_sm.save_session("u1", {"foo": "baz"})
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "bar")
+        self.clock.advance(5)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "baz")
+
+    @inlineCallbacks
+    def test_cleared_session_is_reloaded_after_ttl(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.other_sm.clear_session("u1")
+        self.clock.advance(5)
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_recreated_session_is_reloaded_after_ttl(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.other_sm.clear_session("u1")
+        yield self.other_sm.create_session("u1", foo="baz")
+        self.clock.advance(5)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "baz")
+
+    @inlineCallbacks
+    def test_session_saved_without_cache_is_reloaded_after_ttl(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.other_sm.save_session("u1", {"foo": "baz"})
+        self.clock.advance(5)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "baz")
+        # The session has no version now, so it's loaded again every time the
+        # cached copy is stale.
+        yield self.other_sm.save_session("u1", {"foo": "quux"})
+        self.clock.advance(5)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "quux")
+
+    @inlineCallbacks
+    def test_version_expires_with_session(self):
+        sm = SessionManager(
+            self.manager, max_session_length=60, cache=self.cache)
+        yield sm.create_session("u1")
+        self.assertTrue(
+            0 < (yield self.manager.ttl("session_version:u1")) <= 60)
+        yield sm.schedule_session_expiry("u1", 10)
+        self.assertTrue(
+            0 < (yield self.manager.ttl("session_version:u1")) <= 10)
+
+    @inlineCallbacks
+    def test_round_trips(self):
+        fake_redis = self.persistence_helper.get_fake_redis(self.manager)
+        yield self.sm.create_session("u1")
+
+        fake_redis.reset_counts()
+        yield self.sm.load_session("u1")
+        self.assertEqual(fake_redis.round_trips, 0)
+
+        # Once the cached session is stale, only the version is checked.
+        self.clock.advance(6)
+        fake_redis.reset_counts()
+        yield self.sm.load_session("u1")
+        self.assertEqual(fake_redis.round_trips, 1)
+        self.assertEqual(fake_redis.command_counts, {"get": 1})
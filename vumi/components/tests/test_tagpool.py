@@ -35,6 +35,20 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.declare_tags([tag2, tag3])
         self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
 
+    @inlineCallbacks
+    def test_declare_tags_in_chunks(self):
+        tkey = self.pool_key_generator("poolA")
+        self.patch(TagpoolManager, "DECLARE_CHUNK_SIZE", 3)
+        local_tags = ["tag%02d" % i for i in range(10)]
+        yield self.tpm.declare_tags([("poolA", t) for t in local_tags])
+        redis = self.redis
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
+                         local_tags)
+        self.assertEqual((yield redis.smembers(tkey("free:set"))),
+                         set(local_tags))
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag00"))
+
     @inlineCallbacks
     def test_declare_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -89,7 +103,7 @@ class TestTxTagpoolManager(VumiTestCase):
         self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
         self.assertEqual((yield self.tpm.acquire_tag("poolB")), None)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag2"])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(["tag2"]))
@@ -114,7 +128,7 @@ class TestTxTagpoolManager(VumiTestCase):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          free_local_tags)
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
@@ -137,13 +151,162 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.acquire_tag("poolA")
         yield self.tpm.release_tag(tag1)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag3", "tag1"])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(["tag1", "tag3"]))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag2"]))
 
+    @inlineCallbacks
+    def test_release_tag_goes_to_back_of_queue(self):
+        tag1, tag2, tag3 = [("poolA", "tag%d" % i) for i in (1, 2, 3)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        yield self.tpm.release_tag(tag1)
+        yield self.tpm.declare_tags([tag3])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_release_free_tag(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2"])
+
+    @inlineCallbacks
+    def test_acquire_tag_claimed_elsewhere(self):
+        """
+        If another caller claims the first free tag between our reading it
+        and removing it, we move on to the next one.
+        """
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        # Someone else claims tag1 after we've seen it at the front of the
+        # queue.
+        yield self.redis.zrem(tkey("free:zset"), "tag1")
+        orig_zrange = self.redis.zrange
+        stale = [["tag1"]]
+
+        def stale_zrange(key, start, stop, *args, **kw):
+            if stale:
+                return stale.pop()
+            return orig_zrange(key, start, stop, *args, **kw)
+
+        self.patch(self.redis, "zrange", stale_zrange)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_migrate_pool(self):
+        tkey = self.pool_key_generator("poolA")
+        redis = self.redis
+        yield self.make_old_pool("poolA", ["tag3", "tag1", "tag2"], ["tag0"])
+        self.assertEqual((yield self.tpm.migrate_pool("poolA")), 3)
+        self.assertEqual((yield redis.exists(tkey("free:list"))), False)
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag3", "tag1", "tag2"])
+        self.assertEqual((yield redis.smembers(tkey("free:set"))),
+                         set(["tag1", "tag2", "tag3"]))
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag3"))
+        yield self.tpm.release_tag(("poolA", "tag0"))
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2", "tag0"])
+        # Migrating again does nothing.
+        self.assertEqual((yield self.tpm.migrate_pool("poolA")), 0)
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2", "tag0"])
+
+    @inlineCallbacks
+    def make_old_pool(self, pool, free_tags, inuse_tags=()):
+        """Lay out a pool the way older versions of the tag pool manager did.
+        """
+        tkey = self.pool_key_generator(pool)
+        for local_tag in free_tags:
+            yield self.redis.rpush(tkey("free:list"), local_tag)
+            yield self.redis.sadd(tkey("free:set"), local_tag)
+        for local_tag in inuse_tags:
+            yield self.redis.sadd(tkey("inuse:set"), local_tag)
+
+    @inlineCallbacks
+    def test_acquire_tag_from_old_pool(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.make_old_pool("poolA", ["tag3", "tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag3"))
+        self.assertEqual((yield self.redis.exists(tkey("free:list"))), False)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag1"))
+
+    @inlineCallbacks
+    def test_acquire_specific_tag_from_old_pool(self):
+        yield self.make_old_pool("poolA", ["tag1", "tag2"])
+        self.assertEqual(
+            (yield self.tpm.acquire_specific_tag(("poolA", "tag2"))),
+            ("poolA", "tag2"))
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag1"))
+
+    @inlineCallbacks
+    def test_release_tag_to_old_pool(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.make_old_pool("poolA", ["tag1", "tag2"], ["tag0"])
+        yield self.tpm.release_tag(("poolA", "tag0"))
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2", "tag0"])
+
+    @inlineCallbacks
+    def test_declare_tags_in_old_pool(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.make_old_pool("poolA", ["tag2", "tag1"])
+        yield self.tpm.declare_tags([("poolA", "tag1"), ("poolA", "tag3")])
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag2", "tag1", "tag3"])
+
+    @inlineCallbacks
+    def test_resume_interrupted_migration(self):
+        tkey = self.pool_key_generator("poolA")
+        redis = self.redis
+        yield self.make_old_pool("poolA", ["tag1", "tag2", "tag3", "tag4"])
+        # A migration moved the list out of the way and added the first two
+        # tags to the sorted set before it was interrupted. One of those has
+        # been acquired since.
+        yield redis.rename(tkey("free:list"), tkey("free:list:migrating"))
+        yield redis.zadd(tkey("free:zset"), tag1=1, tag2=2)
+        yield redis.set(tkey("free:counter"), 2)
+        yield self.tpm.acquire_specific_tag(("poolA", "tag1"))
+        yield self.make_old_pool("poolA", ["tag5"])
+
+        tpm = TagpoolManager(self.redis)
+        self.assertEqual((yield tpm.acquire_tag("poolA")), ("poolA", "tag2"))
+        self.assertEqual((yield redis.exists(tkey("free:list"))), False)
+        self.assertEqual(
+            (yield redis.exists(tkey("free:list:migrating"))), False)
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag3", "tag4", "tag5"])
+        self.assertEqual(sorted((yield tpm.inuse_tags("poolA"))),
+                         [("poolA", "tag1"), ("poolA", "tag2")])
+
+    @inlineCallbacks
+    def test_migrate_pool_resumes_interrupted_migration(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.make_old_pool("poolA", ["tag1", "tag2"])
+        yield self.redis.rename(
+            tkey("free:list"), tkey("free:list:migrating"))
+        self.assertEqual((yield self.tpm.migrate_pool("poolA")), 2)
+        self.assertEqual(
+            (yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+            ["tag1", "tag2"])
+
     @inlineCallbacks
     def test_release_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -275,6 +438,44 @@ class TestTxTagpoolManager(VumiTestCase):
         my_tags = yield self.tpm.owned_tags(u"me")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_declare_tags_round_trips(self):
+        fake_redis = self.persistence_helper.get_fake_redis(self.redis)
+        self.patch(TagpoolManager, "DECLARE_CHUNK_SIZE", 1000)
+        fake_redis.reset_counts()
+        yield self.tpm.declare_tags(
+            [("poolA", "tag%d" % i) for i in range(2500)])
+        # Register the pool, look for old free lists, find existing tags,
+        # reserve scores and one pipeline per chunk.
+        self.assertEqual(fake_redis.round_trips, 8)
+
+    @inlineCallbacks
+    def test_acquire_and_release_round_trips(self):
+        fake_redis = self.persistence_helper.get_fake_redis(self.redis)
+        yield self.tpm.declare_tags(
+            [("poolA", "tag%d" % i) for i in range(100)])
+
+        fake_redis.reset_counts()
+        yield self.tpm.acquire_tag("poolA")
+        self.assertEqual(fake_redis.round_trips, 5)
+
+        fake_redis.reset_counts()
+        yield self.tpm.acquire_specific_tag(("poolA", "tag50"))
+        self.assertEqual(fake_redis.round_trips, 4)
+
+        fake_redis.reset_counts()
+        yield self.tpm.release_tag(("poolA", "tag50"))
+        self.assertEqual(fake_redis.round_trips, 5)
+
+        fake_redis.reset_counts()
+        yield self.tpm.acquire_tag("poolB")
+        # Look for old free lists the first time the pool is used.
+        self.assertEqual(fake_redis.round_trips, 3)
+
+        fake_redis.reset_counts()
+        yield self.tpm.acquire_tag("poolB")
+        self.assertEqual(fake_redis.round_trips, 1)
+
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
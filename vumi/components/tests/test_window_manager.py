@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -103,6 +103,157 @@ class TestWindowManager(VumiTestCase):
             (yield self.wm.get_internal_id(self.window_id, "external_id")),
             None)
 
+    @inlineCallbacks
+    def test_remove_key_clears_flight_data(self):
+        key = yield self.wm.add(self.window_id, 1)
+        self.assertEqual((yield self.wm.get_next_key(self.window_id)), key)
+        yield self.assert_in_flight(self.window_id, 1)
+        yield self.wm.remove_key(self.window_id, key)
+        yield self.assert_in_flight(self.window_id, 0)
+        self.assertEqual(
+            (yield self.redis.get(self.wm.window_key(self.window_id, key))),
+            None)
+        self.assertEqual(
+            (yield self.redis.zscore(self.wm.stats_key(self.window_id), key)),
+            None)
+
+    @inlineCallbacks
+    def test_clear_expired_flight_keys_frees_window(self):
+        for i in range(12):
+            yield self.wm.add(self.window_id, i)
+        yield self.slide_window()
+        yield self.assert_in_flight(self.window_id, 10)
+        self.assertEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+        self.clock.advance(10)
+        yield self.wm.clear_expired_flight_keys()
+        yield self.assert_in_flight(self.window_id, 0)
+        # Expired keys are still reported until they're removed.
+        yield self.assert_expired_keys(self.window_id, 10)
+        self.assertNotEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+    @inlineCallbacks
+    def test_get_next_key_claims_atomically(self):
+        key = yield self.wm.add(self.window_id, 1)
+        claimed = []
+
+        def set_timestamp(window_id, flight_keys):
+            claimed.extend(flight_keys)
+            raise Exception("Failed before timestamping")
+
+        self.patch(self.wm, '_set_timestamp', set_timestamp)
+        yield self.assertFailure(
+            self.wm.get_next_key(self.window_id), Exception)
+        self.assertEqual(claimed, [key])
+        # The key is no longer waiting, but hasn't been lost.
+        yield self.assert_count_waiting(self.window_id, 0)
+        self.assertEqual(
+            (yield self.redis.lrange(self.wm.claimed_key(self.window_id),
+                                     0, -1)),
+            [key])
+
+    @inlineCallbacks
+    def test_clear_expired_flight_keys_recovers_claimed_keys(self):
+        key = yield self.wm.add(self.window_id, 1)
+        yield self.redis.rpoplpush(
+            self.wm.window_key(self.window_id),
+            self.wm.claimed_key(self.window_id))
+
+        yield self.wm.clear_expired_flight_keys()
+        yield self.assert_in_flight(self.window_id, 1)
+        self.assertEqual(
+            (yield self.redis.llen(self.wm.claimed_key(self.window_id))), 0)
+
+        # Recovered keys expire like any other in-flight key.
+        self.clock.advance(10)
+        yield self.wm.clear_expired_flight_keys()
+        yield self.assert_in_flight(self.window_id, 0)
+        self.assertEqual(
+            (yield self.wm.get_expired_flight_keys(self.window_id)), [key])
+
+    @inlineCallbacks
+    def make_old_flight_list(self, count):
+        """
+        Put `count` keys in flight the way older window managers stored them.
+        """
+        for i in range(count):
+            yield self.wm.add(self.window_id, i)
+        keys = []
+        for i in range(count):
+            key = yield self.redis.rpop(self.wm.window_key(self.window_id))
+            keys.append(key)
+        flight_key = self.wm.flight_key(self.window_id)
+        for key in keys:
+            yield self.redis.lpush(flight_key, key)
+        returnValue(keys)
+
+    @inlineCallbacks
+    def test_old_windows_migrated_on_first_use(self):
+        yield self.make_old_flight_list(2)
+        yield self.wm.add(self.window_id, 'waiting')
+        flight_key = self.wm.flight_key(self.window_id)
+        self.assertEqual((yield self.redis.type(flight_key)), 'list')
+        yield self.assert_in_flight(self.window_id, 2)
+        self.assertEqual((yield self.redis.type(flight_key)), 'zset')
+        self.assertNotEqual((yield self.wm.get_next_key(self.window_id)), None)
+        yield self.assert_in_flight(self.window_id, 3)
+
+    @inlineCallbacks
+    def test_old_windows_migrated_by_gc(self):
+        yield self.make_old_flight_list(3)
+        yield self.wm.clear_expired_flight_keys()
+        flight_key = self.wm.flight_key(self.window_id)
+        self.assertEqual((yield self.redis.type(flight_key)), 'zset')
+        yield self.assert_in_flight(self.window_id, 3)
+        self.clock.advance(10)
+        yield self.wm.clear_expired_flight_keys()
+        yield self.assert_in_flight(self.window_id, 0)
+
+    @inlineCallbacks
+    def test_migrate_flight_key_already_migrated(self):
+        yield self.make_old_flight_list(1)
+        flight_key = self.wm.flight_key(self.window_id)
+        # Another window manager converts the list after we've checked its
+        # type but before we rename it.
+        orig_type = self.redis.type
+
+        @inlineCallbacks
+        def type_and_migrate(key):
+            key_type = yield orig_type(key)
+            self.patch(self.redis, 'type', orig_type)
+            wm = WindowManager(self.redis)
+            self.add_cleanup(wm.stop)
+            yield wm.migrate_windows()
+            returnValue(key_type)
+
+        self.patch(self.redis, 'type', type_and_migrate)
+        yield self.wm._migrate_flight_key(self.window_id)
+        self.assertEqual((yield self.redis.type(flight_key)), 'zset')
+        yield self.assert_in_flight(self.window_id, 1)
+
+    @inlineCallbacks
+    def test_migrate_windows(self):
+        keys = yield self.make_old_flight_list(3)
+        flight_key = self.wm.flight_key(self.window_id)
+        yield self.redis.zadd(self.wm.stats_key(self.window_id), **{
+            keys[0]: 5,
+        })
+        self.clock.advance(7)
+
+        yield self.wm.migrate_windows()
+        self.assertEqual((yield self.redis.type(flight_key)), 'zset')
+        yield self.assert_in_flight(self.window_id, 3)
+        self.assertEqual(
+            (yield self.redis.zrange(flight_key, 0, -1, withscores=True)),
+            [(keys[0], 5.0)] + sorted((key, 7.0) for key in keys[1:]))
+
+        # Migrating again does nothing.
+        yield self.wm.migrate_windows()
+        yield self.assert_in_flight(self.window_id, 3)
+
+        yield self.wm.remove_key(self.window_id, keys[1])
+        yield self.assert_in_flight(self.window_id, 2)
+
     @inlineCallbacks
     def assert_count_waiting(self, window_id, amount):
         self.assertEqual((yield self.wm.count_waiting(window_id)), amount)
@@ -210,6 +361,41 @@ class TestWindowManager(VumiTestCase):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    @inlineCallbacks
+    def test_round_trips(self):
+        fake_redis = self.persistence_helper.get_fake_redis(self.redis)
+
+        fake_redis.reset_counts()
+        yield self.wm.add(self.window_id, 1)
+        self.assertEqual(fake_redis.round_trips, 2)
+
+        fake_redis.reset_counts()
+        key = yield self.wm.get_next_key(self.window_id)
+        # The first use of a window checks for an old in-flight list.
+        self.assertEqual(fake_redis.round_trips, 5)
+
+        yield self.wm.add(self.window_id, 2)
+        fake_redis.reset_counts()
+        key2 = yield self.wm.get_next_key(self.window_id)
+        self.assertEqual(fake_redis.round_trips, 4)
+        yield self.wm.remove_key(self.window_id, key2)
+
+        fake_redis.reset_counts()
+        yield self.wm.set_external_id(self.window_id, key, 'external-1')
+        self.assertEqual(fake_redis.round_trips, 2)
+
+        fake_redis.reset_counts()
+        yield self.wm.remove_key(self.window_id, key)
+        self.assertEqual(fake_redis.round_trips, 2)
+
+        fake_redis.reset_counts()
+        yield self.wm.get_next_key(self.window_id)
+        self.assertEqual(fake_redis.round_trips, 1)
+
+        fake_redis.reset_counts()
+        yield self.wm.clear_expired_flight_keys()
+        self.assertEqual(fake_redis.round_trips, 2)
+
 
 class TestConcurrentWindowManager(VumiTestCase):
 
@@ -3,7 +3,7 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from twisted.internet.task import LoopingCall
 
 from vumi import log
@@ -14,6 +14,18 @@ class WindowException(Exception):
 
 
 class WindowManager(object):
+    """
+    Manages windows of keys waiting to be processed, limiting how many keys
+    from each window may be in flight at once.
+
+    In-flight keys are kept in a sorted set scored by the time they were
+    dispatched. Older versions of the window manager kept them in a list.
+    Each window's list is converted to a sorted set the first time a window
+    manager touches the window, so windows left by an older version keep
+    working after an upgrade. All window managers using the old layout must
+    be stopped before upgraded ones are started, because they will fail on
+    windows that have been converted.
+    """
 
     WINDOW_KEY = 'windows'
     FLIGHT_KEY = 'inflight'
@@ -28,8 +40,9 @@ class WindowManager(object):
         self.clock = self.get_clock()
         self.gc = LoopingCall(self.clear_expired_flight_keys)
         self.gc.clock = self.clock
-        self.gc.start(gc_interval)
         self._monitor = None
+        self._migrated_windows = set()
+        self.gc.start(gc_interval)
 
     def noop(self, *args, **kwargs):
         pass
@@ -101,7 +114,7 @@ class WindowManager(object):
     def get_next_key(self, window_id):
 
         window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
+        claimed_key = self.claimed_key(window_id)
 
         waiting_list = yield self.count_waiting(window_id)
         if waiting_list == 0:
@@ -113,15 +126,23 @@ class WindowManager(object):
         if room_available > 0:
             log.debug('Window %s has space for %s' % (window_key,
                                                         room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
+            # The key is moved atomically into the claimed list so that it
+            # can't be lost if we fail before it's been timestamped. Keys
+            # left there are recovered by clear_expired_flight_keys().
+            next_key = yield self.redis.rpoplpush(window_key, claimed_key)
             if next_key:
-                yield self._set_timestamp(window_id, next_key)
+                yield self._set_timestamp(window_id, [next_key])
                 returnValue(next_key)
 
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
+    def _set_timestamp(self, window_id, flight_keys):
+        clock_time = self.get_clocktime()
+        timestamps = dict((key, clock_time) for key in flight_keys)
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.flight_key(window_id), **timestamps)
+        pipe.zadd(self.stats_key(window_id), **timestamps)
+        for key in flight_keys:
+            pipe.lrem(self.claimed_key(window_id), key, 1)
+        return pipe.execute()
 
     def _clear_timestamp(self, window_id, flight_key):
         return self.redis.zrem(self.stats_key(window_id), flight_key)
@@ -130,21 +151,35 @@ class WindowManager(object):
         window_key = self.window_key(window_id)
         return self.redis.llen(window_key)
 
+    @inlineCallbacks
     def count_in_flight(self, window_id):
-        flight_key = self.flight_key(window_id)
-        return self.redis.llen(flight_key)
+        yield self._ensure_migrated(window_id)
+        count = yield self.redis.zcard(self.flight_key(window_id))
+        returnValue(count)
 
     def get_expired_flight_keys(self, window_id):
         return self.redis.zrangebyscore(self.stats_key(window_id),
             '-inf', self.get_clocktime() - self.flight_lifetime)
 
+    def claimed_key(self, window_id):
+        return self.flight_key(window_id, 'claimed')
+
     @inlineCallbacks
     def clear_expired_flight_keys(self):
         windows = yield self.get_windows()
         for window_id in windows:
-            expired_keys = yield self.get_expired_flight_keys(window_id)
-            for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            yield self._ensure_migrated(window_id)
+            pipe = self.redis.pipeline()
+            pipe.zremrangebyscore(
+                self.flight_key(window_id), '-inf',
+                self.get_clocktime() - self.flight_lifetime)
+            pipe.lrange(self.claimed_key(window_id), 0, -1)
+            [_, claimed_keys] = yield pipe.execute()
+            if claimed_keys:
+                # These were claimed by a window manager that didn't get as
+                # far as timestamping them. Put them in flight now so they
+                # expire like any other unacknowledged key.
+                yield self._set_timestamp(window_id, claimed_keys)
 
     @inlineCallbacks
     def get_data(self, window_id, key):
@@ -153,11 +188,63 @@ class WindowManager(object):
 
     @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        yield self._ensure_migrated(window_id)
+        pipe = self.redis.pipeline()
+        pipe.get(self.map_key(window_id, 'external', key))
+        pipe.zrem(self.flight_key(window_id), key)
+        pipe.zrem(self.stats_key(window_id), key)
+        pipe.delete(self.window_key(window_id, key))
+        pipe.delete(self.map_key(window_id, 'external', key))
+        [external_id, _, _, _, _] = yield pipe.execute()
+        if external_id:
+            yield self.redis.delete(self.map_key(window_id, 'internal',
+                                                 external_id))
+
+    @inlineCallbacks
+    def migrate_windows(self):
+        """
+        Convert in-flight keys stored by older versions of the window manager
+        in a list into the sorted set used now.
+
+        Windows are also converted when they're first used, so calling this
+        is optional. It converts every window up front instead.
+        """
+        windows = yield self.get_windows()
+        for window_id in windows:
+            yield self._migrate_flight_key(window_id)
+            self._migrated_windows.add(window_id)
+
+    def _ensure_migrated(self, window_id):
+        if window_id in self._migrated_windows:
+            return succeed(None)
+        d = self._migrate_flight_key(window_id)
+        d.addCallback(lambda _: self._migrated_windows.add(window_id))
+        return d
+
+    @inlineCallbacks
+    def _migrate_flight_key(self, window_id):
+        flight_key = self.flight_key(window_id)
+        if (yield self.redis.type(flight_key)) != 'list':
+            return
+        # Move the old list out of the way first so nothing can be added to
+        # it while we're reading it. If the rename fails, another window
+        # manager has already converted it.
+        old_flight_key = self.flight_key(
+            window_id, 'migrating', uuid.uuid4().get_hex())
+        try:
+            yield self.redis.rename(flight_key, old_flight_key)
+        except self.redis.RESPONSE_ERROR:
+            return
+        pipe = self.redis.pipeline()
+        pipe.lrange(old_flight_key, 0, -1)
+        pipe.zrange(self.stats_key(window_id), 0, -1, withscores=True)
+        [keys, timestamps] = yield pipe.execute()
+        timestamps = dict(timestamps)
+        clock_time = self.get_clocktime()
+        if keys:
+            yield self.redis.zadd(flight_key, **dict(
+                (key, timestamps.get(key, clock_time)) for key in keys))
+        yield self.redis.delete(old_flight_key)
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
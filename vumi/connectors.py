@@ -16,9 +16,13 @@ class BaseConnector(object):
     A connector encapsulates the 'inbound', 'outbound' and 'event' publishers
     and consumers required by vumi workers and avoids having to operate on them
     individually all over the place.
+
+    If ``confirm_window`` is set, the connector's publishers use publisher
+    confirms with at most that many unconfirmed messages each. While any of
+    their windows is full, the connector's consumers are paused.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, confirm_window=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -26,6 +30,9 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._confirm_window = confirm_window
+        self._full_confirm_windows = set()
+        self._confirm_paused_consumers = []
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -56,10 +63,39 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        if self._confirm_window:
+            publisher = yield self.worker.publish_to(
+                self._rkey(mtype), confirm_window=self._confirm_window)
+            publisher.confirm_window.add_listener(
+                lambda full: self._confirm_window_changed(mtype, full))
+        else:
+            publisher = yield self.worker.publish_to(self._rkey(mtype))
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
+    def _confirm_window_changed(self, mtype, full):
+        was_full = bool(self._full_confirm_windows)
+        if full:
+            self._full_confirm_windows.add(mtype)
+        else:
+            self._full_confirm_windows.discard(mtype)
+        if self._full_confirm_windows and not was_full:
+            log.info("Pausing %r until the broker confirms more messages." % (
+                self.name,))
+            # Only consumers we pause here are unpaused again later, so we
+            # don't interfere with pausing for other reasons.
+            self._confirm_paused_consumers = [
+                consumer for consumer in self._consumers.itervalues()
+                if not consumer.paused]
+            for consumer in self._confirm_paused_consumers:
+                consumer.pause()
+        elif was_full and not self._full_confirm_windows:
+            log.info("Unpausing %r." % (self.name,))
+            consumers, self._confirm_paused_consumers = (
+                self._confirm_paused_consumers, [])
+            for consumer in consumers:
+                consumer.unpause()
+
     @inlineCallbacks
     def _setup_consumer(self, mtype, msg_class, default_handler):
         def handler(msg):
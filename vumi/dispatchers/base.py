@@ -5,11 +5,13 @@
 import re
 import functools
 
-from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults, succeed,
+    FirstError)
 
 from vumi.service import Worker
 from vumi.errors import ConfigError, DispatcherError
-from vumi.message import TransportUserMessage, TransportEvent
+from vumi.message import TransportUserMessage, TransportEvent, TransportStatus
 from vumi.utils import load_class_by_string, get_first_word
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
@@ -17,6 +19,17 @@ from vumi.components.session import SessionManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
+def _gather(deferreds):
+    """
+    Wait for all of ``deferreds`` to fire. If any of them fail, fail with
+    the first failure as it was raised, rather than wrapped in a
+    :class:`FirstError`.
+    """
+    d = gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure if f.check(FirstError) else f)
+    return d
+
+
 class BaseDispatchWorker(Worker):
     """Base class for a dispatch worker.
 
@@ -31,14 +44,19 @@ class BaseDispatchWorker(Worker):
         yield self.setup_endpoints()
         yield self.setup_middleware()
         yield self.setup_router()
-        yield self.setup_transport_publishers()
-        yield self.setup_exposed_publishers()
-        yield self.setup_transport_consumers()
-        yield self.setup_exposed_consumers()
+        # Each endpoint's publishers and consumers are independent of the
+        # others, so we set them all up at once instead of one at a time.
+        yield _gather([
+            self.setup_transport_publishers(),
+            self.setup_exposed_publishers(),
+            self.setup_transport_consumers(),
+            self.setup_exposed_consumers(),
+        ])
 
         consumers = (self.exposed_consumer.values() +
                         self.transport_consumer.values() +
-                        self.transport_event_consumer.values())
+                        self.transport_event_consumer.values() +
+                        self.transport_status_consumer.values())
         for consumer in consumers:
             consumer.unpause()
 
@@ -67,52 +85,83 @@ class BaseDispatchWorker(Worker):
     def teardown_router(self):
         return maybeDeferred(self._router.teardown_routing)
 
-    @inlineCallbacks
+    def _setup_for_names(self, target, names, setup):
+        """
+        Call ``setup(name)`` for each of ``names`` at once and store the
+        results in ``target``, keyed by name.
+        """
+        def store(result, name):
+            target[name] = result
+
+        deferreds = []
+        for name in names:
+            d = maybeDeferred(setup, name)
+            d.addCallback(store, name)
+            deferreds.append(d)
+        return _gather(deferreds)
+
     def setup_transport_publishers(self):
         self.transport_publisher = {}
-        for transport_name in self.transport_names:
-            self.transport_publisher[transport_name] = yield self.publish_to(
-                '%s.outbound' % (transport_name,))
+        return self._setup_for_names(
+            self.transport_publisher, self.transport_names,
+            lambda name: self.publish_to('%s.outbound' % (name,)))
 
-    @inlineCallbacks
     def setup_transport_consumers(self):
         self.transport_consumer = {}
         self.transport_event_consumer = {}
-        for transport_name in self.transport_names:
-            self.transport_consumer[transport_name] = yield self.consume(
-                '%s.inbound' % (transport_name,),
-                functools.partial(self.dispatch_inbound_message,
-                                  transport_name),
-                message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
-        for transport_name in self.transport_names:
-            self.transport_event_consumer[transport_name] = yield self.consume(
-                '%s.event' % (transport_name,),
-                functools.partial(self.dispatch_inbound_event, transport_name),
-                message_class=TransportEvent, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+        return _gather([
+            self._setup_for_names(
+                self.transport_consumer, self.transport_names,
+                lambda name: self.consume(
+                    '%s.inbound' % (name,),
+                    functools.partial(self.dispatch_inbound_message, name),
+                    message_class=TransportUserMessage, paused=True,
+                    prefetch_count=self.amqp_prefetch_count)),
+            self._setup_for_names(
+                self.transport_event_consumer, self.transport_names,
+                lambda name: self.consume(
+                    '%s.event' % (name,),
+                    functools.partial(self.dispatch_inbound_event, name),
+                    message_class=TransportEvent, paused=True,
+                    prefetch_count=self.amqp_prefetch_count)),
+            self.setup_transport_status_consumers(),
+        ])
+
+    def setup_transport_status_consumers(self):
+        self.transport_status_consumer = {}
+        if not getattr(self._router, 'consume_transport_status', False):
+            return succeed(None)
+        # Transports publish status messages via their
+        # `<transport_name>.status` connector.
+        return self._setup_for_names(
+            self.transport_status_consumer, self.transport_names,
+            lambda name: self.consume(
+                '%s.status.status' % (name,),
+                functools.partial(self.dispatch_transport_status, name),
+                message_class=TransportStatus, paused=True,
+                prefetch_count=self.amqp_prefetch_count))
 
-    @inlineCallbacks
     def setup_exposed_publishers(self):
         self.exposed_publisher = {}
         self.exposed_event_publisher = {}
-        for exposed_name in self.exposed_names:
-            self.exposed_publisher[exposed_name] = yield self.publish_to(
-                '%s.inbound' % (exposed_name,))
-        for exposed_name in self.exposed_names:
-            self.exposed_event_publisher[exposed_name] = yield self.publish_to(
-                '%s.event' % (exposed_name,))
+        return _gather([
+            self._setup_for_names(
+                self.exposed_publisher, self.exposed_names,
+                lambda name: self.publish_to('%s.inbound' % (name,))),
+            self._setup_for_names(
+                self.exposed_event_publisher, self.exposed_names,
+                lambda name: self.publish_to('%s.event' % (name,))),
+        ])
 
-    @inlineCallbacks
     def setup_exposed_consumers(self):
         self.exposed_consumer = {}
-        for exposed_name in self.exposed_names:
-            self.exposed_consumer[exposed_name] = yield self.consume(
-                '%s.outbound' % (exposed_name,),
-                functools.partial(self.dispatch_outbound_message,
-                                  exposed_name),
+        return self._setup_for_names(
+            self.exposed_consumer, self.exposed_names,
+            lambda name: self.consume(
+                '%s.outbound' % (name,),
+                functools.partial(self.dispatch_outbound_message, name),
                 message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                prefetch_count=self.amqp_prefetch_count))
 
     def dispatch_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_consume("inbound", msg, endpoint)
@@ -129,6 +178,11 @@ class BaseDispatchWorker(Worker):
         d.addCallback(self._router.dispatch_outbound_message)
         return d
 
+    def dispatch_transport_status(self, endpoint, msg):
+        # Middleware doesn't handle status messages, so we skip it here.
+        return maybeDeferred(
+            self._router.dispatch_transport_status, endpoint, msg)
+
     def publish_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_publish("inbound", msg, endpoint)
         d.addCallback(self.exposed_publisher[endpoint].publish_message)
@@ -164,8 +218,14 @@ class BaseDispatchRouter(object):
     If you are subclassing this class, you should not override
     :meth:`__init__`. Custom setup should be done in
     :meth:`setup_routing` instead.
+
+    Routers that need status messages from the transports they route to
+    should set :attr:`consume_transport_status` to ``True`` in
+    :meth:`setup_routing` and implement :meth:`dispatch_transport_status`.
     """
 
+    consume_transport_status = False
+
     def __init__(self, dispatcher, config):
         self.dispatcher = dispatcher
         self.config = config
@@ -212,6 +272,16 @@ class BaseDispatchRouter(object):
         """
         raise NotImplementedError()
 
+    def dispatch_transport_status(self, transport_name, msg):
+        """Handle a status message from a transport.
+
+        :param str transport_name:
+            Name of the transport the status message is from.
+        :param vumi.message.TransportStatus msg:
+            Status message received.
+        """
+        pass
+
 
 class SimpleDispatchRouter(BaseDispatchRouter):
     """Simple dispatch router that maps transports to apps.
@@ -490,6 +560,7 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.routing_table = self.compile_routing_table(self.rules)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
@@ -524,16 +595,51 @@ class ContentKeywordRouter(SimpleDispatchRouter):
                     (not 'prefix' in rule) or
                     (msg['from_addr'].startswith(rule['prefix']))])
 
+    def compile_routing_table(self, rules):
+        """
+        Build a lookup table for `rules` so that finding the rules that match
+        a message doesn't require checking every rule.
+
+        The table maps each keyword to a dict mapping `to_addr` values
+        (``None`` for rules without a `to_addr`) to a dict mapping `from_addr`
+        prefixes (``''`` for rules without a `prefix`) to a list of
+        ``(rule_index, app)`` pairs.
+        """
+        table = {}
+        for index, rule in enumerate(rules):
+            to_addrs = table.setdefault(rule['keyword'], {})
+            prefixes = to_addrs.setdefault(rule.get('to_addr'), {})
+            prefixes.setdefault(rule.get('prefix', ''), []).append(
+                (index, rule['app']))
+        return table
+
+    def get_matching_apps(self, keyword, msg):
+        """
+        Return the apps for all the rules that match `keyword` and `msg`, in
+        the order the rules were defined.
+        """
+        to_addrs = self.routing_table.get(keyword)
+        if not to_addrs:
+            return []
+        from_addr = msg['from_addr'] or ''
+        matches = []
+        for to_addr in set([None, msg['to_addr']]):
+            prefixes = to_addrs.get(to_addr)
+            if not prefixes:
+                continue
+            for i in xrange(len(from_addr) + 1):
+                matches.extend(prefixes.get(from_addr[:i], ()))
+        matches.sort()
+        return [app for _, app in matches]
+
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
-        matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
-        if not matched:
+        apps = self.get_matching_apps(keyword, msg)
+        for app in apps:
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(app, msg.copy())
+        if not apps:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
             else:
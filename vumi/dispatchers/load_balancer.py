@@ -1,16 +1,170 @@
 # -*- test-case-name: vumi.dispatchers.tests.test_load_balancer -*-
 
-"""Router for round-robin load balancing between two transports."""
+"""Router for load balancing between transports."""
 
 import itertools
+from collections import OrderedDict
+
+from twisted.internet import reactor
 
 from vumi import log
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import BaseDispatchRouter
+from vumi.utils import load_class_by_string
+
+
+class RoundRobinStrategy(object):
+    """Balancing strategy that sends messages to each transport in turn.
+
+    Balancing strategies choose the transport for each outbound message that
+    isn't routed by reply affinity. They are given the router they are part
+    of and the router configuration, and may override :meth:`message_sent`
+    and :meth:`event_received` to track the messages flowing through each
+    transport.
+    """
+
+    def __init__(self, router, config):
+        self.router = router
+        self.config = config
+        self.transport_names = router.dispatcher.transport_names
+        self.transport_name_cycle = itertools.cycle(self.transport_names)
+
+    def choose_transport(self, available):
+        """Choose the transport to send the next outbound message to.
+
+        :param set available:
+            The names of the transports that may be chosen. This is never
+            empty.
+        """
+        for transport_name in self.transport_name_cycle:
+            if transport_name in available:
+                return transport_name
+
+    def message_sent(self, transport_name, msg):
+        """Called when an outbound message is sent to a transport."""
+        pass
+
+    def event_received(self, transport_name, event):
+        """Called when an event is received from a transport."""
+        pass
+
+
+class WeightedStrategy(RoundRobinStrategy):
+    """Balancing strategy that sends messages to transports in proportion to
+    their configured weights.
+
+    Configuration options:
+
+    :param dict transport_weights:
+        Mapping from transport name to a positive integer weight.
+        Transports without a weight get a weight of 1.
+    """
+
+    def __init__(self, router, config):
+        super(WeightedStrategy, self).__init__(router, config)
+        weights = config.get('transport_weights', {})
+        self.weights = dict(
+            (name, int(weights.get(name, 1)))
+            for name in self.transport_names)
+        if any(weight < 1 for weight in self.weights.values()):
+            raise ConfigError(
+                "Transport weights for %s must be positive integers." % (
+                    type(router).__name__,))
+        self.current_weights = dict.fromkeys(self.transport_names, 0)
+
+    def choose_transport(self, available):
+        # This is the "smooth" weighted round-robin used by nginx. It spreads
+        # each transport's messages out instead of sending them in bursts.
+        total = 0
+        chosen = None
+        for transport_name in self.transport_names:
+            if transport_name not in available:
+                continue
+            weight = self.weights[transport_name]
+            self.current_weights[transport_name] += weight
+            total += weight
+            if (chosen is None or self.current_weights[transport_name] >
+                    self.current_weights[chosen]):
+                chosen = transport_name
+        self.current_weights[chosen] -= total
+        return chosen
+
+
+class LeastOutstandingStrategy(RoundRobinStrategy):
+    """Balancing strategy that sends messages to the transport with the fewest
+    messages that haven't been acked or nacked yet.
+
+    Ties are broken by round-robin.
+
+    Messages that are never acked or nacked stop counting as outstanding
+    after a timeout, and the oldest messages stop counting if too many are
+    outstanding, so that lost events don't skew the balancing forever.
+
+    Configuration options:
+
+    :param float outstanding_timeout:
+        Number of seconds after which a message stops counting as
+        outstanding. Default: 300.
+    :param int max_outstanding_messages:
+        Maximum number of outstanding messages to keep track of across all
+        transports. Default: 100000.
+    """
+
+    def __init__(self, router, config):
+        super(LeastOutstandingStrategy, self).__init__(router, config)
+        self.outstanding_timeout = float(
+            config.get('outstanding_timeout', 300))
+        self.max_outstanding_messages = int(
+            config.get('max_outstanding_messages', 100000))
+        if self.outstanding_timeout <= 0 or self.max_outstanding_messages < 1:
+            raise ConfigError(
+                "Outstanding message limits for %s must be positive." % (
+                    type(router).__name__,))
+        self.clock = reactor
+        self.outstanding = dict.fromkeys(self.transport_names, 0)
+        # message_id -> (transport_name, time sent), oldest first.
+        self.outstanding_messages = OrderedDict()
+
+    def expire_outstanding_messages(self):
+        """Stop counting messages that have been outstanding for too long, or
+        the oldest messages if there are too many."""
+        expire_before = self.clock.seconds() - self.outstanding_timeout
+        while self.outstanding_messages:
+            message_id = next(iter(self.outstanding_messages))
+            transport_name, sent_at = self.outstanding_messages[message_id]
+            if (sent_at > expire_before and len(self.outstanding_messages) <=
+                    self.max_outstanding_messages):
+                break
+            del self.outstanding_messages[message_id]
+            self.outstanding[transport_name] -= 1
+
+    def choose_transport(self, available):
+        self.expire_outstanding_messages()
+        least = min(self.outstanding[name] for name in available)
+        return super(LeastOutstandingStrategy, self).choose_transport(set(
+            name for name in available if self.outstanding[name] == least))
+
+    def message_sent(self, transport_name, msg):
+        if transport_name not in self.outstanding:
+            return
+        entry = self.outstanding_messages.pop(msg['message_id'], None)
+        if entry is not None:
+            self.outstanding[entry[0]] -= 1
+        self.outstanding_messages[msg['message_id']] = (
+            transport_name, self.clock.seconds())
+        self.outstanding[transport_name] += 1
+        self.expire_outstanding_messages()
+
+    def event_received(self, transport_name, event):
+        if event['event_type'] not in ('ack', 'nack'):
+            return
+        entry = self.outstanding_messages.pop(event['user_message_id'], None)
+        if entry is not None:
+            self.outstanding[entry[0]] -= 1
 
 
 class LoadBalancingRouter(BaseDispatchRouter):
-    """Router that does round-robin dispatching to transports.
+    """Router that balances outbound messages across transports.
 
     Supports only one exposed name and requires at least one transport
     name.
@@ -19,13 +173,28 @@ class LoadBalancingRouter(BaseDispatchRouter):
 
     :param bool reply_affinity:
         If set to true, replies are sent back to the same transport
-        they were sent from. If false, replies are round-robinned in
+        they were sent from. If false, replies are load balanced in
         the same way other outbound messages are. Default: true.
     :param bool rewrite_transport_name:
         If set to true, rewrites message `transport_names` in both
         directions. Default: true.
+    :param str strategy_class:
+        Full dotted name of the balancing strategy class to use. The
+        strategies provided are
+        :class:`~vumi.dispatchers.load_balancer.RoundRobinStrategy`,
+        :class:`~vumi.dispatchers.load_balancer.WeightedStrategy` and
+        :class:`~vumi.dispatchers.load_balancer.LeastOutstandingStrategy`.
+        Default: round-robin.
+    :param bool skip_unavailable_transports:
+        If set to true, the router consumes the status messages published by
+        the transports and doesn't send messages to transports whose last
+        status was `degraded` (e.g. throttled) or `down` while any other
+        transport is available. Default: false.
     """
 
+    DEFAULT_STRATEGY_CLASS = (
+        'vumi.dispatchers.load_balancer.RoundRobinStrategy')
+
     def setup_routing(self):
         self.reply_affinity = self.config.get('reply_affinity', True)
         self.rewrite_transport_names = self.config.get(
@@ -37,9 +206,13 @@ class LoadBalancingRouter(BaseDispatchRouter):
         if not self.dispatcher.transport_names:
             raise ConfigError("At least one transport name is needed for %s" %
                               (type(self).__name__,))
-        self.transport_name_cycle = itertools.cycle(
-            self.dispatcher.transport_names)
         self.transport_name_set = set(self.dispatcher.transport_names)
+        self.unavailable_transport_names = set()
+        self.consume_transport_status = self.config.get(
+            'skip_unavailable_transports', False)
+        strategy_cls = load_class_by_string(self.config.get(
+            'strategy_class', self.DEFAULT_STRATEGY_CLASS))
+        self.strategy = strategy_cls(self, self.config)
 
     def push_transport_name(self, msg, transport_name):
         hm = msg['helper_metadata']
@@ -55,6 +228,13 @@ class LoadBalancingRouter(BaseDispatchRouter):
             return None
         return transport_names.pop()
 
+    def choose_transport_name(self):
+        available = self.transport_name_set - self.unavailable_transport_names
+        if not available:
+            # Sending somewhere is better than sending nowhere.
+            available = self.transport_name_set
+        return self.strategy.choose_transport(available)
+
     def dispatch_inbound_message(self, msg):
         if self.reply_affinity:
             # TODO: we should really be pushing the endpoint name
@@ -65,6 +245,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
 
     def dispatch_inbound_event(self, msg):
+        self.strategy.event_received(msg['transport_name'], msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
@@ -77,9 +258,18 @@ class LoadBalancingRouter(BaseDispatchRouter):
                             " reply for unknown load balancer endpoint %r was"
                             " was received. Using round-robin routing instead."
                             % (transport_name,))
-                transport_name = self.transport_name_cycle.next()
+                transport_name = self.choose_transport_name()
         else:
-            transport_name = self.transport_name_cycle.next()
+            transport_name = self.choose_transport_name()
+        self.strategy.message_sent(transport_name, msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = transport_name
         self.dispatcher.publish_outbound_message(transport_name, msg)
+
+    def dispatch_transport_status(self, transport_name, msg):
+        if transport_name not in self.transport_name_set:
+            return
+        if msg['status'] == 'ok':
+            self.unavailable_transport_names.discard(transport_name)
+        else:
+            self.unavailable_transport_names.add(transport_name)
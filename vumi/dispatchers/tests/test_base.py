@@ -1,19 +1,31 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, SimpleDispatchRouter, ToAddrRouter,
+    FromAddrMultiplexRouter)
 from vumi.dispatchers.tests.helpers import DispatcherHelper, DummyDispatcher
 from vumi.errors import DispatcherError
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
 
+class StatusRecordingRouter(SimpleDispatchRouter):
+
+    consume_transport_status = True
+
+    def setup_routing(self):
+        self.statuses = []
+
+    def dispatch_transport_status(self, transport_name, msg):
+        self.statuses.append((transport_name, msg))
+
+
 class TestBaseDispatchWorker(VumiTestCase):
     def setUp(self):
         self.disp_helper = self.add_helper(
             DispatcherHelper(BaseDispatchWorker))
 
-    def get_dispatcher(self, **config_extras):
+    def get_dispatcher(self, start=True, **config_extras):
         config = {
             "transport_names": [
                 "transport1",
@@ -37,7 +49,7 @@ class TestBaseDispatchWorker(VumiTestCase):
                 ],
             }
         config.update(config_extras)
-        return self.disp_helper.get_dispatcher(config)
+        return self.disp_helper.get_dispatcher(config, start=start)
 
     def ch(self, connector_name):
         return self.disp_helper.get_connector_helper(connector_name)
@@ -209,6 +221,42 @@ class TestBaseDispatchWorker(VumiTestCase):
         self.assert_outbound('transport2', app_msg_pairs)
         self.assert_no_outbound('transport1', 'transport3', 'upstream1')
 
+    @inlineCallbacks
+    def test_transport_status_not_consumed_by_default(self):
+        dispatcher = yield self.get_dispatcher()
+        self.assertEqual(dispatcher.transport_status_consumer, {})
+
+    @inlineCallbacks
+    def test_transport_status_routing(self):
+        dispatcher = yield self.get_dispatcher(router_class=(
+            'vumi.dispatchers.tests.test_base.StatusRecordingRouter'))
+        self.assertEqual(
+            sorted(dispatcher.transport_status_consumer.keys()),
+            ['transport1', 'transport2', 'transport3'])
+
+        msg = self.disp_helper.make_status(
+            status='degraded', component='foo', type='throttled',
+            message='Throttled')
+        yield self.disp_helper.dispatch_raw('transport2.status.status', msg)
+        self.assertEqual(dispatcher._router.statuses, [('transport2', msg)])
+
+    @inlineCallbacks
+    def test_setup_failure(self):
+        dispatcher = yield self.get_dispatcher(start=False)
+        orig_consume = dispatcher.consume
+
+        def consume(routing_key, *args, **kw):
+            if routing_key in ('transport2.inbound', 'app3.outbound'):
+                raise DispatcherError("Can't consume %s" % (routing_key,))
+            return orig_consume(routing_key, *args, **kw)
+
+        dispatcher.consume = consume
+        # The first error is raised as it is, and the others are consumed
+        # instead of being logged as unhandled.
+        err = yield self.assertFailure(
+            dispatcher.startWorker(), DispatcherError)
+        self.assertTrue(str(err).startswith("Can't consume "))
+
     def get_dispatcher_consumers(self, dispatcher):
         return (dispatcher.transport_consumer.values() +
                 dispatcher.transport_event_consumer.values() +
@@ -534,6 +582,64 @@ class TestContentKeywordRouter(VumiTestCase):
             'keyword1 rest of msg', to_addr='8181', from_addr='+256788601462')
         self.assert_dispatched('app1', [msg])
 
+    @inlineCallbacks
+    def test_inbound_message_routing_to_addr_and_prefix_mismatch(self):
+        msg1 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8182', from_addr='+256788601462')
+        msg2 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+255788601462')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app3', [msg1, msg2])
+        self.assert_dispatched('fallback_app', [])
+
+    def test_compile_routing_table(self):
+        self.assertEqual(self.router.compile_routing_table([
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '123',
+             'prefix': '+27'},
+            {'app': 'app2', 'keyword': 'foo'},
+            {'app': 'app3', 'keyword': 'bar', 'prefix': '+27'},
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '123'},
+        ]), {
+            'foo': {
+                '123': {'+27': [(0, 'app1')], '': [(3, 'app1')]},
+                None: {'': [(1, 'app2')]},
+            },
+            'bar': {None: {'+27': [(2, 'app3')]}},
+        })
+
+    def test_get_matching_apps_in_rule_order(self):
+        self.router.routing_table = self.router.compile_routing_table([
+            {'app': 'app1', 'keyword': 'foo', 'prefix': '+2782'},
+            {'app': 'app2', 'keyword': 'foo', 'to_addr': '123'},
+            {'app': 'app3', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app4', 'keyword': 'foo', 'prefix': '+2783'},
+            {'app': 'app5', 'keyword': 'foo'},
+        ])
+        msg = self.disp_helper.make_inbound(
+            'foo', to_addr='123', from_addr='+27821234567')
+        self.assertEqual(
+            self.router.get_matching_apps('foo', msg),
+            ['app1', 'app2', 'app3', 'app5'])
+        self.assertEqual(self.router.get_matching_apps('bar', msg), [])
+
+    @inlineCallbacks
+    def test_inbound_message_routing_many_rules(self):
+        self.router.rules = [
+            {'app': 'app%d' % (i % 3 + 1), 'keyword': 'keyword%d' % i,
+             'to_addr': '8181', 'prefix': '+256'}
+            for i in range(10000)]
+        self.router.routing_table = self.router.compile_routing_table(
+            self.router.rules)
+        msg1 = yield self.send_inbound(
+            'KEYWORD1234 rest of msg', to_addr='8181', from_addr='+2567886')
+        msg2 = yield self.send_inbound(
+            'KEYWORD9999 rest of msg', to_addr='8181', from_addr='+2567886')
+        msg3 = yield self.send_inbound(
+            'KEYWORD10000 rest of msg', to_addr='8181', from_addr='+2567886')
+        self.assert_dispatched('app2', [msg1])
+        self.assert_dispatched('app1', [msg2])
+        self.assert_dispatched('fallback_app', [msg3])
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         yield self.router.session_manager.create_session(
@@ -1,6 +1,7 @@
 """Tests for vumi.dispatchers.load_balancer."""
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from vumi.dispatchers.load_balancer import LoadBalancingRouter
 from vumi.dispatchers.tests.helpers import DummyDispatcher
@@ -12,6 +13,7 @@ class BaseLoadBalancingTestCase(VumiTestCase):
 
     reply_affinity = None
     rewrite_transport_names = None
+    extra_config = {}
 
     @inlineCallbacks
     def setUp(self):
@@ -28,6 +30,7 @@ class BaseLoadBalancingTestCase(VumiTestCase):
             config['reply_affinity'] = self.reply_affinity
         if self.rewrite_transport_names is not None:
             config['rewrite_transport_names'] = self.rewrite_transport_names
+        config.update(self.extra_config)
         self.dispatcher = DummyDispatcher(config)
         self.router = LoadBalancingRouter(self.dispatcher, config)
         self.add_cleanup(self.router.teardown_routing)
@@ -167,3 +170,153 @@ class TestLoadBalancingWithoutRewriteTransportNames(BaseLoadBalancingTestCase):
         self.router.dispatch_outbound_message(msg1)
         [new_msg] = self.dispatcher.transport_publisher['transport_1'].msgs
         self.assertEqual(new_msg['transport_name'], 'round_robin')
+
+
+class TestLoadBalancingWithWeightedStrategy(BaseLoadBalancingTestCase):
+
+    reply_affinity = False
+    extra_config = {
+        "strategy_class": (
+            "vumi.dispatchers.load_balancer.WeightedStrategy"),
+        "transport_weights": {"transport_1": 3},
+    }
+
+    def test_outbound_message_routing(self):
+        msgs = [self.msg_helper.make_outbound('msg %d' % i) for i in range(8)]
+        for msg in msgs:
+            self.router.dispatch_outbound_message(msg)
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(
+            publishers['transport_1'].msgs,
+            [msgs[0], msgs[1], msgs[3], msgs[4], msgs[5], msgs[7]])
+        self.assertEqual(publishers['transport_2'].msgs, [msgs[2], msgs[6]])
+
+
+class TestLoadBalancingWithLeastOutstandingStrategy(
+        BaseLoadBalancingTestCase):
+
+    reply_affinity = False
+    extra_config = {
+        "strategy_class": (
+            "vumi.dispatchers.load_balancer.LeastOutstandingStrategy"),
+    }
+
+    def send_outbound(self, content):
+        msg = self.msg_helper.make_outbound(content)
+        self.router.dispatch_outbound_message(msg)
+        return msg
+
+    def test_outbound_message_routing(self):
+        msg1 = self.send_outbound('msg 1')
+        msg2 = self.send_outbound('msg 2')
+        # transport_2 acks its message, so it has fewer outstanding messages.
+        self.router.dispatch_inbound_event(self.msg_helper.make_ack(
+            msg2, transport_name='transport_2'))
+        msg3 = self.send_outbound('msg 3')
+        msg4 = self.send_outbound('msg 4')
+        # Delivery reports don't count.
+        self.router.dispatch_inbound_event(
+            self.msg_helper.make_delivery_report(
+                msg1, transport_name='transport_1'))
+        # transport_1 nacks both its messages.
+        self.router.dispatch_inbound_event(self.msg_helper.make_nack(
+            msg1, transport_name='transport_1'))
+        self.router.dispatch_inbound_event(self.msg_helper.make_nack(
+            msg4, transport_name='transport_1'))
+        msg5 = self.send_outbound('msg 5')
+
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(publishers['transport_1'].msgs, [msg1, msg4, msg5])
+        self.assertEqual(publishers['transport_2'].msgs, [msg2, msg3])
+        self.assertEqual(self.router.strategy.outstanding, {
+            'transport_1': 1,
+            'transport_2': 1,
+        })
+
+    def test_outstanding_messages_expire(self):
+        clock = self.router.strategy.clock = Clock()
+        msg1 = self.send_outbound('msg 1')
+        clock.advance(200)
+        self.send_outbound('msg 2')
+        self.send_outbound('msg 3')
+        self.assertEqual(self.router.strategy.outstanding, {
+            'transport_1': 2,
+            'transport_2': 1,
+        })
+        # msg 1 is never acked, so it stops counting after the timeout.
+        clock.advance(100)
+        self.send_outbound('msg 4')
+        self.assertEqual(self.router.strategy.outstanding, {
+            'transport_1': 1,
+            'transport_2': 2,
+        })
+        self.assertEqual(len(self.router.strategy.outstanding_messages), 3)
+        # A late ack for an expired message is ignored.
+        self.router.dispatch_inbound_event(self.msg_helper.make_ack(
+            msg1, transport_name='transport_1'))
+        self.assertEqual(self.router.strategy.outstanding, {
+            'transport_1': 1,
+            'transport_2': 2,
+        })
+
+    def test_max_outstanding_messages(self):
+        self.router.strategy.max_outstanding_messages = 3
+        msgs = [self.send_outbound('msg %d' % i) for i in range(5)]
+        self.assertEqual(
+            self.router.strategy.outstanding_messages.keys(),
+            [msg['message_id'] for msg in msgs[2:]])
+        self.assertEqual(self.router.strategy.outstanding, {
+            'transport_1': 2,
+            'transport_2': 1,
+        })
+
+
+class TestLoadBalancingWithSkipUnavailableTransports(
+        BaseLoadBalancingTestCase):
+
+    reply_affinity = False
+    extra_config = {
+        "skip_unavailable_transports": True,
+    }
+
+    def send_outbound(self, content):
+        msg = self.msg_helper.make_outbound(content)
+        self.router.dispatch_outbound_message(msg)
+        return msg
+
+    def send_status(self, transport_name, status, status_type):
+        self.router.dispatch_transport_status(
+            transport_name, self.msg_helper.make_status(
+                status=status, component='smpp', type=status_type,
+                message='status'))
+
+    def test_consume_transport_status(self):
+        self.assertTrue(self.router.consume_transport_status)
+
+    def test_outbound_message_routing(self):
+        msg1 = self.send_outbound('msg 1')
+        self.send_status('transport_2', 'degraded', 'throttled')
+        msg2 = self.send_outbound('msg 2')
+        msg3 = self.send_outbound('msg 3')
+        self.send_status('transport_2', 'ok', 'throttled_end')
+        msg4 = self.send_outbound('msg 4')
+        msg5 = self.send_outbound('msg 5')
+
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(
+            publishers['transport_1'].msgs, [msg1, msg2, msg3, msg5])
+        self.assertEqual(publishers['transport_2'].msgs, [msg4])
+
+    def test_outbound_message_routing_all_unavailable(self):
+        self.send_status('transport_1', 'down', 'connection_lost')
+        self.send_status('transport_2', 'degraded', 'throttled')
+        msg1 = self.send_outbound('msg 1')
+        msg2 = self.send_outbound('msg 2')
+
+        publishers = self.dispatcher.transport_publisher
+        self.assertEqual(publishers['transport_1'].msgs, [msg1])
+        self.assertEqual(publishers['transport_2'].msgs, [msg2])
+
+    def test_status_for_unknown_transport(self):
+        self.send_status('transport_unknown', 'down', 'connection_lost')
+        self.assertEqual(self.router.unavailable_transport_names, set())
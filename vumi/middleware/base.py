@@ -1,7 +1,8 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 from confmodel import Config
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -184,6 +185,10 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    Most middleware handlers are synchronous, so handlers are called directly
+    and their results passed straight on to the next middleware. The rest of
+    the stack is only chained onto a Deferred once a handler returns one.
     """
 
     def __init__(self, middlewares):
@@ -191,6 +196,7 @@ class MiddlewareStack(object):
             middlewares, 'consume_priority')
         self.publish_middlewares = self._sort_by_priority(
             reversed(middlewares), 'publish_priority')
+        self._handlers = {}
 
     @staticmethod
     def _sort_by_priority(middlewares, priority_key):
@@ -198,17 +204,45 @@ class MiddlewareStack(object):
         # order within priority levels.
         return sorted(middlewares, key=lambda mw: getattr(mw, priority_key))
 
-    @inlineCallbacks
+    def _get_handlers(self, middlewares, handler_name):
+        # The handler methods are looked up once per handler name rather than
+        # once per message.
+        handlers = self._handlers.get(handler_name)
+        if handlers is None:
+            method_name = 'handle_%s' % (handler_name,)
+            handlers = self._handlers[handler_name] = [
+                (middleware, method_name, getattr(middleware, method_name))
+                for middleware in middlewares]
+        return handlers
+
     def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+        try:
+            handlers = self._get_handlers(middlewares, handler_name)
+            return self._process(handlers, 0, message, connector_name)
+        except Exception:
+            return fail()
+
+    def _process(self, handlers, index, message, connector_name):
+        while index < len(handlers):
+            middleware, method_name, handler = handlers[index]
+            index += 1
+            message = handler(message, connector_name)
+            if isinstance(message, Deferred):
+                return message.addCallback(
+                    self._continue, handlers, index, connector_name)
+            self._check_message(message, middleware, method_name)
+        return succeed(message)
+
+    def _continue(self, message, handlers, index, connector_name):
+        middleware, method_name, _ = handlers[index - 1]
+        self._check_message(message, middleware, method_name)
+        return self._process(handlers, index, message, connector_name)
+
+    def _check_message(self, message, middleware, method_name):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.%s should never be None' % (
+                    middleware, method_name,))
 
     def apply_consume(self, handler_name, message, connector_name):
         handler_name = 'consume_%s' % (handler_name,)
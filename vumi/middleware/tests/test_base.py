@@ -2,11 +2,13 @@ import yaml
 import itertools
 
 from confmodel.fields import ConfigInt
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
 
 from vumi.middleware.base import (
-    BaseMiddleware, MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config, BaseMiddlewareConfig)
+    BaseMiddleware, MiddlewareStack, MiddlewareError,
+    create_middlewares_from_config, setup_middlewares_from_config,
+    BaseMiddlewareConfig)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -81,6 +83,22 @@ class ToyAsymmetricMiddleware(ToyMiddleware):
         return self._handle('publish_failure', message, connector_name)
 
 
+class ToyAsyncMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        d = Deferred()
+        d.addCallback(super(ToyAsyncMiddleware, self)._handle, message,
+                      connector_name)
+        self.worker.pending.append(d)
+        return d
+
+
+class ToyNoneMiddleware(ToyMiddleware):
+
+    def _handle(self, direction, message, connector_name):
+        return None
+
+
 class TestMiddlewareStack(VumiTestCase):
 
     @inlineCallbacks
@@ -91,6 +109,7 @@ class TestMiddlewareStack(VumiTestCase):
                 (yield self.mkmiddleware('mw3', ToyMiddleware)),
                 ])
         self.processed_messages = []
+        self.pending = []
 
     @inlineCallbacks
     def mkmiddleware(self, name, mw_class):
@@ -176,6 +195,56 @@ class TestMiddlewareStack(VumiTestCase):
                 ('mw1', 'event', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    def test_apply_synchronous_middleware(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_asynchronous_middleware(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyAsyncMiddleware)),
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+        ])
+        [pending] = self.pending
+        pending.callback('inbound')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+        self.assert_processed([
+            ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+            ('mw2', 'inbound', 'dummy_msg.mw1.mw2', 'end_foo'),
+            ('mw3', 'inbound', 'dummy_msg.mw1.mw2.mw3', 'end_foo'),
+        ])
+
+    @inlineCallbacks
+    def test_apply_middleware_returning_none(self):
+        self.stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyNoneMiddleware)),
+        ])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, MiddlewareError)
+
+    @inlineCallbacks
+    def test_apply_async_middleware_returning_none(self):
+        mw = yield self.mkmiddleware('mw1', ToyMiddleware)
+        mw.handle_inbound = lambda message, connector_name: succeed(None)
+        self.stack = MiddlewareStack([mw])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, MiddlewareError)
+
+    @inlineCallbacks
+    def test_apply_middleware_raising_exception(self):
+        mw = yield self.mkmiddleware('mw1', ToyMiddleware)
+        mw.handle_inbound = lambda message, connector_name: 1 / 0
+        self.stack = MiddlewareStack([mw])
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, ZeroDivisionError)
+
     @inlineCallbacks
     def test_teardown_in_reverse_order(self):
 
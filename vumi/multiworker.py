@@ -2,7 +2,7 @@
 
 from copy import deepcopy
 
-from vumi.service import Worker, WorkerCreator
+from vumi.service import Worker, WorkerCreator, LocalMessageBus
 
 
 class MultiWorker(Worker):
@@ -16,6 +16,16 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type local_delivery: bool
+    :param local_delivery:
+        If ``True``, messages published by one child worker to a queue
+        consumed by another are handed over in memory instead of going
+        through the AMQP broker. See :class:`vumi.service.LocalMessageBus`.
+        Defaults to ``False``.
+    :type local_queue_size: int
+    :param local_queue_size:
+        Maximum number of messages waiting for each local consumer before
+        messages are sent over AMQP instead. Defaults to ``100``.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
@@ -46,6 +56,10 @@ class MultiWorker(Worker):
     def startService(self):
         super(MultiWorker, self).startService()
         self.workers = []
+        self.local_message_bus = None
+        if self.config.get('local_delivery', False):
+            self.local_message_bus = LocalMessageBus(
+                self.config.get('local_queue_size', 100))
         self.worker_creator = self.WORKER_CREATOR(self.options)
         for wname, wclass in self.config.get('workers', {}).items():
             worker = self.create_worker(wname, wclass)
@@ -1,9 +1,11 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
+from collections import Counter
 import fnmatch
 from functools import wraps
 from itertools import takewhile, dropwhile
 import os
+import time
 from zlib import crc32
 
 from hyperloglog import HyperLogLog
@@ -40,21 +42,58 @@ class FakeRedis(object):
     It's intended to match the Python redis module API closely so that
     it can be used in place of the redis module when testing.
 
+    Every call made to the fake counts as a round trip to the server, and a
+    pipeline counts as a single round trip however many commands it holds.
+    :attr:`round_trips` and :attr:`command_counts` keep track of these until
+    :meth:`reset_counts` is called, so tests can check how chatty a component
+    is.
+
+    :param float latency:
+        Seconds to wait before returning the result of each round trip. In
+        async mode this replaces the small default delay. In sync mode the
+        call blocks, as it would with a real server. Defaults to ``None``.
+
     Known limitations:
 
     * Exceptions raised are not guaranteed to match the exception
       types raised by the real Python redis module.
     """
 
-    def __init__(self, charset='utf-8', errors='strict', async=False):
+    def __init__(self, charset='utf-8', errors='strict', async=False,
+                 latency=None):
         self._data = {}
         self._known_key_existence = {}
         self._expiries = {}
         self._is_async = async
+        self.latency = latency
         self.clock = Clock()
         self._charset = charset
         self._charset_errors = errors
         self._delayed_calls = []
+        self.reset_counts()
+
+    def reset_counts(self):
+        """
+        Reset the round trip and command counts.
+        """
+        self.round_trips = 0
+        self.command_counts = Counter()
+
+    @property
+    def commands(self):
+        """
+        The number of commands run since the counts were last reset,
+        including each command in a pipeline.
+        """
+        return sum(self.command_counts.itervalues())
+
+    def _count_round_trip(self, func, args):
+        self.round_trips += 1
+        if func is FakeRedis._execute_pipeline.sync:
+            [calls] = args
+            self.command_counts.update(f.__name__ for f, _, _ in calls)
+        else:
+            self.command_counts[func.__name__] += 1
 
     def teardown(self):
         self._clean_up_expires()
@@ -88,17 +127,21 @@ class FakeRedis(object):
         some real delay to catch code that doesn't properly wait for the
         deferred to fire.
         """
+        self._count_round_trip(func, args)
         self.clock.advance(0.1)
         if self._is_async:
             # Add some latency to catch things that don't wait on deferreds. We
             # can't use deferLater() here because we want to keep track of the
             # delayed call object.
+            wait = FAKE_REDIS_WAIT if self.latency is None else self.latency
             d = Deferred()
             delayed = reactor.callLater(
-                FAKE_REDIS_WAIT, call_to_deferred, d, func, self, *args, **kw)
+                wait, call_to_deferred, d, func, self, *args, **kw)
             self._delayed_calls.append(delayed)
             return d
         else:
+            if self.latency:
+                time.sleep(self.latency)
             return func(self, *args, **kw)
 
     def _set_key(self, key, value):
@@ -144,6 +187,10 @@ class FakeRedis(object):
     def keys(self, pattern='*'):
         return fnmatch.filter(self._data.keys(), pattern)
 
+    @maybe_async
+    def dbsize(self):
+        return len(self._data)
+
     @maybe_async
     def scan(self, cursor, match=None, count=None):
         if cursor is None:
@@ -181,6 +228,28 @@ class FakeRedis(object):
 
         return [cursor, fnmatch.filter(output, match)]
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self)
+
+    @maybe_async
+    def _execute_pipeline(self, calls, raise_on_error=True):
+        """
+        Run all the calls queued in a pipeline as a single operation. As with
+        real Redis, every call is run even if an earlier one fails and the
+        first error is raised afterwards unless ``raise_on_error`` is false.
+        """
+        results = []
+        error = None
+        for func, args, kw in calls:
+            try:
+                results.append(func(self, *args, **kw))
+            except ResponseError as e:
+                results.append(e)
+                error = error or e
+        if error is not None and raise_on_error:
+            raise error
+        return results
+
     @maybe_async
     def flushdb(self):
         self._data = {}
@@ -238,7 +307,10 @@ class FakeRedis(object):
         old_value = self._data.get(key)
         if old_value is None:
             old_value = 0
-        new_value = int(old_value) + amount
+        try:
+            new_value = int(old_value) + amount
+        except ValueError:
+            raise ResponseError("value is not an integer or out of range")
         self.set.sync(self, key, new_value)
         return new_value
 
@@ -247,7 +319,10 @@ class FakeRedis(object):
         old_value = self._data.get(key)
         if old_value is None:
             old_value = 0
-        new_value = int(old_value) - amount
+        try:
+            new_value = int(old_value) - amount
+        except ValueError:
+            raise ResponseError("value is not an integer or out of range")
         self.set.sync(self, key, new_value)
         return new_value
 
@@ -425,6 +500,11 @@ class FakeRedis(object):
         zval = self._setdefault_key(key, Zset())
         return zval.zremrangebyrank(start, stop)
 
+    @maybe_async
+    def zremrangebyscore(self, key, min, max):
+        zval = self._setdefault_key(key, Zset())
+        return zval.zremrangebyscore(min, max)
+
     # List operations
     @maybe_async
     def llen(self, key):
@@ -540,6 +620,32 @@ class FakeRedis(object):
         return len(hll)
 
 
+class FakePipeline(object):
+    """
+    A pipeline for :class:`FakeRedis`.
+
+    Calls are queued and then run together as a single fake redis operation
+    when :meth:`execute` is called.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        func = getattr(type(self._fake_redis), name).sync
+
+        def queue_call(*args, **kw):
+            self._calls.append((func, args, kw))
+            return self
+        return queue_call
+
+    def execute(self, raise_on_error=True):
+        calls, self._calls = self._calls, []
+        return self._fake_redis._execute_pipeline(
+            calls, raise_on_error=raise_on_error)
+
+
 class Zset(object):
     """A Redis-like ordered set implementation."""
 
@@ -627,3 +733,8 @@ class Zset(object):
         deleted_keys = self._zval[start:stop]
         del self._zval[start:stop]
         return len(deleted_keys)
+
+    def zremrangebyscore(self, min='-inf', max='+inf'):
+        deleted_keys = set(v for v, k in self.zrangebyscore(min, max))
+        self._zval = [val for val in self._zval if val[1] not in deleted_keys]
+        return len(deleted_keys)
@@ -1,7 +1,8 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
 import os
-from functools import wraps
+from functools import partial, wraps
+from types import MethodType
 
 from vumi.persist.ast_magic import make_function
 from vumi.persist.fake_redis import FakeRedis
@@ -50,6 +51,7 @@ class CallMakerMetaclass(type):
         for name, attr in class_dict.items():
             if isinstance(attr, RedisCall):
                 attr = make_callfunc(name, attr)
+                attr.redis_call = True
 
             new_class_dict[name] = attr
         return type.__new__(meta, classname, bases, new_class_dict)
@@ -60,6 +62,62 @@ class ClientProxy(object):
         self.client = client
 
 
+class Pipeline(object):
+    """
+    A batch of redis calls to be sent to the server together.
+
+    Calls made on a pipeline take the same arguments (and apply the same key
+    prefixing and result filtering) as the equivalent manager methods, but
+    are queued instead of being sent. :meth:`execute` sends all the queued
+    calls in a single round-trip and returns a list of their results in the
+    order the calls were made. For async managers the list is returned via
+    a deferred.
+
+    Pipelines are not transactional. Other clients may run commands between
+    the commands in a pipeline.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    # Manager helpers used by the queued calls to prefix keys and filter
+    # results.
+    _MANAGER_HELPERS = ('_key', '_unkey', '_unkeys', '_unkeys_scan')
+
+    def __getattr__(self, name):
+        if name in self._MANAGER_HELPERS:
+            return getattr(self._manager, name)
+        attr = getattr(type(self._manager), name, None)
+        if not getattr(attr, 'redis_call', False):
+            # Anything else would be run immediately instead of queued.
+            raise AttributeError(
+                "%r can't be called on a pipeline" % (name,))
+        return MethodType(attr.im_func, self)
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append([call, args, kw, None])
+        return self
+
+    def _filter_redis_results(self, func, results):
+        self._calls[-1][3] = func
+        return self
+
+    def execute(self, raise_on_error=True):
+        """
+        Send all queued calls to the server and return their results.
+
+        Every queued call is run even if an earlier one fails. If
+        ``raise_on_error`` is false, errors are returned in place of the
+        results of the calls that failed instead of being raised.
+        """
+        calls, self._calls = self._calls, []
+        return self._manager._execute_pipeline(calls, raise_on_error)
+
+
 class Manager(object):
 
     __metaclass__ = CallMakerMetaclass
@@ -100,8 +158,16 @@ class Manager(object):
             client_proxy=self._client_proxy)
         if isinstance(self._client, FakeRedis):
             sub_man._close = self._client.teardown
+            sub_man.RESPONSE_ERROR = self.RESPONSE_ERROR
         return sub_man
 
+    def pipeline(self):
+        """
+        Return a :class:`Pipeline` for sending a batch of calls to redis in
+        a single round-trip.
+        """
+        return Pipeline(self)
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -202,6 +268,23 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _execute_pipeline(self, calls, raise_on_error=True):
+        """Send a batch of calls queued by a :class:`Pipeline`.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for call, args, kw, _ in calls:
+            getattr(pipe, call)(*args, **kw)
+        return self._filter_redis_results(
+            partial(self._filter_pipeline_results, calls),
+            pipe.execute(raise_on_error=raise_on_error))
+
+    def _filter_pipeline_results(self, calls, results):
+        return [
+            (func(result)
+             if func is not None and not isinstance(result, Exception)
+             else result)
+            for (_, _, _, func), result in zip(calls, results)]
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -229,6 +312,7 @@ class Manager(object):
 
     type = RedisCall(['key'])
     exists = RedisCall(['key'])
+    dbsize = RedisCall([])
     keys = RedisCall(['pattern'], defaults=['*'], key_args=['pattern'],
                      filter_func='_unkeys')
     scan = RedisCall(['cursor', 'match', 'count'],
@@ -287,6 +371,7 @@ class Manager(object):
     zscore = RedisCall(['key', 'value'])
     zcount = RedisCall(['key', 'min', 'max'])
     zremrangebyrank = RedisCall(['key', 'start', 'stop'])
+    zremrangebyscore = RedisCall(['key', 'min', 'max'])
 
     # List operations
 
@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_manager -*-
 
 import redis
+import redis.client
 import redis.exceptions
 
 from vumi.persist.redis_base import Manager
@@ -47,6 +48,24 @@ class VumiRedis(redis.Redis):
             cursor = None
         return (cursor, keys)
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        """
+        Return a pipeline with the same method signatures as this client.
+        """
+        return VumiPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+
+class VumiPipeline(redis.client.BasePipeline, VumiRedis):
+    """
+    Pipeline version of :class:`VumiRedis`.
+
+    .. note::
+
+       ``scan()`` can't be pipelined because it unpacks its response.
+    """
+
 
 class RedisManager(Manager):
 
@@ -5,6 +5,7 @@ import os
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
+from vumi.persist import fake_redis
 from vumi.persist.fake_redis import FakeRedis, ResponseError
 from vumi.tests.helpers import VumiTestCase
 
@@ -107,6 +108,13 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, "value", 'get', "mykey")
         yield self.assert_redis_op(redis, 10, 'ttl', "mykey")
 
+    @inlineCallbacks
+    def test_incr_non_integer(self):
+        redis = yield self.get_redis()
+        yield redis.set("inc", "a")
+        yield self.assert_redis_error(redis, 'incr', "inc")
+        yield self.assert_redis_op(redis, 'a', 'get', "inc")
+
     @inlineCallbacks
     def test_incr_with_by_param(self):
         redis = yield self.get_redis()
@@ -266,6 +274,25 @@ class FakeRedisTestMixin(object):
             redis, [('one', 1), ('two', 2), ('three', 3)],
             'zrange', 'set', 0, -1, withscores=True)
 
+    @inlineCallbacks
+    def test_zremrangebyscore(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=1, two=2, three=3)
+        yield self.assert_redis_op(redis, 2, 'zremrangebyscore', 'set', 1, 2)
+        yield self.assert_redis_op(
+            redis, [('three', 3)], 'zrange', 'set', 0, -1, withscores=True)
+
+    @inlineCallbacks
+    def test_zremrangebyscore_inf(self):
+        redis = yield self.get_redis()
+        yield redis.zadd('set', one=1, two=2, three=3)
+        yield self.assert_redis_op(
+            redis, 2, 'zremrangebyscore', 'set', '-inf', '(3')
+        yield self.assert_redis_op(
+            redis, [('three', 3)], 'zrange', 'set', 0, -1, withscores=True)
+        yield self.assert_redis_op(
+            redis, 0, 'zremrangebyscore', 'set', '-inf', 2)
+
     @inlineCallbacks
     def test_zscore(self):
         redis = yield self.get_redis()
@@ -500,6 +527,16 @@ class FakeRedisTestMixin(object):
         yield redis.hset("hash_key", "a", 1.0)
         yield self.assert_redis_op(redis, 'hash', 'type', 'hash_key')
 
+    @inlineCallbacks
+    def test_dbsize(self):
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(redis, 0, 'dbsize')
+        yield redis.set("string_key", "a")
+        yield redis.sadd("set_key", "a")
+        yield self.assert_redis_op(redis, 2, 'dbsize')
+        yield redis.delete("string_key")
+        yield self.assert_redis_op(redis, 1, 'dbsize')
+
     @inlineCallbacks
     def test_charset_encoding_default(self):
         # Redis client assumes utf-8
@@ -620,6 +657,40 @@ class FakeRedisUnverifiedTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'pfadd', 'hll1', *values)
         yield self.assert_redis_op(redis, 998, 'pfcount', 'hll1')
 
+    @inlineCallbacks
+    def test_round_trip_counts(self):
+        """
+        Real Redis doesn't count round trips for us.
+        """
+        redis = yield self.get_redis()
+        self.assertEqual(redis.round_trips, 0)
+        self.assertEqual(redis.commands, 0)
+        yield redis.set("foo", "1")
+        yield redis.get("foo")
+        yield redis.get("bar")
+        self.assertEqual(redis.round_trips, 3)
+        self.assertEqual(redis.commands, 3)
+        self.assertEqual(redis.command_counts, {"set": 1, "get": 2})
+
+        redis.reset_counts()
+        self.assertEqual(redis.round_trips, 0)
+        self.assertEqual(redis.command_counts, {})
+
+    @inlineCallbacks
+    def test_pipeline_round_trip_counts(self):
+        """
+        Real Redis doesn't count round trips for us.
+        """
+        redis = yield self.get_redis()
+        pipe = redis.pipeline()
+        pipe.set("foo", "1").incr("foo").get("foo")
+        self.assertEqual(redis.round_trips, 0)
+        yield self.assert_redis_op(pipe, [True, 2, "2"], "execute")
+        self.assertEqual(redis.round_trips, 1)
+        self.assertEqual(redis.commands, 3)
+        self.assertEqual(
+            redis.command_counts, {"set": 1, "incr": 1, "get": 1})
+
 
 class TestFakeRedis(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
                     VumiTestCase):
@@ -639,6 +710,14 @@ class TestFakeRedis(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
     def wait(self, redis, delay):
         redis.clock.advance(delay)
 
+    def test_latency(self):
+        redis = self.get_redis(latency=0.05)
+        sleeps = []
+        self.patch(fake_redis.time, "sleep", sleeps.append)
+        redis.set("foo", "1")
+        redis.get("foo")
+        self.assertEqual(sleeps, [0.05, 0.05])
+
 
 class TestFakeRedisAsync(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
                          VumiTestCase):
@@ -659,6 +738,13 @@ class TestFakeRedisAsync(FakeRedisUnverifiedTestMixin, FakeRedisTestMixin,
     def wait(self, redis, delay):
         redis.clock.advance(delay)
 
+    @inlineCallbacks
+    def test_latency(self):
+        redis = self.get_redis(latency=0.05)
+        start = reactor.seconds()
+        yield redis.set("foo", "1")
+        self.assertTrue(reactor.seconds() - start >= 0.05)
+
 
 class RedisPairWrapper(object):
     def __init__(self, test_case, fake_redis, real_redis):
@@ -72,3 +72,54 @@ class TestRedisManager(VumiTestCase):
         self.manager.setex("key-ttl", 30, "value")
         ttl = self.manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
+
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        pipe.set('foo', 'bar')
+        pipe.incr('counter')
+        pipe.get('foo')
+        pipe.keys()
+        self.assertEqual(len(pipe), 4)
+        # Nothing is sent until the pipeline is executed.
+        self.assertEqual([], self.manager.keys())
+
+        results = pipe.execute()
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(results[:3], [True, 1, 'bar'])
+        self.assertEqual(sorted(results[3]), ['counter', 'foo'])
+
+    def test_pipeline_empty(self):
+        self.assertEqual([], self.manager.pipeline().execute())
+
+    def test_pipeline_error(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.hincrby('foo', 'field')
+        pipe.set('baz', 'quux')
+        self.assertRaises(self.manager.RESPONSE_ERROR, pipe.execute)
+        # Calls after the failed one are still run.
+        self.assertEqual('quux', self.manager.get('baz'))
+
+    def test_pipeline_error_not_raised(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.hincrby('foo', 'field')
+        pipe.keys('fo*')
+        [error, keys] = pipe.execute(raise_on_error=False)
+        self.assertTrue(isinstance(error, self.manager.RESPONSE_ERROR))
+        self.assertEqual(['foo'], keys)
+
+    def test_pipeline_only_redis_calls(self):
+        pipe = self.manager.pipeline()
+        self.assertRaises(AttributeError, getattr, pipe, 'sub_manager')
+        self.assertRaises(AttributeError, getattr, pipe, 'get_key_prefix')
+        self.assertRaises(AttributeError, getattr, pipe, 'pipeline')
+
+    def test_pipeline_setex(self):
+        pipe = self.manager.pipeline()
+        pipe.setex('foo', 30, 'bar')
+        pipe.get('foo')
+        pipe.ttl('foo')
+        [_, value, ttl] = pipe.execute()
+        self.assertEqual(value, 'bar')
+        self.assertTrue(10 <= ttl <= 30)
@@ -107,6 +107,59 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_pipeline(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        pipe.set('foo', 'bar')
+        pipe.incr('counter')
+        pipe.get('foo')
+        pipe.keys()
+        self.assertEqual(len(pipe), 4)
+        # Nothing is sent until the pipeline is executed.
+        self.assertEqual([], (yield manager.keys()))
+
+        results = yield pipe.execute()
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(results[:3], [True, 1, 'bar'])
+        self.assertEqual(sorted(results[3]), ['counter', 'foo'])
+        self.assertEqual('redistest:foo', manager._key('foo'))
+
+    @inlineCallbacks
+    def test_pipeline_empty(self):
+        manager = yield self.get_manager()
+        self.assertEqual([], (yield manager.pipeline().execute()))
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        manager = yield self.get_manager()
+        yield manager.set('foo', 'bar')
+        pipe = manager.pipeline()
+        pipe.hincrby('foo', 'field')
+        pipe.set('baz', 'quux')
+        yield self.assertFailure(pipe.execute(), manager.RESPONSE_ERROR)
+        # Calls after the failed one are still run.
+        self.assertEqual('quux', (yield manager.get('baz')))
+
+    @inlineCallbacks
+    def test_pipeline_error_not_raised(self):
+        manager = yield self.get_manager()
+        yield manager.set('foo', 'bar')
+        pipe = manager.pipeline()
+        pipe.hincrby('foo', 'field')
+        pipe.keys('fo*')
+        [error, keys] = yield pipe.execute(raise_on_error=False)
+        self.assertTrue(isinstance(error, manager.RESPONSE_ERROR))
+        self.assertEqual(['foo'], keys)
+
+    @inlineCallbacks
+    def test_pipeline_only_redis_calls(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        self.assertRaises(AttributeError, getattr, pipe, 'sub_manager')
+        self.assertRaises(AttributeError, getattr, pipe, 'get_key_prefix')
+        self.assertRaises(AttributeError, getattr, pipe, 'pipeline')
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
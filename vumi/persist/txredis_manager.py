@@ -13,7 +13,8 @@ except ImportError:
 import txredis.exceptions
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, Deferred, gatherResults, FirstError)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import (
@@ -219,6 +220,52 @@ class VumiRedis(txr.Redis):
         self._send('PFCOUNT', key)
         return self.getResponse()
 
+    def pipeline(self, transaction=False):
+        """
+        Return a pipeline for sending a batch of commands together.
+
+        Only non-transactional pipelines are supported, because the
+        connection may be shared by several managers.
+        """
+        assert not transaction, "Transactional pipelines are not supported."
+        return VumiRedisPipeline(self)
+
+
+class VumiRedisPipeline(object):
+    """
+    A batch of commands to send to the server together.
+
+    txredis writes each command to the connection as soon as it is called
+    and matches responses to commands in order, so sending every command in
+    the batch before waiting for any of the responses gives us a pipeline.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kw):
+            self._calls.append((name, args, kw))
+            return self
+        return queue_call
+
+    def execute(self, raise_on_error=True):
+        calls, self._calls = self._calls, []
+        ds = [getattr(self._client, name)(*args, **kw)
+              for name, args, kw in calls]
+        if not raise_on_error:
+            for call_d in ds:
+                call_d.addErrback(self._response_error)
+        d = gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure if f.check(FirstError)
+                     else f)
+        return d
+
+    def _response_error(self, failure):
+        failure.trap(txredis.exceptions.ResponseError)
+        return failure.value
+
 
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
@@ -7,6 +7,7 @@ import re
 import time
 import calendar
 import copy
+import gzip
 from datetime import datetime
 
 import yaml
@@ -16,11 +17,51 @@ from vumi.persist.redis_manager import RedisManager
 from vumi.errors import ConfigError
 
 
+GZIP_MAGIC = '\x1f\x8b'
+
+
 def vumi_version():
     vumi = pkg_resources.get_distribution("vumi")
     return str(vumi)
 
 
+def open_backup(filename):
+    """Open a backup file for reading, decompressing it if it's gzipped."""
+    backup = open(filename, "rb")
+    magic = backup.read(len(GZIP_MAGIC))
+    backup.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=backup, mode="rb")
+    return backup
+
+
+def scan_keys(redis, count=None):
+    """
+    Iterate over all the keys in ``redis`` without asking for all of them at
+    once. Redis may return a key more than once during a scan, so the same
+    key may be yielded more than once.
+    """
+    cursor = None
+    while True:
+        cursor, keys = redis.scan(cursor, count=count)
+        for key in keys:
+            yield key
+        if cursor is None:
+            break
+
+
+def batches(items, size):
+    """Split an iterable into lists of at most ``size`` items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class KeyHandler(object):
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
@@ -32,15 +73,51 @@ class KeyHandler(object):
                                   for ktype in self.REDIS_TYPES)
 
     def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
-            'type': key_type,
-            'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
+        [record] = self.dump_keys(redis, [key])
         return record
 
+    def dump_keys(self, redis, keys):
+        """
+        Return backup records for ``keys``. The key types are fetched in one
+        pipelined round-trip and the values and TTLs in a second one. Keys
+        that have been deleted or have changed type since they were listed
+        are left out.
+
+        Each ``<type>_get`` handler must make exactly one redis call.
+        """
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+        keys = [(key, key_type) for key, key_type in zip(keys, key_types)
+                if key_type != 'none']
+
+        for key, key_type in keys:
+            pipe.type(key)
+            self._get_handlers[key_type](pipe, key)
+            pipe.ttl(key)
+        # Fetching the value of a key whose type has changed fails with a
+        # WRONGTYPE error, which shouldn't stop us backing up the other keys.
+        results = pipe.execute(raise_on_error=False)
+
+        records = []
+        for i, (key, key_type) in enumerate(keys):
+            new_type, value, ttl = results[3 * i:3 * i + 3]
+            if new_type != key_type or isinstance(value, Exception):
+                continue
+            if not value:
+                # Redis doesn't keep empty values, so the key was deleted.
+                continue
+            if key_type == 'set':
+                value = sorted(value)
+            records.append({
+                'type': key_type,
+                'key': key,
+                'value': value,
+                'ttl': ttl,
+            })
+        return records
+
     def restore_key(self, redis, record, ttl_offset=0):
         key, key_type, ttl = record['key'], record['type'], record['ttl']
         if ttl is not None:
@@ -69,22 +146,25 @@ class KeyHandler(object):
         return redis.lrange(key, 0, -1)
 
     def list_set(self, redis, key, value):
+        # Unsorted backups may contain the same list more than once.
+        redis.delete(key)
         for item in value:
             redis.rpush(key, item)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
 
     def set_set(self, redis, key, value):
-        for item in value:
-            redis.sadd(key, item)
+        if value:
+            redis.sadd(key, *value)
 
     def zset_get(self, redis, key):
         return redis.zrange(key, 0, -1, withscores=True)
 
     def zset_set(self, redis, key, value):
-        for item, score in value:
-            redis.zadd(key, **{item.encode('utf8'): score})
+        if value:
+            redis.zadd(key, **dict(
+                (item.encode('utf8'), score) for item, score in value))
 
     def hash_get(self, redis, key):
         return redis.hgetall(key)
@@ -98,12 +178,26 @@ class BackupDbsCmd(usage.Options):
     synopsis = "<db-config.yaml> <db-backup-output.json>"
 
     optFlags = [
-        ["not-sorted", None, "Don't sort keys when doing backup."],
+        ["not-sorted", None, "Don't sort keys when doing backup. Sorting "
+                             "holds every key in memory until all of them "
+                             "have been listed. Without sorting, records are "
+                             "written as keys are found, and a key that is "
+                             "found more than once is written more than "
+                             "once."],
+        ["gzip", None, "Compress the backup with gzip."],
+    ]
+
+    optParameters = [
+        ["batch-size", None, 1000,
+         "Number of keys to fetch from redis at a time.", int],
     ]
 
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "wb")
+        if self['gzip']:
+            self.db_backup = gzip.open(db_backup, "wb")
+        else:
+            self.db_backup = open(db_backup, "wb")
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def header(self, cfg):
@@ -124,15 +218,19 @@ class BackupDbsCmd(usage.Options):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
         key_handler = KeyHandler()
-        keys = redis.keys()
+        batch_size = self.opts['batch-size']
+        keys = scan_keys(redis, count=batch_size)
         if not self.opts['not-sorted']:
-            keys = sorted(keys)
+            # Sorting needs every key in memory.
+            keys = sorted(set(keys))
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        count = 0
+        for batch in batches(keys, batch_size):
+            for record in key_handler.dump_keys(redis, batch):
+                self.write_line(record)
+                count += 1
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (count,))
 
 
 class RestoreDbsCmd(usage.Options):
@@ -150,9 +248,14 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["batch-size", None, 1000,
+         "Number of keys to send to redis at a time.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def check_header(self, header):
@@ -198,6 +301,8 @@ class RestoreDbsCmd(usage.Options):
         if self.opts['purge']:
             redis._purge_all()
         key_handler = KeyHandler()
+        batch_size = self.opts['batch-size']
+        pipe = redis.pipeline()
         keys, skipped = 0, 0
         for i, line in enumerate(line_iter):
             try:
@@ -212,8 +317,11 @@ class RestoreDbsCmd(usage.Options):
                 cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
                 skipped += 1
                 continue
-            key_handler.restore_key(redis, record, ttl_offset)
+            key_handler.restore_key(pipe, record, ttl_offset)
             keys += 1
+            if keys % batch_size == 0:
+                pipe.execute()
+        pipe.execute()
 
         cfg.emit("%d keys successfully restored." % keys)
         if skipped != 0:
@@ -227,7 +335,7 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.migrated_backup = open(migrated_backup, "wb")
 
     def postOptions(self):
@@ -358,7 +466,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
@@ -2,10 +2,12 @@
 
 import json
 import datetime
+import gzip
 
 import yaml
 
-from vumi.scripts.db_backup import ConfigHolder, Options, vumi_version
+from vumi.scripts.db_backup import (
+    ConfigHolder, Options, KeyHandler, vumi_version)
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -146,6 +148,100 @@ class TestBackupDbCmd(DbBackupBaseTestCase):
             self.assertEqual(record, {'key': 's', 'type': 'string',
                                       'value': "foo"})
 
+    def test_backup_in_batches(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        self.redis.set("foo", "not backed up")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--batch-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Backing up dbs ...',
+            'Backed up 5 keys.',
+        ])
+        with open(db_backup) as backup:
+            self.assertEqual([json.loads(x) for x in backup][1:], [
+                {'key': 's%d' % (i,), 'type': 'string', 'value': str(i),
+                 'ttl': None} for i in range(5)])
+
+    def test_backup_not_sorted(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % (i,), str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--batch-size", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[0]['sorted'], False)
+        self.assertEqual(sorted(records[1:]), [
+            {'key': 's%d' % (i,), 'type': 'string', 'value': str(i),
+             'ttl': None} for i in range(5)])
+
+    def test_backup_gzip(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--gzip", self.mkdbconfig("bar"),
+                             db_backup])
+        cfg.run()
+        with gzip.open(db_backup) as backup:
+            self.assertEqual([json.loads(x) for x in backup][1:], [
+                {'key': 's', 'type': 'string', 'value': "foo", 'ttl': None},
+            ])
+
+
+class TestKeyHandler(DbBackupBaseTestCase):
+    def test_dump_keys(self):
+        self.redis.set("s", "foo")
+        self.redis.sadd("set", "c", "a", "b")
+        self.redis.expire("set", 30)
+        key_handler = KeyHandler()
+        [string_record, set_record] = key_handler.dump_keys(
+            self.redis, ["s", "set"])
+        self.assertEqual(string_record, {
+            'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None})
+        self.assertTrue(0 < set_record.pop('ttl') <= 30)
+        self.assertEqual(set_record, {
+            'key': 'set', 'type': 'set', 'value': ['a', 'b', 'c']})
+
+    def test_dump_keys_skips_missing_keys(self):
+        self.redis.set("s", "foo")
+        key_handler = KeyHandler()
+        self.assertEqual(key_handler.dump_keys(self.redis, ["gone", "s"]), [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
+    def test_dump_keys_skips_keys_changed_between_round_trips(self):
+        self.redis.set("s", "foo")
+        self.redis.set("deleted", "bar")
+        self.redis.rpush("retyped", "baz")
+        self.redis.sadd("emptied", "quux")
+        orig_pipeline = self.redis.pipeline
+
+        def pipeline():
+            pipe = orig_pipeline()
+            orig_execute = pipe.execute
+
+            def execute(*args, **kw):
+                results = orig_execute(*args, **kw)
+                # Change the keys after their types have been fetched.
+                self.redis.delete("deleted")
+                self.redis.delete("retyped")
+                self.redis.set("retyped", "baz")
+                self.redis.srem("emptied", "quux")
+                pipe.execute = orig_execute
+                return results
+
+            pipe.execute = execute
+            return pipe
+
+        self.patch(self.redis, "pipeline", pipeline)
+        key_handler = KeyHandler()
+        self.assertEqual(
+            key_handler.dump_keys(
+                self.redis, ["deleted", "retyped", "emptied", "s"]),
+            [{'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
 
 class TestRestoreDbCmd(DbBackupBaseTestCase):
 
@@ -247,6 +343,12 @@ class TestRestoreDbCmd(DbBackupBaseTestCase):
                            {'l': lvalue},
                            lambda k: self.redis.lrange(k, 0, -1))
 
+    def test_restore_list_twice(self):
+        lvalue = ['z', 'a', 'c']
+        record = {'key': 'l', 'type': 'list', 'value': lvalue, 'ttl': None}
+        self.check_restore([record, record], {'l': lvalue},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
     def test_restore_set(self):
         svalue = set(['z', 'a', 'c'])
         self.check_restore([{'key': 's', 'type': 'set',
@@ -282,6 +384,30 @@ class TestRestoreDbCmd(DbBackupBaseTestCase):
                            args=["--frozen-ttls"], key_prefix="bar")
         self.assertTrue(0 < self.redis.ttl("bar:s") <= 30)
 
+    def test_restore_in_batches(self):
+        backup_data = [{'key': 's%d' % (i,), 'type': 'string',
+                        'value': str(i), 'ttl': None} for i in range(5)]
+        self.check_restore(
+            backup_data, dict(('s%d' % (i,), str(i)) for i in range(5)),
+            self.redis.get, args=["--batch-size", "2"])
+
+    def test_restore_gzip(self):
+        backup_data = [
+            {'backup_type': 'redis',
+             'timestamp': datetime.datetime.utcnow().isoformat()},
+            {'key': 's', 'type': 'string', 'value': 'ping', 'ttl': None},
+        ]
+        db_backup = self.mktemp()
+        with gzip.open(db_backup, "wb") as backup:
+            backup.write("\n".join(json.dumps(x) for x in backup_data))
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '1 keys successfully restored.',
+        ])
+        self.assertEqual(self.redis.get("bar:s"), "ping")
+
 
 class TestMigrateDbCmd(DbBackupBaseTestCase):
 
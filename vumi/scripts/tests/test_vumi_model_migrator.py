@@ -1,9 +1,10 @@
 """Tests for vumi.scripts.vumi_model_migrator."""
 
+import re
 import sys
 from StringIO import StringIO
 
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 from twisted.internet.task import deferLater
 from twisted.python import usage
 
@@ -72,6 +73,8 @@ class StubbedModelMigrator(ModelMigrator):
         self.output = []
         self.recorded_loads = []
         self.recorded_stores = []
+        # A clock that doesn't move keeps the throughput report predictable.
+        self.clock = lambda: 0.0
         super(StubbedModelMigrator, self).__init__(*args, **kwargs)
 
     def emit(self, s):
@@ -155,6 +158,77 @@ class TestVumiModelMigrator(VumiTestCase):
             "-m", self.model_cls_path,
         ])
 
+    def test_concurrent_saves_defaults_to_concurrent_migrations(self):
+        model_migrator = self.make_migrator(concurrent_migrations=7)
+        self.assertEqual(model_migrator.options["concurrent-saves"], 7)
+        self.assertEqual(model_migrator.save_semaphore.limit, 7)
+
+    def test_concurrent_saves(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--concurrent-saves", "3"])
+        self.assertEqual(model_migrator.save_semaphore.limit, 3)
+
+    def test_concurrency_options_must_be_positive(self):
+        for opt in ["--concurrent-migrations", "--concurrent-saves",
+                    "--index-page-size", "--load-bunch-size"]:
+            self.assertRaises(
+                usage.UsageError, self.make_migrator,
+                self.default_args + [opt, "0"])
+
+    def test_load_bunch_size(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--load-bunch-size", "5"])
+        self.assertEqual(model_migrator.manager.load_bunch_size, 5)
+
+    def test_make_bunches(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--load-bunch-size", "5"],
+            concurrent_migrations=6)
+        keys = [u"key-%d" % i for i in range(13)]
+        bunches = model_migrator.make_bunches(keys * 3)
+        self.assertEqual(
+            list(bunches), [(keys * 3)[i:i + 5] for i in range(0, 39, 5)])
+        bunches = model_migrator.make_bunches(keys[:12])
+        self.assertEqual(
+            list(bunches), [keys[i:i + 2] for i in range(0, 12, 2)])
+        self.assertEqual(list(model_migrator.make_bunches([])), [])
+
+    def test_make_bunches_limited_by_concurrent_migrations(self):
+        model_migrator = self.make_migrator(
+            self.default_args + ["--load-bunch-size", "5"],
+            concurrent_migrations=4)
+        keys = [u"key-%d" % i for i in range(13)]
+        bunches = model_migrator.make_bunches(keys)
+        self.assertEqual(
+            list(bunches), [keys[:4], keys[4:8], keys[8:12], keys[12:]])
+
+    def test_migrate_page_limits_objects_in_flight(self):
+        """
+        No more than --concurrent-migrations objects are loaded or migrated at
+        once, however the keys are bunched.
+        """
+        model_migrator = self.make_migrator(
+            self.default_args + ["--load-bunch-size", "2"],
+            concurrent_migrations=5)
+        in_flight = []
+        pending = []
+
+        def migrate_bunch(keys, dry_run):
+            in_flight.extend(keys)
+            d = Deferred()
+            d.addCallback(lambda _: [in_flight.remove(k) for k in keys])
+            pending.append(d)
+            return d
+
+        model_migrator.migrate_bunch = migrate_bunch
+        keys = [u"key-%d" % i for i in range(20)]
+        page_d = model_migrator.migrate_page(keys, False)
+        while pending:
+            self.assertTrue(0 < len(in_flight) <= 5)
+            pending.pop(0).callback(None)
+        self.assertEqual(in_flight, [])
+        return page_d
+
     @inlineCallbacks
     def test_main(self):
         yield self.mk_simple_models_old(3)
@@ -163,9 +237,11 @@ class TestVumiModelMigrator(VumiTestCase):
             None, "name",
             "-m", self.model_cls_path,
             "-b", self.riak_manager.bucket_prefix)
-        self.assertEqual(
-            sys.stdout.getvalue(),
-            "Migrating ...\nDone, 3 objects migrated.\n")
+        self.assertTrue(re.match(
+            r"Migrating \.\.\.\nDone, 3 objects migrated\.\n"
+            r"3 saved, 0 tombstones skipped, 0 failed"
+            r" in \d+\.\ds \(\d+\.\d+ objects/s\)\.\n$",
+            sys.stdout.getvalue()))
 
     @inlineCallbacks
     def test_successful_migration(self):
@@ -176,6 +252,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -193,6 +270,7 @@ class TestVumiModelMigrator(VumiTestCase):
             "2 objects migrated.",
             continuation,
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -214,6 +292,7 @@ class TestVumiModelMigrator(VumiTestCase):
             "3 objects migrated.",
             ct3,
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -233,6 +312,7 @@ class TestVumiModelMigrator(VumiTestCase):
             "2 objects migrated.",
             continuation,
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -251,6 +331,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(cont_model_migrator.output, [
             "Migrating ...",
             "Done, 1 object migrated.",
+            "1 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(cloads, [u"key-2"])
         self.assertEqual(cstores, [u"key-2"])
@@ -270,8 +351,9 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output[:1], [
             "Migrating ...",
         ])
-        self.assertEqual(model_migrator.output[-1:], [
+        self.assertEqual(model_migrator.output[-2:], [
             "Done, 3 objects migrated.",
+            "0 saved, 3 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
 
     @inlineCallbacks
@@ -292,8 +374,9 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output[:1], [
             "Migrating ...",
         ])
-        self.assertEqual(model_migrator.output[-1:], [
+        self.assertEqual(model_migrator.output[-2:], [
             "Done, 3 objects migrated.",
+            "0 saved, 0 tombstones skipped, 3 failed in 0.0s (0.0 objects/s).",
         ])
 
     @inlineCallbacks
@@ -306,6 +389,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating 2 specified keys ...",
             "Done, 2 objects migrated.",
+            "2 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-1", u"key-2"])
         self.assertEqual(sorted(stores), [u"key-1", u"key-2"])
@@ -319,6 +403,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "0 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [])
@@ -338,6 +423,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "2 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-0", u"key-1", u"key-2"])
         self.assertEqual(sorted(stores), [u"key-0", u"key-2"])
@@ -357,6 +443,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -378,6 +465,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -402,6 +490,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "3 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
@@ -426,6 +515,7 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(model_migrator.output, [
             "Migrating ...",
             "Done, 3 objects migrated.",
+            "2 saved, 0 tombstones skipped, 0 failed in 0.0s (0.0 objects/s).",
         ])
         self.assertEqual(sorted(loads), [u"key-0", u"key-1", u"key-2"])
         self.assertEqual(sorted(stores), [u"key-0", u"key-2"])
@@ -436,3 +526,30 @@ class TestVumiModelMigrator(VumiTestCase):
         self.assertEqual(obj_1.a, u"value-1")
         obj_2 = yield self.model.load(u"key-2")
         self.assertEqual(obj_2.a, u"value-2-modified")
+
+    @inlineCallbacks
+    def test_migration_with_some_failures(self):
+        """
+        If a bunch fails to load, the keys in it are migrated one at a time so
+        that only the broken ones fail.
+        """
+        yield self.mk_simple_models_old(3)
+        orig_load = self.riak_manager.load
+
+        def error_load(modelcls, key, result=None):
+            if key == u"key-1":
+                raise ValueError("Failed to load.")
+            return orig_load(modelcls, key, result=result)
+
+        model_migrator = self.make_migrator(
+            concurrent_migrations=1, manager_load_func=error_load)
+        loads, stores = self.recorded_loads_and_stores(model_migrator)
+        yield model_migrator.run()
+        self.assertEqual(model_migrator.output, [
+            "Migrating ...",
+            "Failed to migrate key u'key-1':",
+            "  ValueError: Failed to load.",
+            "Done, 3 objects migrated.",
+            "2 saved, 0 tombstones skipped, 1 failed in 0.0s (0.0 objects/s).",
+        ])
+        self.assertEqual(sorted(stores), [u"key-0", u"key-2"])
@@ -1,5 +1,6 @@
 """Tests for vumi.scripts.vumi_redis_tools."""
 
+import os
 import StringIO
 
 import yaml
@@ -7,8 +8,8 @@ import yaml
 from twisted.python.usage import UsageError
 
 from vumi.scripts.vumi_redis_tools import (
-    scan_keys, TaskRunner, Options, Task, TaskError,
-    Count, Expire, Persist, ListKeys, Skip)
+    scan_keys, scan_key_batches, key_slot, TaskRunner, Options, Task,
+    TaskError, ProgressReporter, Count, Expire, Persist, ListKeys, Skip)
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -31,6 +32,16 @@ class DummyTask(Task):
         self.b = b
 
 
+class FailingTask(Task):
+    """Task that fails, for testing."""
+
+    name = "fail"
+    hidden = True
+
+    def process_key(self, key):
+        raise ValueError("Failed on %s" % (key,))
+
+
 class TestTask(VumiTestCase):
     def test_name(self):
         t = Task()
@@ -61,6 +72,12 @@ class TestTask(VumiTestCase):
         self.assertEqual(t.runner, runner)
         self.assertEqual(t.redis, redis)
 
+    def test_process_keys(self):
+        t = Skip("skip_.*")
+        self.assertEqual(
+            t.process_keys(["skip_this", "dont_skip", "skip_too", "keep"]),
+            ["dont_skip", "keep"])
+
 
 class TestCount(VumiTestCase):
 
@@ -101,6 +118,17 @@ class TestCount(VumiTestCase):
             "Found 5 matching keys.",
         ])
 
+    def test_merge_state(self):
+        t = self.mk_count()
+        worker_t = self.mk_count()
+        worker_t.process_keys(["a", "b", "c"])
+        t.process_key("d")
+        t.merge_state(worker_t.get_state())
+        t.after()
+        self.assertEqual(self.runner.output, [
+            "Found 4 matching keys.",
+        ])
+
 
 class TestExpire(VumiTestCase):
 
@@ -138,6 +166,16 @@ class TestExpire(VumiTestCase):
         self.assertEqual(
             self.redis.ttl("key2"), None)
 
+    def test_process_keys(self):
+        t = self.mk_expire(seconds=10)
+        for key in ["key1", "key2", "key3"]:
+            self.redis.set(key, "bar")
+        keys = t.process_keys(["key1", "key2"])
+        self.assertEqual(keys, ["key1", "key2"])
+        self.assertTrue(0 < self.redis.ttl("key1") <= 10)
+        self.assertTrue(0 < self.redis.ttl("key2") <= 10)
+        self.assertEqual(self.redis.ttl("key3"), None)
+
 
 class TestPersist(VumiTestCase):
 
@@ -174,6 +212,16 @@ class TestPersist(VumiTestCase):
         self.assertTrue(
             0 < self.redis.ttl("key2") <= 20)
 
+    def test_process_keys(self):
+        t = self.mk_persist()
+        for key in ["key1", "key2", "key3"]:
+            self.redis.setex(key, 10, "bar")
+        keys = t.process_keys(["key1", "key2"])
+        self.assertEqual(keys, ["key1", "key2"])
+        self.assertEqual(self.redis.ttl("key1"), None)
+        self.assertEqual(self.redis.ttl("key2"), None)
+        self.assertTrue(0 < self.redis.ttl("key3") <= 10)
+
 
 class TestListKeys(VumiTestCase):
 
@@ -287,6 +335,19 @@ class TestOptions(VumiTestCase):
             ["list", "count"]
         )
 
+    def test_defaults(self):
+        opts = self.mk_opts(["-t", "count"])
+        self.assertEqual(opts["batch-size"], 1000)
+        self.assertEqual(opts["processes"], 1)
+        self.assertEqual(opts["max-in-flight"], 4)
+        self.assertEqual(opts["progress"], False)
+
+    def test_invalid_processes(self):
+        exc = self.assertRaises(
+            UsageError,
+            self.mk_opts, ["-t", "count", "--processes", "0"])
+        self.assertEqual(str(exc), "--processes must be at least 1.")
+
     def test_help(self):
         opts = Options()
         lines = opts.getUsage().splitlines()
@@ -379,6 +440,155 @@ class TestTaskRunner(VumiTestCase):
             'key2',
         ])
 
+    def test_batches(self):
+        runner = self.make_runner([
+            "-t", "skip:pattern=key1.*",
+            "-t", "list",
+            "-t", "count",
+            "--batch-size", "3",
+        ])
+        for i in range(20):
+            runner.redis.set("key%02d" % (i,), "v")
+        runner.run()
+        output = self.output(runner)
+        self.assertEqual(output[-1], 'Found 10 matching keys.')
+        self.assertEqual(
+            sorted(output[:-1]), ["key%02d" % (i,) for i in range(10)])
+
+    def test_processes(self):
+        runner = self.make_runner([
+            "-t", "list",
+            "-t", "count",
+            "--processes", "3",
+            "--batch-size", "2",
+            "--max-in-flight", "1",
+        ])
+        for i in range(20):
+            runner.redis.set("key%02d" % (i,), "v")
+        runner.run()
+        output = self.output(runner)
+        self.assertEqual(output[-1], 'Found 20 matching keys.')
+        self.assertEqual(
+            sorted(output[:-1]), ["key%02d" % (i,) for i in range(20)])
+
+    def test_processes_failure(self):
+        runner = self.make_runner([
+            "-t", "fail",
+            "--processes", "2",
+        ])
+        runner.redis.set("key1", "v")
+        err = self.assertRaises(TaskError, runner.run)
+        self.assertTrue("Worker processes failed:" in str(err))
+        self.assertTrue("ValueError: Failed on key1" in str(err))
+
+    def test_processes_failure_with_many_batches(self):
+        # There are more batches than the failed worker's queue can hold, so
+        # the scan has to stop instead of waiting for room on it.
+        runner = self.make_runner([
+            "-t", "fail",
+            "--processes", "2",
+            "--batch-size", "1",
+            "--max-in-flight", "1",
+        ])
+        for i in range(200):
+            runner.redis.set("key%03d" % (i,), "v")
+        err = self.assertRaises(TaskError, runner.run)
+        self.assertTrue("Worker processes failed:" in str(err))
+        self.assertTrue("ValueError: Failed on key" in str(err))
+
+    def test_processes_killed(self):
+        runner = self.make_runner([
+            "-t", "list",
+            "--processes", "2",
+            "--batch-size", "1",
+            "--max-in-flight", "1",
+        ])
+        for i in range(200):
+            runner.redis.set("key%03d" % (i,), "v")
+
+        def process_keys(keys):
+            os._exit(3)
+
+        runner.process_keys = process_keys
+        err = self.assertRaises(TaskError, runner.run)
+        self.assertTrue("exited with code 3." in str(err))
+
+    def test_progress(self):
+        runner = self.make_runner([
+            "-t", "count",
+            "--progress",
+        ])
+        runner.stderr = StringIO.StringIO()
+        runner.redis.set("key1", "k1")
+        runner.redis.set("key2", "k2")
+        runner.run()
+        self.assertEqual(self.output(runner), [
+            'Found 2 matching keys.',
+        ])
+        [progress] = runner.stderr.getvalue().splitlines()
+        self.assertTrue(progress.startswith("Processed 2 keys in "))
+
+    def test_progress_processes(self):
+        runner = self.make_runner([
+            "-t", "count",
+            "--progress",
+            "--processes", "2",
+        ])
+        runner.stderr = StringIO.StringIO()
+        for i in range(5):
+            runner.redis.set("key%d" % (i,), "v")
+        runner.run()
+        self.assertEqual(self.output(runner), [
+            'Found 5 matching keys.',
+        ])
+        progress = runner.stderr.getvalue().splitlines()
+        self.assertTrue(progress[-1].startswith("Processed 5 keys in "))
+
+
+class TestProgressReporter(VumiTestCase):
+    def mk_reporter(self, total, interval, times):
+        self.output = []
+        self.times = list(times)
+        return ProgressReporter(
+            self.output.append, total, interval,
+            clock=lambda: self.times.pop(0))
+
+    def test_add(self):
+        reporter = self.mk_reporter(100, 10, [0, 5, 10])
+        reporter.add(10)
+        self.assertEqual(self.output, [])
+        reporter.add(10)
+        self.assertEqual(self.output, [
+            "Processed 20 keys in 10s (2 keys/s), about 40s left",
+        ])
+        self.assertEqual(reporter.processed, 20)
+
+    def test_report_done(self):
+        reporter = self.mk_reporter(20, 10, [0, 4])
+        reporter.processed = 20
+        reporter.report()
+        self.assertEqual(self.output, [
+            "Processed 20 keys in 4s (5 keys/s)",
+        ])
+
+
+class TestKeySlot(VumiTestCase):
+    def test_key_slot(self):
+        # These are the slots Redis Cluster uses for these keys.
+        self.assertEqual(key_slot("foo"), 12182)
+        self.assertEqual(key_slot("bar"), 5061)
+        self.assertEqual(key_slot("123456789"), 12739)
+
+    def test_hash_tag(self):
+        self.assertEqual(
+            key_slot("{user1000}.following"), key_slot("user1000"))
+        self.assertEqual(
+            key_slot("{user1000}.followers"), key_slot("user1000"))
+
+    def test_empty_hash_tag(self):
+        self.assertNotEqual(key_slot("{}foo"), key_slot(""))
+        self.assertEqual(key_slot("{}foo"), 9500)
+
 
 class TestScanKeys(VumiTestCase):
     def setUp(self):
@@ -410,3 +620,13 @@ class TestScanKeys(VumiTestCase):
         self.redis.set("tea:rooibos", "yes")
         keys = list(scan_keys(self.redis, "coffee:*"))
         self.assertEqual(keys, ["coffee:latte"])
+
+    def test_batches(self):
+        expected_keys = ["key%02d" % i for i in range(20)]
+        for key in expected_keys:
+            self.redis.set(key, "foo")
+        batches = list(scan_key_batches(self.redis, "*", count=7))
+        self.assertTrue(len(batches) > 1)
+        self.assertTrue(all(len(keys) <= 7 for keys in batches))
+        self.assertEqual(
+            sorted(key for keys in batches for key in keys), expected_keys)
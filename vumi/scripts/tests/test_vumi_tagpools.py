@@ -119,6 +119,24 @@ class TestPurgePoolCmd(TagPoolBaseTestCase):
         self.assertEqual(cfg.tagpool.get_metadata("foo"), {})
 
 
+class TestMigratePoolsCmd(TagPoolBaseTestCase):
+    def test_migrate_pools(self):
+        cfg = make_cfg(["migrate-pools"])
+        cfg.tagpool.declare_tags([("foo", "tag1"), ("bar", "tag2")])
+        redis = cfg.tagpool.redis
+        redis.rpush("tagpools:bar:free:list", "tag3")
+        redis.sadd("tagpools:bar:free:set", "tag3")
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Migrating pools to the free tag sorted set ...',
+            '  Moved 1 free tag(s) for pool bar.',
+            '  Moved 0 free tag(s) for pool foo.',
+            '  Done.',
+            ])
+        self.assertEqual(
+            redis.zrange("tagpools:bar:free:zset", 0, -1), ["tag2", "tag3"])
+
+
 class TestListKeysCmd(TagPoolBaseTestCase):
     def setUp(self):
         super(TestListKeysCmd, self).setUp()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- test-case-name: vumi.scripts.tests.test_vumi_model_migrator -*-
 import sys
+import time
+from collections import deque
 
-from twisted.internet.defer import inlineCallbacks, gatherResults, succeed
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, succeed, DeferredSemaphore)
 from twisted.internet.task import react
 from twisted.python import usage
 
@@ -21,7 +24,13 @@ class Options(usage.Options):
          "Migrate these specific keys rather than the whole bucket."
          " E.g. --keys 'foo,bar,baz'"],
         ["concurrent-migrations", None, "20",
-         "The number of concurrent migrations to perform."],
+         "The maximum number of objects to load and migrate at once."],
+        ["concurrent-saves", None, None,
+         "The maximum number of objects to save to Riak at once."
+         " Defaults to the number of concurrent migrations."],
+        ["load-bunch-size", None, None,
+         "The maximum number of objects to load from Riak in one bunch."
+         " Defaults to the Riak manager's bunch size."],
         ["index-page-size", None, "1000",
          "The number of keys to fetch in each index query."],
         ["continuation-token", None, None,
@@ -48,6 +57,15 @@ class Options(usage.Options):
             raise usage.UsageError("Please specify a bucket prefix.")
         self['concurrent-migrations'] = int(self['concurrent-migrations'])
         self['index-page-size'] = int(self['index-page-size'])
+        if self['concurrent-saves'] is None:
+            self['concurrent-saves'] = self['concurrent-migrations']
+        self['concurrent-saves'] = int(self['concurrent-saves'])
+        if self['load-bunch-size'] is not None:
+            self['load-bunch-size'] = int(self['load-bunch-size'])
+        for opt in ('concurrent-migrations', 'concurrent-saves',
+                    'index-page-size', 'load-bunch-size'):
+            if self[opt] is not None and self[opt] < 1:
+                raise usage.UsageError("--%s must be at least 1." % (opt,))
 
 
 class ProgressEmitter(object):
@@ -64,6 +82,27 @@ class ProgressEmitter(object):
         self.processed = value
 
 
+class MigrationStats(object):
+    """Count what happened to each key and how quickly we got through them.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.start = clock()
+        self.processed = 0
+        self.saved = 0
+        self.tombstones = 0
+        self.failures = 0
+
+    def summary(self):
+        elapsed = self.clock() - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        return (
+            "%d saved, %d tombstones skipped, %d failed"
+            " in %.1fs (%.1f objects/s)." % (
+                self.saved, self.tombstones, self.failures, elapsed, rate))
+
+
 class FakeIndexPage(object):
     def __init__(self, keys, page_size):
         self._keys = keys
@@ -81,14 +120,21 @@ class FakeIndexPage(object):
 
 
 class ModelMigrator(object):
+
+    clock = time.time
+
     def __init__(self, options):
         self.options = options
         model_cls = load_class_by_string(options['model'])
         riak_config = {
             'bucket_prefix': options['bucket-prefix'],
         }
+        if options['load-bunch-size'] is not None:
+            riak_config['load_bunch_size'] = options['load-bunch-size']
         self.manager = self.get_riak_manager(riak_config)
         self.model = self.manager.proxy(model_cls)
+        self.save_semaphore = DeferredSemaphore(options['concurrent-saves'])
+        self.stats = MigrationStats(self.clock)
 
         # The default post-migrate-function does nothing and returns True if
         # and only if the object was migrated.
@@ -106,40 +152,101 @@ class ModelMigrator(object):
     def emit(self, s):
         print s
 
+    def skip_tombstone(self, key):
+        self.stats.tombstones += 1
+        self.emit("Skipping tombstone key %r." % (key,))
+
+    def report_failure(self, key, e):
+        self.stats.failures += 1
+        self.emit("Failed to migrate key %r:" % (key,))
+        self.emit("  %s: %s" % (type(e).__name__, e))
+
+    @inlineCallbacks
+    def migrate_object(self, obj, dry_run):
+        try:
+            should_save = yield self.post_migrate_function(obj)
+            if should_save and not dry_run:
+                yield self.save_semaphore.run(obj.save)
+                self.stats.saved += 1
+        except Exception, e:
+            self.report_failure(obj.key, e)
+
     @inlineCallbacks
     def migrate_key(self, key, dry_run):
         try:
             obj = yield self.model.load(key)
-            if obj is not None:
-                should_save = yield self.post_migrate_function(obj)
-                if should_save and not dry_run:
-                    yield obj.save()
-            else:
-                self.emit("Skipping tombstone key %r." % (key,))
         except Exception, e:
-            self.emit("Failed to migrate key %r:" % (key,))
-            self.emit("  %s: %s" % (type(e).__name__, e))
+            self.report_failure(key, e)
+            return
+        if obj is not None:
+            yield self.migrate_object(obj, dry_run)
+        else:
+            self.skip_tombstone(key)
+
+    @inlineCallbacks
+    def migrate_bunch(self, keys, dry_run):
+        """
+        Load a bunch of keys together and migrate the objects we get back.
+
+        If the bunch fails to load, we fall back to loading the keys one at a
+        time so that we can tell which of them are broken.
+        """
+        objs = []
+        try:
+            for bunch in self.model.load_all_bunches(keys):
+                objs.extend((yield bunch))
+        except Exception:
+            yield gatherResults([
+                self.migrate_key(key, dry_run) for key in keys])
+            return
+        # Keys that don't exist aren't returned from a bunch load.
+        found = set(obj.key for obj in objs)
+        for key in keys:
+            if key not in found:
+                self.skip_tombstone(key)
+        yield gatherResults([
+            self.migrate_object(obj, dry_run) for obj in objs])
 
     @inlineCallbacks
-    def migrate_keys(self, _result, keys_list, dry_run):
+    def migrate_bunches(self, bunches, dry_run):
         """
-        Migrate keys from `keys_list` until there are none left.
+        Migrate bunches of keys from `bunches` until there are none left.
 
         This method is expected to be called multiple times concurrently with
-        all instances sharing the same `keys_list`.
+        all instances sharing the same `bunches` queue.
+        """
+        while bunches:
+            keys = bunches.popleft()
+            yield self.migrate_bunch(keys, dry_run)
+
+    def make_bunches(self, keys):
+        """
+        Split `keys` into a queue of bunches. Bunches are no bigger than the
+        manager's load bunch size or the number of concurrent migrations, but
+        small enough that the work is spread over as many of them as we can.
         """
-        # keys_list is a shared mutable list, so we can't just iterate over it.
-        while keys_list:
-            key = keys_list.pop(0)
-            yield self.migrate_key(key, dry_run)
+        concurrency = self.options["concurrent-migrations"]
+        bunch_size = max(1, min(
+            self.manager.load_bunch_size, concurrency,
+            (len(keys) + concurrency - 1) // concurrency))
+        return deque(
+            keys[i:i + bunch_size] for i in xrange(0, len(keys), bunch_size))
 
     def migrate_page(self, keys, dry_run):
         # Depending on our Riak client, Python version, and JSON library we may
         # get bytes or unicode here.
         keys = [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
+        bunches = self.make_bunches(keys)
+        if not bunches:
+            return succeed([])
+        # Each bunch is loaded and migrated as a unit, so we only work on as
+        # many bunches at once as keeps the number of objects in flight within
+        # the concurrent migrations limit.
+        workers = max(
+            1, self.options["concurrent-migrations"] // len(bunches[0]))
         return gatherResults([
-            self.migrate_keys(None, keys, dry_run)
-            for _ in xrange(self.options["concurrent-migrations"])])
+            self.migrate_bunches(bunches, dry_run)
+            for _ in xrange(min(len(bunches), workers))])
 
     @inlineCallbacks
     def migrate_pages(self, index_page, emit_progress):
@@ -155,6 +262,7 @@ class ModelMigrator(object):
             keys = list(index_page)
             yield self.migrate_page(keys, dry_run)
             processed += len(keys)
+            self.stats.processed = processed
             progress.update(processed)
             continuation = getattr(index_page, 'continuation', None)
             if continuation is not None:
@@ -162,6 +270,7 @@ class ModelMigrator(object):
             index_page = yield next_page_d
         self.emit("Done, %s object%s migrated." % (
             processed, "" if processed == 1 else "s"))
+        self.emit(self.stats.summary())
 
     def migrate_specified_keys(self, keys):
         """
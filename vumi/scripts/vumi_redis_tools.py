@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 # -*- test-case-name: vumi.scripts.tests.test_vumi_redis_tools -*-
+import binascii
+import multiprocessing
+import Queue
 import re
+import signal
 import sys
+import time
+import traceback
 
 import yaml
 from twisted.python import usage
@@ -77,6 +83,30 @@ class Task(object):
         """
         return key
 
+    def process_keys(self, keys):
+        """Run once for each batch of keys.
+
+        Returns the list of keys to be processed by later tasks, as
+        for :meth:`process_key`. Tasks that make a redis call for each
+        key should override this to send the calls for the whole batch
+        in one pipeline.
+        """
+        keys = [self.process_key(key) for key in keys]
+        return [key for key in keys if key is not None]
+
+    def get_state(self):
+        """Return the task's results from a worker process.
+
+        When the runner uses more than one process, each process gets its
+        own copy of the task and runs :meth:`before` on it. The state
+        returned here is sent back to the parent process and passed to
+        :meth:`merge_state` before :meth:`after` is run.
+        """
+        return None
+
+    def merge_state(self, state):
+        """Add the results from a worker process's copy of the task."""
+
 
 class Count(Task):
     """A task that counts the number of keys."""
@@ -96,6 +126,12 @@ class Count(Task):
         self.count += 1
         return key
 
+    def get_state(self):
+        return self.count
+
+    def merge_state(self, state):
+        self.count += state
+
 
 class Expire(Task):
     """A task that sets an expiry time on each key."""
@@ -109,6 +145,13 @@ class Expire(Task):
         self.redis.expire(key, self.seconds)
         return key
 
+    def process_keys(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.expire(key, self.seconds)
+        pipe.execute()
+        return keys
+
 
 class Persist(Task):
     """A task that persists each key."""
@@ -119,6 +162,13 @@ class Persist(Task):
         self.redis.persist(key)
         return key
 
+    def process_keys(self, keys):
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.persist(key)
+        pipe.execute()
+        return keys
+
 
 class ListKeys(Task):
     """A task that prints out each key."""
@@ -150,6 +200,25 @@ class Options(usage.Options):
 
     longdesc = "Perform tasks on Redis keys."
 
+    optFlags = [
+        ["progress", None, "Print the processing rate and an estimate of "
+                           "the time left to stderr while running."],
+    ]
+
+    optParameters = [
+        ["batch-size", None, 1000,
+         "Number of keys to ask for in each scan and to process at a time.",
+         int],
+        ["processes", None, 1,
+         "Number of processes to spread the keys over. Keys are given to "
+         "processes by their hash slot.", int],
+        ["max-in-flight", None, 4,
+         "Number of scanned batches of keys that may be waiting for each "
+         "process.", int],
+        ["progress-interval", None, 10.0,
+         "Seconds between progress reports.", float],
+    ]
+
     def __init__(self):
         usage.Options.__init__(self)
         self['tasks'] = []
@@ -178,15 +247,18 @@ class Options(usage.Options):
     def postOptions(self):
         if not self['tasks']:
             raise usage.UsageError("Please specify a task.")
+        for opt in ('batch-size', 'processes', 'max-in-flight'):
+            if self[opt] < 1:
+                raise usage.UsageError("--%s must be at least 1." % (opt,))
 
 
-def scan_keys(redis, match):
-    """Iterate over matching keys."""
+def scan_key_batches(redis, match, count=None):
+    """Iterate over batches of matching keys, one batch per scan."""
     prev_cursor = None
     while True:
-        cursor, keys = redis.scan(prev_cursor, match=match)
-        for key in keys:
-            yield key
+        cursor, keys = redis.scan(prev_cursor, match=match, count=count)
+        if keys:
+            yield keys
         if cursor is None:
             break
         if cursor == prev_cursor:
@@ -194,14 +266,80 @@ def scan_keys(redis, match):
         prev_cursor = cursor
 
 
+def scan_keys(redis, match, count=None):
+    """Iterate over matching keys."""
+    for keys in scan_key_batches(redis, match, count=count):
+        for key in keys:
+            yield key
+
+
+def key_slot(key):
+    """
+    Return the Redis Cluster hash slot for ``key``. If the key contains a
+    ``{...}`` hash tag, only the tag is hashed.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key, 0) % 16384
+
+
+class ProgressReporter(object):
+    """
+    Reports how many keys have been processed, how quickly and roughly how
+    long the rest will take.
+
+    The estimate assumes every key in the database will be processed, so it
+    is an upper bound when only some keys match.
+    """
+
+    def __init__(self, emit, total, interval, clock=time.time):
+        self.emit = emit
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+        self.processed = 0
+        self.start = self.last_report = clock()
+
+    def add(self, count):
+        self.processed += count
+        now = self.clock()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        if now is None:
+            now = self.clock()
+        elapsed = now - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        line = "Processed %d keys in %.0fs (%.0f keys/s)" % (
+            self.processed, elapsed, rate)
+        if rate > 0 and self.total > self.processed:
+            line += ", about %.0fs left" % (
+                (self.total - self.processed) / rate,)
+        self.emit(line)
+
+
 class TaskRunner(object):
 
     stdout = sys.stdout
 
+    stderr = sys.stderr
+
+    # How long to wait on the worker process queues before checking whether
+    # a process has failed.
+    POLL_INTERVAL = 0.1
+
     def __init__(self, options):
         self.options = options
         self.match_pattern = options['match_pattern']
         self.tasks = options['tasks']
+        self.batch_size = options['batch-size']
+        self.processes = options['processes']
+        self.max_in_flight = options['max-in-flight']
         self.redis = self.get_redis(options['config'])
 
     def emit(self, s):
@@ -211,6 +349,14 @@ class TaskRunner(object):
         self.stdout.write(s)
         self.stdout.write("\n")
 
+    def emit_progress(self, s):
+        """
+        Print a progress report to stderr, so that it isn't mixed up with
+        the output of the tasks.
+        """
+        self.stderr.write(s)
+        self.stderr.write("\n")
+
     def get_redis(self, config):
         """
         Create and return a redis manager.
@@ -218,6 +364,22 @@ class TaskRunner(object):
         redis_config = config.get('redis_manager', {})
         return RedisManager.from_config(redis_config)
 
+    def get_progress_reporter(self):
+        if not self.options['progress']:
+            return None
+        return ProgressReporter(
+            self.emit_progress, self.redis.dbsize(),
+            self.options['progress-interval'])
+
+    def process_keys(self, keys):
+        """
+        Apply all tasks to a batch of keys.
+        """
+        for task in self.tasks:
+            keys = task.process_keys(keys)
+            if not keys:
+                break
+
     def run(self):
         """
         Apply all tasks to all keys.
@@ -228,15 +390,154 @@ class TaskRunner(object):
         for task in self.tasks:
             task.before()
 
-        for key in scan_keys(self.redis, self.match_pattern):
-            for task in self.tasks:
-                key = task.process_key(key)
-                if key is None:
-                    break
+        progress = self.get_progress_reporter()
+        batches = scan_key_batches(
+            self.redis, self.match_pattern, count=self.batch_size)
+        if self.processes > 1:
+            self.run_processes(batches, progress)
+        else:
+            for keys in batches:
+                self.process_keys(keys)
+                if progress is not None:
+                    progress.add(len(keys))
+
+        if progress is not None:
+            progress.report()
 
         for task in self.tasks:
             task.after()
 
+    def run_processes(self, batches, progress):
+        """
+        Spread the scanned keys over worker processes by hash slot, so that
+        keys that share a hash tag are always handled by the same process.
+
+        Each process has a queue of at most ``max-in-flight`` batches, which
+        stops the scan from getting too far ahead of the processing. The
+        processes send their output, the number of keys they have processed
+        and their task states back on a shared result queue.
+
+        If a process fails, the scan stops, the other processes are stopped
+        and a :class:`TaskError` is raised.
+        """
+        self._results = multiprocessing.Queue()
+        self._errors = []
+        self._progress = progress
+        workers = []
+        for i in range(self.processes):
+            batch_queue = multiprocessing.Queue(self.max_in_flight)
+            worker = multiprocessing.Process(
+                target=self._worker_main, args=(batch_queue, self._results))
+            worker.daemon = True
+            worker.start()
+            workers.append((worker, batch_queue))
+        self._running = len(workers)
+
+        try:
+            self._feed_workers(workers, batches)
+            while self._running and not self._errors:
+                self._read_results(workers, self.POLL_INTERVAL)
+        finally:
+            if self._running:
+                for worker, _batch_queue in workers:
+                    if worker.is_alive():
+                        worker.terminate()
+            for worker, _batch_queue in workers:
+                worker.join()
+        if self._errors:
+            raise TaskError(
+                "Worker processes failed:\n%s" % ("\n".join(self._errors),))
+
+    def _feed_workers(self, workers, batches):
+        """
+        Send batches of keys to the worker processes until there are no more
+        keys or a process has failed.
+        """
+        pending = [[] for _ in workers]
+        for keys in batches:
+            for key in keys:
+                pending[key_slot(key) % len(workers)].append(key)
+            for i, (_worker, batch_queue) in enumerate(workers):
+                if len(pending[i]) >= self.batch_size:
+                    if not self._put_batch(workers, batch_queue, pending[i]):
+                        return
+                    pending[i] = []
+            self._read_results(workers)
+            if self._errors:
+                return
+        for i, (_worker, batch_queue) in enumerate(workers):
+            if pending[i]:
+                if not self._put_batch(workers, batch_queue, pending[i]):
+                    return
+            if not self._put_batch(workers, batch_queue, None):
+                return
+
+    def _put_batch(self, workers, batch_queue, keys):
+        """
+        Put a batch of keys on a worker's queue, waiting for room if it is
+        full. Returns ``False`` without waiting any longer if a worker fails,
+        since a failed worker no longer takes batches off its queue.
+        """
+        while True:
+            try:
+                batch_queue.put(keys, True, self.POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+            self._read_results(workers)
+            if self._errors:
+                return False
+
+    def _read_results(self, workers, timeout=0):
+        """
+        Handle the results the worker processes have sent so far, waiting up
+        to ``timeout`` seconds for the first one. Processes that die without
+        sending a result are counted as failed.
+        """
+        while True:
+            try:
+                kind, value = self._results.get(timeout > 0, timeout)
+            except Queue.Empty:
+                break
+            timeout = 0
+            if kind == 'emit':
+                self.emit(value)
+            elif kind == 'processed':
+                if self._progress is not None:
+                    self._progress.add(value)
+            elif kind == 'error':
+                self._errors.append(value)
+                self._running -= 1
+            else:
+                for task, state in zip(self.tasks, value):
+                    task.merge_state(state)
+                self._running -= 1
+        for worker, _batch_queue in workers:
+            # A process that exits normally has always sent its result
+            # first, but one that is killed hasn't.
+            if worker.exitcode not in (None, 0) and not self._errors:
+                self._errors.append(
+                    "Worker process %s exited with code %s." % (
+                        worker.pid, worker.exitcode))
+
+    def _worker_main(self, batch_queue, results):
+        # This runs in a forked copy of the runner, so we can replace
+        # things without affecting the parent process.
+        self.emit = lambda s: results.put(('emit', s))
+        # The parent stops us with SIGTERM if another process fails, so we
+        # mustn't inherit any handler it has installed for it.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            for task in self.tasks:
+                task.init(self, self.redis)
+                task.before()
+            for keys in iter(batch_queue.get, None):
+                self.process_keys(keys)
+                results.put(('processed', len(keys)))
+            results.put(('done', [task.get_state() for task in self.tasks]))
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+
 
 if __name__ == '__main__':
     try:
@@ -71,6 +71,15 @@ class PurgePoolCmd(PoolSubCmd):
         cfg.emit("  Done.")
 
 
+class MigratePoolsCmd(usage.Options):
+    def run(self, cfg):
+        cfg.emit("Migrating pools to the free tag sorted set ...")
+        for pool in sorted(cfg.tagpool.list_pools()):
+            moved = cfg.tagpool.migrate_pool(pool)
+            cfg.emit("  Moved %d free tag(s) for pool %s." % (moved, pool))
+        cfg.emit("  Done.")
+
+
 def key_ranges(keys):
     """Take a list of keys and convert them to a compact
     output string.
@@ -175,6 +184,9 @@ class Options(usage.Options):
          "List the free and inuse keys associated with a tag pool."],
         ["list-pools", None, ListPoolsCmd,
          "List all pools defined in config and in the tag store."],
+        ["migrate-pools", None, MigratePoolsCmd,
+         "Move free tags left in the free lists used by older versions of "
+         "the tag pool manager. Pools are also migrated when first used."],
         ["release-tag", None, ReleaseTagCmd,
          "Release a single tag, moves it from the in-use to the free set. "
          "Use only if you know what you are doing."]
@@ -1,14 +1,21 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
+import cPickle
+import hashlib
 import json
+import os
+import stat
+import tempfile
 import warnings
+from collections import OrderedDict, deque
 from copy import deepcopy
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, DeferredQueue, succeed,
+    maybeDeferred)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -17,11 +24,141 @@ from txamqp.protocol import AMQClient
 
 from vumi.errors import VumiError
 from vumi.message import Message
-from vumi.utils import load_class_by_string, vumi_resource_path, build_web_site
+from vumi.utils import (
+    load_class_by_string, vumi_resource_path, build_web_site,
+    listen_tcp_reuse_port)
 
 
 SPECS = {}
 
+# Bump this if the contents of pre-parsed spec files change.
+SPEC_CACHE_VERSION = 1
+
+
+class _PreparedSpecMethod(txamqp.spec.Method):
+    """
+    A spec method with its docstring worked out in advance. Formatting the
+    docstrings is most of the work txamqp does when it generates the
+    channel methods, so pre-parsed specs store them.
+    """
+
+    def docstring(self):
+        return self.prepared_docstring
+
+
+def get_spec_cache_key(specfile):
+    stat = os.stat(specfile)
+    return (SPEC_CACHE_VERSION, stat.st_mtime, stat.st_size)
+
+
+def get_spec_cache_dir():
+    """
+    Return the directory pre-parsed specs are stored in. This is
+    ``$VUMI_CACHE_DIR`` if it is set, and otherwise ``vumi`` in the user's
+    cache directory (``$XDG_CACHE_HOME`` or ``~/.cache``).
+    """
+    cache_dir = os.environ.get('VUMI_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    user_cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(user_cache_dir, 'vumi')
+
+
+def get_spec_cache_path(specfile):
+    """
+    Return the path of the pre-parsed copy of ``specfile``. Spec files with
+    the same name in different places are stored separately.
+    """
+    specfile = os.path.abspath(specfile)
+    return os.path.join(get_spec_cache_dir(), '%s-%s.pickle' % (
+        os.path.basename(specfile), hashlib.sha1(specfile).hexdigest()[:12]))
+
+
+def _is_private(stat_result):
+    """
+    Return ``True`` if a file or directory belongs to us and nobody else can
+    write to it.
+    """
+    return (stat_result.st_uid == os.getuid() and
+            not stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def read_spec_cache(specfile):
+    """
+    Return the pre-parsed copy of ``specfile`` with its channel methods
+    generated, or ``None`` if there isn't an up to date one.
+
+    Loading a pickle can run arbitrary code, so the file is ignored unless
+    both it and the spec cache directory belong to us and nobody else can
+    write to them.
+    """
+    cache_path = get_spec_cache_path(specfile)
+    try:
+        if not _is_private(os.stat(os.path.dirname(cache_path))):
+            return None
+        with open(cache_path, 'rb') as f:
+            if not _is_private(os.fstat(f.fileno())):
+                return None
+            key, spec = cPickle.load(f)
+    except Exception:
+        # A missing, unreadable or incompatible file is just a cache miss.
+        return None
+    if key != get_spec_cache_key(specfile):
+        return None
+    spec.post_load()
+    return spec
+
+
+def write_spec_cache(specfile, spec):
+    """
+    Store a pre-parsed copy of ``spec`` in the spec cache directory. Nothing
+    is written if the directory can't be created or isn't writable.
+    """
+    for klass in spec.classes:
+        for method in klass.methods:
+            if not isinstance(method, _PreparedSpecMethod):
+                method.prepared_docstring = method.docstring()
+                method.__class__ = _PreparedSpecMethod
+    # The generated module and class can't be pickled, so we leave them out
+    # and generate them again when the file is read.
+    generated = (spec.module, spec.klass)
+    del spec.module, spec.klass
+    try:
+        data = cPickle.dumps(
+            (get_spec_cache_key(specfile), spec), cPickle.HIGHEST_PROTOCOL)
+    finally:
+        spec.module, spec.klass = generated
+    cache_path = get_spec_cache_path(specfile)
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # Lots of workers may be starting at once, so the file is only put
+        # in place once it's complete.
+        os.rename(tmp_name, cache_path)
+    except (IOError, OSError):
+        pass
+
+
+def load_spec(specfile):
+    """
+    Load a txamqp spec, using the pre-parsed copy in the spec cache
+    directory if there is an up to date one and creating it if there isn't.
+
+    Parsing the spec XML and generating the channel methods takes a good
+    part of a worker's startup time, which adds up when lots of workers are
+    started at once.
+    """
+    spec = read_spec_cache(specfile)
+    if spec is None:
+        spec = txamqp.spec.load(specfile)
+        write_spec_cache(specfile, spec)
+    return spec
+
 
 def get_spec(specfile):
     """
@@ -32,7 +169,7 @@ def get_spec(specfile):
     decidedly happy test run time reduction.
     """
     if specfile not in SPECS:
-        SPECS[specfile] = txamqp.spec.load(specfile)
+        SPECS[specfile] = load_spec(specfile)
     return SPECS[specfile]
 
 
@@ -42,7 +179,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = WorkerDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -76,7 +213,45 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class WorkerDelegate(TwistedDelegate):
+    """
+    Handles the methods the broker sends to a client, including the
+    publisher confirms sent on channels in confirm mode.
+    """
+
+    def basic_ack(self, ch, msg):
+        self._publish_confirmed(ch, msg, True)
+
+    def basic_nack(self, ch, msg):
+        self._publish_confirmed(ch, msg, False)
+
+    def _publish_confirmed(self, ch, msg, acked):
+        window = getattr(ch, 'publish_confirm_window', None)
+        if window is None:
+            log.msg("Ignoring publish confirm on channel %r not in confirm"
+                    " mode." % (ch,))
+            return
+        window.confirm(msg.delivery_tag, msg.multiple, acked)
+
+
+class _PendingCall(object):
+    "Placeholder for a :meth:`WorkerAMQClient._call_once` result."
+
+    def __init__(self):
+        self.waiters = []
+
+
 class WorkerAMQClient(AMQClient):
+    # Publishers that don't need a channel of their own (see
+    # :meth:`get_publisher_channel`) are spread over this many channels.
+    PUBLISHER_CHANNELS = 4
+
+    def __init__(self, *args, **kwargs):
+        AMQClient.__init__(self, *args, **kwargs)
+        self._declared_exchanges = {}
+        self._publisher_channels = {}
+        self._next_publisher_channel = 0
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -106,13 +281,67 @@ class WorkerAMQClient(AMQClient):
         """
         return (max(self.channels) + 1) if self.channels else 0
 
+    def _call_once(self, cache, key, func, *args, **kw):
+        """
+        Call ``func`` the first time ``key`` is asked for and return a
+        deferred that fires with its result. Later calls share that result,
+        including calls made while the first one is still waiting. If the
+        call fails, the failure is passed on and the next call tries again.
+        """
+        if key in cache:
+            result = cache[key]
+            if isinstance(result, _PendingCall):
+                d = Deferred()
+                result.waiters.append(d)
+                return d
+            return succeed(result)
+
+        pending = cache[key] = _PendingCall()
+
+        def cb(result):
+            cache[key] = result
+            for d in pending.waiters:
+                d.callback(result)
+            return result
+
+        def eb(failure):
+            del cache[key]
+            for d in pending.waiters:
+                d.errback(failure)
+            return failure
+
+        return maybeDeferred(func, *args, **kw).addCallbacks(cb, eb)
+
+    def get_publisher_channel(self):
+        """
+        Return one of the channels shared by publishers on this connection.
+
+        Channels are opened as they're needed and handed out in turn, so at
+        most :attr:`PUBLISHER_CHANNELS` of them are ever opened. A shared
+        channel that has been closed is replaced with a new one.
+        """
+        index = self._next_publisher_channel
+        self._next_publisher_channel = (index + 1) % self.PUBLISHER_CHANNELS
+        channel = self._publisher_channels.get(index)
+        if getattr(channel, 'closed', False):
+            del self._publisher_channels[index]
+        return self._call_once(
+            self._publisher_channels, index, self.get_channel)
+
     def _declare_exchange(self, source, channel):
+        """
+        Declare the exchange ``source`` uses. Each exchange is only declared
+        once per connection, since the declaration doesn't change.
+        """
         # get the details for AMQP
         exchange_name = source.exchange_name
         exchange_type = source.exchange_type
         durable = source.durable
-        return channel.exchange_declare(exchange=exchange_name,
-                                        type=exchange_type, durable=durable)
+        return self._call_once(
+            self._declared_exchanges,
+            (exchange_name, exchange_type, durable),
+            channel.exchange_declare, exchange=exchange_name,
+            type=exchange_type, durable=durable)
 
     @inlineCallbacks
     def start_consumer(self, consumer_class, *args, **kwargs):
@@ -142,8 +371,8 @@ class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
-        # get a channel
-        channel = yield self.get_channel()
+        # get a channel, publishers never close theirs so they can share
+        channel = yield self.get_publisher_channel()
         # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
@@ -218,25 +447,54 @@ class Worker(MultiService, object):
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
             klass.message_class = message_class
-        return self.start_consumer(klass, callback)
+        d = self.start_consumer(klass, callback)
+        local_bus = self.get_local_message_bus()
+        if local_bus is not None:
+            d.addCallback(local_bus.register_consumer)
+        return d
 
     def start_consumer(self, consumer_class, *args, **kw):
         return self._amqp_client.start_consumer(consumer_class, *args, **kw)
 
+    def get_local_message_bus(self):
+        """
+        Return the :class:`LocalMessageBus` shared with the other workers in
+        this process, or ``None`` if there isn't one.
+        """
+        return getattr(self.parent, 'local_message_bus', None)
+
     @inlineCallbacks
-    def publish_to(self, routing_key):
-        channel = yield self._amqp_client.get_channel()
+    def publish_to(self, routing_key, confirm_window=None):
+        """
+        Return a :class:`DynamicPublisher` for ``routing_key``.
+
+        If ``confirm_window`` is set, the publisher gets a channel of its own
+        which is put into confirm mode and at most ``confirm_window``
+        published messages may be waiting for the broker to confirm them.
+        Otherwise the publisher shares a channel with other publishers.
+        """
+        if confirm_window:
+            # Confirms are counted per channel, so this one can't be shared.
+            channel = yield self._amqp_client.get_channel()
+        else:
+            channel = yield self._amqp_client.get_publisher_channel()
         publisher = DynamicPublisher(channel, routing_key)
+        publisher.local_bus = self.get_local_message_bus()
         yield self._amqp_client._declare_exchange(publisher, channel)
+        if confirm_window:
+            yield publisher.enable_confirms(confirm_window)
         # return the publisher
         returnValue(publisher)
 
     def start_publisher(self, publisher_class, *args, **kw):
         return self._amqp_client.start_publisher(publisher_class, *args, **kw)
 
-    def start_web_resources(self, resources, port, site_class=None):
+    def start_web_resources(self, resources, port, site_class=None,
+                            reuse_port=False):
         resources = dict((path, resource) for resource, path in resources)
         site_factory = build_web_site(resources, site_class=site_class)
+        if reuse_port:
+            return listen_tcp_reuse_port(port, site_factory, reactor=reactor)
         return reactor.listenTCP(port, site_factory)
 
 
@@ -244,6 +502,75 @@ class QueueCloseMarker(object):
     "This is a marker for closing consumer queues."
 
 
+class LocalMessageBus(object):
+    """
+    Hands messages from publishers to consumers in the same process without
+    sending them through the AMQP broker.
+
+    A message published to a routing key is given to a local consumer of
+    that routing key's queue if there is one that isn't paused and has fewer
+    than ``queue_size`` messages waiting. The message object is copied rather
+    than encoded and decoded. If no local consumer can take the message, it
+    is published over AMQP as usual, so remote consumers still receive
+    messages while the local consumers are busy or paused.
+
+    Only consumers of ``direct`` exchanges whose queue is named after their
+    routing key are used. These are the queues :meth:`Worker.consume`
+    declares by default. Local consumers are preferred over remote consumers
+    of the same queue.
+
+    Messages delivered locally aren't stored by the broker. A message that
+    is being processed when the process stops is lost. Messages still
+    waiting when their consumer stops are published over AMQP instead.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._consumers = {}
+
+    def _key(self, exchange_name, routing_key):
+        return (exchange_name, routing_key)
+
+    def register_consumer(self, consumer):
+        """
+        Start delivering local messages to ``consumer``. Returns the consumer
+        so that this can be used as a callback.
+        """
+        if (consumer.exchange_type == 'direct' and
+                consumer.queue_name == consumer.routing_key):
+            consumer.start_local_delivery(self)
+            key = self._key(consumer.exchange_name, consumer.routing_key)
+            self._consumers.setdefault(key, []).append(consumer)
+        return consumer
+
+    def unregister_consumer(self, consumer):
+        key = self._key(consumer.exchange_name, consumer.routing_key)
+        consumers = self._consumers.get(key, [])
+        if consumer in consumers:
+            consumers.remove(consumer)
+        if not consumers:
+            self._consumers.pop(key, None)
+
+    def publish_message(self, publisher, message):
+        """
+        Give ``message`` to a local consumer of ``publisher``'s routing key.
+
+        Returns ``True`` if a local consumer accepted the message and
+        ``False`` if it should be published over AMQP instead.
+        """
+        consumers = self._consumers.get(
+            self._key(publisher.exchange_name, publisher.routing_key))
+        if not consumers:
+            return False
+        for _ in range(len(consumers)):
+            # Rotate the consumers so that they take turns.
+            consumer = consumers.pop(0)
+            consumers.append(consumer)
+            if consumer.deliver_local(message, publisher):
+                return True
+        return False
+
+
 class Consumer(object):
 
     exchange_name = "vumi"
@@ -264,6 +591,8 @@ class Consumer(object):
         self.keep_consuming = False
         self.queue = None
         self._consumer_tag = None
+        self.local_bus = None
+        self._local_queue = None
 
     @inlineCallbacks
     def start(self):
@@ -294,6 +623,54 @@ class Consumer(object):
             # garbage-collected, because that might only happen later on pypy.
             log.err()
 
+    def start_local_delivery(self, local_bus):
+        """
+        Accept messages from publishers in the same process through
+        ``local_bus``.
+        """
+        self.local_bus = local_bus
+        self._local_queue = DeferredQueue()
+        self._read_local_messages()
+
+    def deliver_local(self, message, publisher):
+        """
+        Queue a message from a local publisher. Returns ``False`` if the
+        message wasn't accepted because this consumer is paused, stopping or
+        has too many messages waiting.
+        """
+        if self.paused or not self.keep_consuming:
+            return False
+        if len(self._local_queue.pending) >= self.local_bus.queue_size:
+            return False
+        self._local_queue.put((message, publisher))
+        return True
+
+    @inlineCallbacks
+    def _read_local_messages(self):
+        while True:
+            item = yield self._local_queue.get()
+            if isinstance(item, QueueCloseMarker):
+                break
+            if self.paused:
+                yield self._unpause_d
+            message, _publisher = item
+            try:
+                yield self.consume_local(message)
+            except Exception:
+                # An error in one message shouldn't stop local delivery.
+                log.err(None, "Error consuming local message: %r" % (
+                    message,))
+
+    def _stop_local_delivery(self):
+        self.local_bus.unregister_consumer(self)
+        pending = self._local_queue.pending[:]
+        del self._local_queue.pending[:]
+        self._local_queue.put(QueueCloseMarker())
+        # Anything still waiting goes back through the publisher, which will
+        # send it to another local consumer or over AMQP.
+        for message, publisher in pending:
+            publisher.publish_message(message)
+
     @inlineCallbacks
     def _channel_consume(self):
         if self._consumer_tag is not None:
@@ -350,6 +727,18 @@ class Consumer(object):
                     'Not acknowledging AMQ message' % result)
         self._check_notify()
 
+    @inlineCallbacks
+    def consume_local(self, message):
+        self._in_progress += 1
+        try:
+            # Copy the payload so that the publisher and consumer don't share
+            # mutable state, as they wouldn't if the message went via AMQP.
+            yield self.consume_message(self.message_class(
+                _process_fields=False, **deepcopy(message.payload)))
+        finally:
+            self._in_progress -= 1
+            self._check_notify()
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
@@ -358,6 +747,8 @@ class Consumer(object):
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        if self.local_bus is not None:
+            self._stop_local_delivery()
         yield self.pause()
         # This actually closes the channel on the server
         yield self.channel.channel_close()
@@ -383,6 +774,100 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class PublishConfirmWindow(object):
+    """
+    Tracks the messages published on a channel in confirm mode that the
+    broker hasn't confirmed yet.
+
+    At most ``size`` messages may be unconfirmed. Messages published while
+    the window is full are held until the broker confirms enough earlier
+    ones. Listeners added with :meth:`add_listener` are called with ``True``
+    when the window fills up and with ``False`` once it has drained to half
+    its size, so that they can stop producing messages in the meantime.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.full = False
+        self._next_tag = 1
+        self._unconfirmed = OrderedDict()
+        self._waiting = deque()
+        self._listeners = []
+        self._drained = []
+
+    def __len__(self):
+        return len(self._unconfirmed)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _set_full(self, full):
+        self.full = full
+        for listener in self._listeners:
+            listener(full)
+
+    def publish(self, send, description):
+        """
+        Call ``send`` to publish a message, or hold it until there is room
+        in the window. Returns a deferred that fires once it has been sent.
+
+        ``description`` is used to log the message if the broker rejects it.
+        """
+        if self._waiting or len(self._unconfirmed) >= self.size:
+            d = Deferred()
+            self._waiting.append((send, description, d))
+            return d
+        self._send(send, description)
+        return succeed(None)
+
+    def _send(self, send, description):
+        # The broker numbers the messages published in confirm mode from 1.
+        self._unconfirmed[self._next_tag] = description
+        self._next_tag += 1
+        send()
+        if not self.full and len(self._unconfirmed) >= self.size:
+            self._set_full(True)
+
+    def confirm(self, delivery_tag, multiple, acked):
+        """
+        Handle a Basic.Ack (``acked=True``) or Basic.Nack from the broker.
+        """
+        if multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [delivery_tag]
+        for tag in tags:
+            description = self._unconfirmed.pop(tag, None)
+            if not acked and description is not None:
+                log.err("Broker rejected published message: %s" % (
+                    description,))
+        while self._waiting and len(self._unconfirmed) < self.size:
+            send, description, d = self._waiting.popleft()
+            self._send(send, description)
+            d.callback(None)
+        if self.full and len(self._unconfirmed) <= self.size // 2:
+            self._set_full(False)
+        if not self._unconfirmed:
+            drained, self._drained = self._drained, []
+            for d in drained:
+                d.callback(None)
+
+    def wait_for_confirms(self):
+        """
+        Return a deferred that fires once every message published so far has
+        been confirmed.
+        """
+        if not self._unconfirmed and not self._waiting:
+            return succeed(None)
+        d = Deferred()
+        self._drained.append(d)
+        return d
+
+
 class _Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -441,26 +926,54 @@ class Publisher(_Publisher):
 class DynamicPublisher(_Publisher):
     """
     A single-routing-key publisher.
+
+    If :attr:`local_bus` is set, messages are given to consumers in the same
+    process through it when possible.
+
+    If :meth:`enable_confirms` has been called, :meth:`publish_message`
+    returns a deferred that waits while :attr:`confirm_window` is full
+    instead of one that has already fired.
     """
 
     durable = True
+    local_bus = None
+    confirm_window = None
 
     def __init__(self, channel, routing_key):
         self.channel = channel
         self.check_routing_key(routing_key)
         self.routing_key = routing_key
 
+    @inlineCallbacks
+    def enable_confirms(self, window_size):
+        """
+        Put the channel into confirm mode, with at most ``window_size``
+        messages waiting to be confirmed by the broker.
+        """
+        self.confirm_window = PublishConfirmWindow(window_size)
+        self.channel.publish_confirm_window = self.confirm_window
+        yield self.channel.confirm_select(nowait=False)
+
     def publish_message(self, message):
-        self.publish_raw(message.to_json())
-        return succeed(message)
+        if (self.local_bus is not None and
+                self.local_bus.publish_message(self, message)):
+            return succeed(message)
+        d = self.publish_raw(message.to_json())
+        if d is None:
+            return succeed(message)
+        return d.addCallback(lambda _: message)
 
     def publish_json(self, data):
-        self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
+        return self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
 
     def publish_raw(self, data):
         amq_message = Content(data)
         amq_message['delivery mode'] = self.delivery_mode
-        self._publish(amq_message)
+        if self.confirm_window is None:
+            self._publish(amq_message)
+            return None
+        return self.confirm_window.publish(
+            lambda: self._publish(amq_message), data)
 
     def _publish(self, message):
         return self.channel.basic_publish(
@@ -1,19 +1,21 @@
 # -*- test-case-name: vumi.tests.test_servicemaker -*-
 import os
 import sys
+import time
 import warnings
+from contextlib import contextmanager
 
 import yaml
 from zope.interface import implements
-from twisted.python import usage
+from twisted.python import usage, log
 from twisted.application.service import IServiceMaker
 from twisted.plugin import IPlugin
 
-from vumi.service import WorkerCreator
-from vumi.utils import (load_class_by_string,
-                        generate_worker_id)
 from vumi.errors import VumiError
-from vumi.sentry import SentryLoggerService
+
+# twistd imports this module to find its plugins whatever it's been asked to
+# do, so the modules that are only needed to start a worker (vumi.service,
+# vumi.utils and vumi.sentry) are imported when they're used.
 
 
 class SafeLoaderWithInclude(yaml.SafeLoader):
@@ -56,6 +58,36 @@ def read_yaml_config(config_file, optional=True):
         return yaml.load(stream, Loader=SafeLoaderWithInclude)
 
 
+class StartupProfiler(object):
+    """
+    Times the phases of starting a worker for the ``--profile-startup``
+    option.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.phases = []
+
+    def record(self, name, start):
+        self.phases.append((name, self.clock() - start))
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def report(self):
+        lines = ["Worker startup profile:"]
+        for name, elapsed in self.phases:
+            lines.append("  %s: %.3fs" % (name, elapsed))
+        lines.append("  total: %.3fs" % (
+            sum(elapsed for _, elapsed in self.phases),))
+        return "\n".join(lines)
+
+
 class VumiOptions(usage.Options):
     """
     Options global to everything vumi.
@@ -112,6 +144,8 @@ class StartWorkerOptions(VumiOptions):
     optFlags = [
         ["worker-help", None,
          "Print out a usage message for the worker-class and exit"],
+        ["profile-startup", None,
+         "Log how long each phase of starting the worker takes"],
         ]
 
     optParameters = [
@@ -144,6 +178,7 @@ class StartWorkerOptions(VumiOptions):
 
     def do_worker_help(self):
         """Print out a usage message for the worker-class and exit"""
+        from vumi.utils import load_class_by_string
         worker_class = load_class_by_string(self.worker_class)
         self.emit(worker_class.__doc__)
         config_class = getattr(worker_class, 'CONFIG_CLASS', None)
@@ -181,14 +216,19 @@ class StartWorkerOptions(VumiOptions):
         return self.opts.pop("maxthreads")
 
     def postOptions(self):
-        VumiOptions.postOptions(self)
+        self.profile_startup = self.opts.pop('profile-startup')
+        self.startup_profiler = StartupProfiler()
+
+        with self.startup_profiler.phase("read vumi config"):
+            VumiOptions.postOptions(self)
 
         self.worker_class = self.get_worker_class()
 
         if self.opts.pop('worker-help'):
             self.do_worker_help()
 
-        self.worker_config = self.get_worker_config()
+        with self.startup_profiler.phase("read worker config"):
+            self.worker_config = self.get_worker_config()
 
         self.maxthreads = self.get_maxthreads()
 
@@ -209,7 +249,37 @@ class VumiWorkerServiceMaker(object):
         if maxthreads is not None:
             reactor.suggestThreadPoolSize(maxthreads)
 
+    def profile_worker_start(self, worker, profiler):
+        """
+        Add the time it takes ``worker`` to connect to AMQP and start up to
+        ``profiler`` and log its report once the worker has started.
+        """
+        from twisted.internet.defer import maybeDeferred
+        amqp_connected = worker._amqp_connected
+        connect_start = profiler.clock()
+
+        def profiled_amqp_connected(amqp_client):
+            # Only the first connection is part of starting up.
+            worker._amqp_connected = amqp_connected
+            profiler.record("connect to AMQP", connect_start)
+            start = profiler.clock()
+            d = maybeDeferred(amqp_connected, amqp_client)
+
+            def report(result):
+                profiler.record("start worker", start)
+                log.msg(profiler.report())
+                return result
+            return d.addCallback(report)
+
+        worker._amqp_connected = profiled_amqp_connected
+
     def makeService(self, options):
+        profiler = options.startup_profiler
+        with profiler.phase("import vumi"):
+            from vumi.service import WorkerCreator, get_spec
+            from vumi.utils import (
+                load_class_by_string, generate_worker_id, vumi_resource_path)
+
         sentry_dsn = options.vumi_options.pop('sentry', None)
         class_name = options.worker_class.rpartition('.')[2].lower()
         logger_name = options.worker_config.get('worker_name', class_name)
@@ -218,15 +288,25 @@ class VumiWorkerServiceMaker(object):
 
         self.set_maxthreads(options.maxthreads)
 
-        worker_creator = WorkerCreator(options.vumi_options)
-        worker = worker_creator.create_worker(options.worker_class,
-                                              options.worker_config)
+        with profiler.phase("import worker class"):
+            worker_class = load_class_by_string(options.worker_class)
+        with profiler.phase("load AMQP spec"):
+            get_spec(vumi_resource_path(options.vumi_options['specfile']))
+        with profiler.phase("create worker"):
+            worker_creator = WorkerCreator(options.vumi_options)
+            worker = worker_creator.create_worker_by_class(
+                worker_class, options.worker_config)
 
         if sentry_dsn is not None:
-            sentry_service = SentryLoggerService(sentry_dsn,
-                                                 logger_name,
-                                                 worker_id)
-            worker.addService(sentry_service)
+            with profiler.phase("set up sentry"):
+                from vumi.sentry import SentryLoggerService
+                sentry_service = SentryLoggerService(sentry_dsn,
+                                                     logger_name,
+                                                     worker_id)
+                worker.addService(sentry_service)
+
+        if options.profile_startup:
+            self.profile_worker_start(worker, profiler)
 
         return worker
 
@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, WorkerDelegate
 from vumi.message import Message as VumiMessage
 
 
@@ -93,6 +92,7 @@ class FakeAMQPBroker(object):
         self.channels = []
         self.dispatched = {}
         self._delivering = None
+        self._held_confirms = None
 
     def _get_queue(self, queue):
         assert queue in self.queues
@@ -163,6 +163,29 @@ class FakeAMQPBroker(object):
     def basic_get(self, queue):
         return self._get_queue(queue).get_message()
 
+    def confirm_publish(self, channel, delivery_tag):
+        if self._held_confirms is not None:
+            self._held_confirms.append((channel, delivery_tag))
+        else:
+            channel.send_confirm(delivery_tag, True)
+
+    def hold_confirms(self):
+        """
+        Stop confirming messages published on channels in confirm mode until
+        :meth:`release_confirms` is called.
+        """
+        if self._held_confirms is None:
+            self._held_confirms = []
+
+    def release_confirms(self, acked=True):
+        """
+        Confirm all held messages, with Basic.Ack if ``acked`` is true and
+        Basic.Nack otherwise, and stop holding confirms.
+        """
+        held, self._held_confirms = self._held_confirms or [], None
+        for channel, delivery_tag in held:
+            channel.send_confirm(delivery_tag, acked)
+
     def basic_ack(self, queue, delivery_tag):
         self._get_queue(queue).ack(delivery_tag)
         return None
@@ -295,6 +318,9 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        # The channel object publishers use, which may be a wrapper.
+        self.wrapper = self
+        self.confirm_tag = None
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -342,7 +368,23 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self.confirm_tag is not None:
+            self.confirm_tag += 1
+            self.broker.confirm_publish(self, self.confirm_tag)
+        return resp
+
+    def confirm_select(self, nowait=False):
+        self.confirm_tag = 0
+        return Message(mkMethod("select-ok", 11))
+
+    def send_confirm(self, delivery_tag, acked):
+        name, index = ('ack', 80) if acked else ('nack', 120)
+        msg = Message(mkMethod(name, index), [
+            ('delivery_tag', delivery_tag),
+            ('multiple', False),
+        ])
+        getattr(self.delegate, 'basic_%s' % (name,))(self.wrapper, msg)
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
@@ -480,7 +522,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, WorkerDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
@@ -509,6 +551,7 @@ class FakeAMQPChannelWrapper(object):
 
     def __init__(self, id, client):
         self._fake_channel = FakeAMQPChannel(id, client)
+        self._fake_channel.wrapper = self
         self.client = client
 
     def __repr__(self):
@@ -554,3 +597,6 @@ class FakeAMQPChannelWrapper(object):
 
     def basic_get(self, queue):
         return self._fake_channel.basic_get(queue)
+
+    def confirm_select(self, nowait=False):
+        return self._fake_channel.confirm_select(nowait)
@@ -271,12 +271,13 @@ class FakeHttpServer(object):
     def endpoint(self):
         return self.fake_server.endpoint
 
-    def get_agent(self, reactor=None, contextFactory=None):
+    def get_agent(self, reactor=None, contextFactory=None, pool=None):
         """
         Returns an IAgent that makes requests to this fake server.
         """
         return ProxyAgentWithContext(
-            self.endpoint, reactor=reactor, contextFactory=contextFactory)
+            self.endpoint, reactor=reactor, contextFactory=contextFactory,
+            pool=pool)
 
 
 class HandlerResource(Resource):
@@ -297,6 +298,8 @@ class HandlerResource(Resource):
 
 
 class ProxyAgentWithContext(ProxyAgent):
-    def __init__(self, endpoint, reactor=None, contextFactory=None):
+    def __init__(self, endpoint, reactor=None, contextFactory=None,
+                 pool=None):
         self.contextFactory = contextFactory  # To assert on in tests.
-        super(ProxyAgentWithContext, self).__init__(endpoint, reactor=reactor)
+        super(ProxyAgentWithContext, self).__init__(
+            endpoint, reactor=reactor, pool=pool)
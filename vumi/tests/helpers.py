@@ -1703,6 +1703,21 @@ class PersistenceHelper(object):
             return self._get_sync_redis_manager(config)
         return self._get_async_redis_manager(config)
 
+    @proxyable
+    def get_fake_redis(self, redis_manager):
+        """
+        Return the :class:`~vumi.persist.fake_redis.FakeRedis` behind a Redis
+        manager, so that its round trips can be counted.
+
+        The test is skipped if the manager is backed by a real Redis server.
+        """
+        from vumi.persist.fake_redis import FakeRedis
+
+        client = redis_manager._client
+        if not isinstance(client, FakeRedis):
+            raise SkipTest("Round trips can only be counted with FakeRedis.")
+        return client
+
     def _get_async_redis_manager(self, config):
         from vumi.persist.txredis_manager import TxRedisManager
 
@@ -31,14 +31,16 @@ class BaseConnectorTestCase(VumiTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     confirm_window=None):
         if worker is None:
             worker = yield self.worker_helper.get_worker(DummyWorker, {})
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares,
+                                         confirm_window=confirm_window)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -144,6 +146,31 @@ class TestBaseConnector(BaseConnectorTestCase):
         publisher = yield conn._setup_publisher('outbound')
         self.assertEqual(publisher.routing_key, 'foo.outbound')
 
+    @inlineCallbacks
+    def test_setup_publisher_with_confirms(self):
+        conn = yield self.mk_connector(connector_name='foo', confirm_window=5)
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.confirm_window.size, 5)
+
+    @inlineCallbacks
+    def test_full_confirm_window_pauses_consumers(self):
+        conn, consumer = yield self.mk_consumer(
+            connector_name='foo', confirm_window=2)
+        paused_consumer = yield conn._setup_consumer(
+            'event', TransportUserMessage, lambda msg: None)
+        yield conn._setup_publisher('outbound')
+        consumer.unpause()
+        self.worker_helper.broker.hold_confirms()
+        for _ in range(2):
+            yield conn._publish_message(
+                'outbound', self.msg_helper.make_outbound("out"), None)
+        self.assertTrue(consumer.paused)
+        self.assertTrue(paused_consumer.paused)
+        self.worker_helper.broker.release_confirms()
+        self.assertFalse(consumer.paused)
+        # Consumers that were already paused are left alone.
+        self.assertTrue(paused_consumer.paused)
+
     @inlineCallbacks
     def test_setup_consumer(self):
         conn, consumer = yield self.mk_consumer(connector_name='foo')
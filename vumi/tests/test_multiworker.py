@@ -31,6 +31,24 @@ class ToyWorker(Worker):
             message.reply(''.join(reversed(message['content']))))
 
 
+class ToySink(Worker):
+    received = []
+
+    def startService(self):
+        self._d = Deferred()
+        return super(ToySink, self).startService()
+
+    @inlineCallbacks
+    def startWorker(self):
+        self.consumer = yield self.consume(
+            self.config['routing_key'], self.process_message,
+            message_class=TransportUserMessage)
+        self._d.callback(None)
+
+    def process_message(self, message):
+        self.received.append(message)
+
+
 class StubbedMultiWorker(MultiWorker):
     def WORKER_CREATOR(self, options):
         worker_creator = StubbedWorkerCreator(options)
@@ -62,6 +80,7 @@ class TestMultiWorker(VumiTestCase):
 
     def clear_events(self):
         ToyWorker.events[:] = []
+        ToySink.received[:] = []
 
     def dispatch(self, msg, connector_name):
         return self.worker_helper.dispatch_inbound(msg, connector_name)
@@ -116,3 +135,45 @@ class TestMultiWorker(VumiTestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+    def mk_local_config(self, **sink_config):
+        sink_config.setdefault('routing_key', 'worker1.outbound')
+        return {
+            'workers': {
+                'worker1': "%s.ToyWorker" % (__name__,),
+                'sink': "%s.ToySink" % (__name__,),
+            },
+            'sink': sink_config,
+            'local_delivery': True,
+        }
+
+    def get_sink_contents(self):
+        return [msg['content'] for msg in ToySink.received]
+
+    @inlineCallbacks
+    def test_no_local_delivery_by_default(self):
+        config = self.mk_local_config()
+        del config['local_delivery']
+        worker = yield self.get_multiworker(config)
+        self.assertEqual(worker.local_message_bus, None)
+        yield self.dispatch(self.msg_helper.make_inbound("foo"), "worker1")
+        self.assertEqual(['oof'], self.get_replies("worker1"))
+        self.assertEqual(['oof'], self.get_sink_contents())
+
+    @inlineCallbacks
+    def test_local_delivery(self):
+        yield self.get_multiworker(self.mk_local_config())
+        yield self.dispatch(self.msg_helper.make_inbound("foo"), "worker1")
+        # The reply skipped the broker.
+        self.assertEqual([], self.get_replies("worker1"))
+        self.assertEqual(['oof'], self.get_sink_contents())
+        [msg] = ToySink.received
+        self.assertTrue(isinstance(msg, TransportUserMessage))
+
+    @inlineCallbacks
+    def test_local_delivery_without_local_consumer(self):
+        yield self.get_multiworker(
+            self.mk_local_config(routing_key='other.outbound'))
+        yield self.dispatch(self.msg_helper.make_inbound("foo"), "worker1")
+        self.assertEqual(['oof'], self.get_replies("worker1"))
+        self.assertEqual([], self.get_sink_contents())
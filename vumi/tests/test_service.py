@@ -1,11 +1,21 @@
 import json
+import os
+import shutil
+import tempfile
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.application.service import MultiService
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+
+import txamqp
 
 from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.service import (
+    Worker, WorkerCreator, LocalMessageBus, PublishConfirmWindow, load_spec,
+    get_spec_cache_dir, get_spec_cache_path)
+from vumi.utils import vumi_resource_path
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.tests.utils import LogCatcher
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
@@ -104,6 +114,308 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_to_with_confirms(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm_window=1)
+        self.assertEqual(publisher.confirm_window.size, 1)
+        msg = yield publisher.publish_message(Message(key=0))
+        self.assertEqual(msg, Message(key=0))
+        self.assertEqual(len(publisher.confirm_window), 0)
+
+        broker = self.worker_helper.broker
+        broker.hold_confirms()
+        d1 = publisher.publish_message(Message(key=1))
+        d2 = publisher.publish_message(Message(key=2))
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        self.assertEqual(
+            len(broker.get_dispatched('vumi', 'test.routing.key')), 2)
+        broker.release_confirms()
+        self.assertTrue(d2.called)
+        self.assertEqual(
+            len(broker.get_dispatched('vumi', 'test.routing.key')), 3)
+        broker.release_confirms()
+        self.assertEqual(len(publisher.confirm_window), 0)
+
+    @inlineCallbacks
+    def test_publishers_share_channels(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        client = worker._amqp_client
+        publishers = []
+        for i in range(client.PUBLISHER_CHANNELS * 2):
+            publisher = yield worker.publish_to('test.routing.key.%d' % (i,))
+            publishers.append(publisher)
+        channels = set(publisher.channel for publisher in publishers)
+        self.assertEqual(len(channels), client.PUBLISHER_CHANNELS)
+        self.assertEqual(
+            len(self.worker_helper.broker.channels),
+            client.PUBLISHER_CHANNELS)
+
+        publishers[0].publish_message(Message(key=0))
+        publishers[-1].publish_message(Message(key=1))
+        [msg0] = self.worker_helper.broker.get_dispatched(
+            'vumi', 'test.routing.key.0')
+        self.assertEqual(msg0.body, '{"key": 0}')
+        [msg1] = self.worker_helper.broker.get_dispatched(
+            'vumi', 'test.routing.key.%d' % (len(publishers) - 1,))
+        self.assertEqual(msg1.body, '{"key": 1}')
+
+    @inlineCallbacks
+    def test_closed_shared_channel_replaced(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        client = worker._amqp_client
+        client.PUBLISHER_CHANNELS = 1
+        publisher1 = yield worker.publish_to('test.routing.key')
+        publisher2 = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher1.channel, publisher2.channel)
+        publisher2.channel.closed = True
+        publisher3 = yield worker.publish_to('test.routing.key')
+        self.assertNotEqual(publisher3.channel, publisher2.channel)
+
+    @inlineCallbacks
+    def test_confirm_publisher_gets_own_channel(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        client = worker._amqp_client
+        client.PUBLISHER_CHANNELS = 1
+        publisher1 = yield worker.publish_to('test.routing.key')
+        publisher2 = yield worker.publish_to(
+            'test.routing.key', confirm_window=1)
+        publisher3 = yield worker.publish_to('test.routing.key')
+        self.assertNotEqual(publisher2.channel, publisher1.channel)
+        self.assertEqual(publisher3.channel, publisher1.channel)
+
+    @inlineCallbacks
+    def test_exchange_declared_once(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        broker = self.worker_helper.broker
+        declared = []
+        pending = Deferred()
+        exchange_declare = broker.exchange_declare
+
+        def wait_and_declare(*args):
+            declared.append(args)
+            return pending.addCallback(lambda _: exchange_declare(*args))
+
+        self.patch(broker, 'exchange_declare', wait_and_declare)
+        d1 = worker.publish_to('test.routing.key.1')
+        d2 = worker.publish_to('test.routing.key.2')
+        self.assertFalse(d1.called)
+        self.assertFalse(d2.called)
+        pending.callback(None)
+        yield d1
+        yield d2
+        yield worker.publish_to('test.routing.key.3')
+        yield worker.consume('test.routing.key.4', lambda msg: None)
+        self.assertEqual(declared, [('vumi', 'direct', True)])
+
+    @inlineCallbacks
+    def test_failed_exchange_declaration_retried(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        broker = self.worker_helper.broker
+        exchange_declare = broker.exchange_declare
+
+        def fail_declare(*args):
+            raise ValueError("oops")
+
+        self.patch(broker, 'exchange_declare', fail_declare)
+        yield self.assertFailure(
+            worker.publish_to('test.routing.key'), ValueError)
+        self.patch(broker, 'exchange_declare', exchange_declare)
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.routing_key, 'test.routing.key')
+
+
+class TestPublishConfirmWindow(VumiTestCase):
+    def setUp(self):
+        self.window = PublishConfirmWindow(4)
+        self.sent = []
+        self.changes = []
+        self.window.add_listener(self.changes.append)
+
+    def publish(self, n):
+        return self.window.publish(lambda: self.sent.append(n), str(n))
+
+    def test_publish(self):
+        d = self.publish(0)
+        self.assertTrue(d.called)
+        self.assertEqual(self.sent, [0])
+        self.assertEqual(len(self.window), 1)
+        self.window.confirm(1, False, True)
+        self.assertEqual(len(self.window), 0)
+
+    def test_window_full(self):
+        ds = [self.publish(n) for n in range(6)]
+        self.assertEqual([d.called for d in ds], [True] * 4 + [False] * 2)
+        self.assertEqual(self.sent, [0, 1, 2, 3])
+        self.assertEqual(self.changes, [True])
+        self.window.confirm(1, False, True)
+        self.assertEqual(self.sent, [0, 1, 2, 3, 4])
+        self.assertTrue(ds[4].called)
+        self.assertFalse(ds[5].called)
+        self.assertEqual(self.changes, [True])
+        self.window.confirm(2, False, True)
+        self.window.confirm(3, False, True)
+        self.assertTrue(ds[5].called)
+        self.assertEqual(self.changes, [True])
+        self.window.confirm(4, False, True)
+        # The window is at half its size.
+        self.assertEqual(len(self.window), 2)
+        self.assertEqual(self.changes, [True, False])
+        self.assertFalse(self.window.full)
+
+    def test_confirm_multiple(self):
+        for n in range(4):
+            self.publish(n)
+        self.window.confirm(3, True, True)
+        self.assertEqual(len(self.window), 1)
+        self.window.confirm(4, True, True)
+        self.assertEqual(len(self.window), 0)
+
+    def test_nack(self):
+        self.publish(0)
+        with LogCatcher() as lc:
+            self.window.confirm(1, False, False)
+        self.assertEqual(len(self.window), 0)
+        [err] = lc.errors
+        self.assertTrue(
+            "Broker rejected published message: 0" in err['message'][0])
+
+    def test_wait_for_confirms(self):
+        self.assertTrue(self.window.wait_for_confirms().called)
+        self.publish(0)
+        self.publish(1)
+        d = self.window.wait_for_confirms()
+        self.window.confirm(1, False, True)
+        self.assertFalse(d.called)
+        self.window.confirm(2, False, True)
+        self.assertTrue(d.called)
+
+
+class TestLocalMessageBus(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.bus = LocalMessageBus(queue_size=1)
+
+    @inlineCallbacks
+    def get_worker(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        parent = MultiService()
+        parent.local_message_bus = self.bus
+        worker.setServiceParent(parent)
+        returnValue(worker)
+
+    def get_dispatched(self):
+        return self.worker_helper.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+
+    @inlineCallbacks
+    def test_local_delivery(self):
+        worker = yield self.get_worker()
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = Message(key="value")
+        yield publisher.publish_message(msg)
+        self.assertEqual(log, [msg])
+        self.assertFalse(log[0] is msg)
+        self.assertFalse(log[0].payload is msg.payload)
+        self.assertEqual(self.get_dispatched(), [])
+
+    @inlineCallbacks
+    def test_local_delivery_error(self):
+        worker = yield self.get_worker()
+        log = []
+
+        def consume_func(msg):
+            log.append(msg)
+            if msg['key'] == 0:
+                raise ValueError("Bad message")
+
+        yield worker.consume('test.routing.key', consume_func)
+        publisher = yield worker.publish_to('test.routing.key')
+        with LogCatcher() as lc:
+            for i in range(3):
+                yield publisher.publish_message(Message(key=i))
+                yield self.worker_helper.kick_delivery()
+        [err] = lc.errors
+        self.assertTrue(
+            "Error consuming local message" in err['why'])
+        self.flushLoggedErrors(ValueError)
+        # Later messages are still delivered locally.
+        self.assertEqual([msg['key'] for msg in log], [0, 1, 2])
+        self.assertEqual(self.get_dispatched(), [])
+
+    @inlineCallbacks
+    def test_no_local_consumer(self):
+        worker = yield self.get_worker()
+        log = []
+        yield worker.consume(
+            'test.routing.key', log.append, queue_name='other.queue')
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        [published_msg] = self.get_dispatched()
+        self.assertEqual(published_msg.body, '{"key": "value"}')
+
+    @inlineCallbacks
+    def test_paused_consumer(self):
+        worker = yield self.get_worker()
+        log = []
+        consumer = yield worker.consume('test.routing.key', log.append)
+        yield consumer.pause()
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(log, [])
+        self.assertEqual(len(self.get_dispatched()), 1)
+        consumer.unpause()
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(log, [Message(key="value")])
+
+    @inlineCallbacks
+    def test_consumer_queue_full(self):
+        worker = yield self.get_worker()
+        log = []
+        consume_d = Deferred()
+
+        def consume_func(msg):
+            log.append(msg)
+            return consume_d
+
+        consumer = yield worker.consume('test.routing.key', consume_func)
+        publisher = yield worker.publish_to('test.routing.key')
+        for i in range(3):
+            yield publisher.publish_message(Message(key=i))
+        # The first message is in progress, the second is waiting and the
+        # third is sent to the broker.
+        self.assertEqual(log, [Message(key=0)])
+        self.assertEqual(consumer._in_progress, 1)
+        [published_msg] = self.get_dispatched()
+        self.assertEqual(published_msg.body, '{"key": 2}')
+        consume_d.callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(sorted(msg['key'] for msg in log), [0, 1, 2])
+        self.assertEqual(consumer._in_progress, 0)
+
+    @inlineCallbacks
+    def test_stopped_consumer_republishes_waiting_messages(self):
+        worker = yield self.get_worker()
+        consume_d = Deferred()
+        consumer = yield worker.consume(
+            'test.routing.key', lambda msg: consume_d)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key=0))
+        yield publisher.publish_message(Message(key=1))
+        self.assertEqual(self.get_dispatched(), [])
+        stop_d = consumer.stop()
+        [published_msg] = self.get_dispatched()
+        self.assertEqual(published_msg.body, '{"key": 1}')
+        consume_d.callback(None)
+        yield stop_d
+        # Later messages go to the broker.
+        yield publisher.publish_message(Message(key=2))
+        self.assertEqual(len(self.get_dispatched()), 2)
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -115,6 +427,123 @@ class NoQueueWorkerCreator(WorkerCreator):
         pass
 
 
+class TestLoadSpec(VumiTestCase):
+    def setUp(self):
+        self.spec_dir = self.mktemp()
+        os.mkdir(self.spec_dir)
+        self.specfile = os.path.join(self.spec_dir, 'amqp-spec-0-8.xml')
+        shutil.copy(vumi_resource_path('amqp-spec-0-8.xml'), self.specfile)
+        self.cache_dir = os.path.join(self.mktemp(), 'vumi')
+        self.patch(os, 'environ', {'VUMI_CACHE_DIR': self.cache_dir})
+        self.cache_path = get_spec_cache_path(self.specfile)
+        self.parsed = []
+        txamqp_load = txamqp.spec.load
+
+        def load(specfile):
+            self.parsed.append(specfile)
+            return txamqp_load(specfile)
+
+        self.patch(txamqp.spec, 'load', load)
+
+    def assert_spec_works(self, spec):
+        self.assertEqual((spec.major, spec.minor), (8, 0))
+        publish = spec.klass.basic_publish
+        self.assertTrue(publish.__doc__.strip().startswith(
+            "publish a message"))
+
+    def test_get_spec_cache_dir(self):
+        self.assertEqual(get_spec_cache_dir(), self.cache_dir)
+        self.patch(os, 'environ', {'XDG_CACHE_HOME': '/cache'})
+        self.assertEqual(get_spec_cache_dir(), '/cache/vumi')
+        self.patch(os, 'environ', {'HOME': '/home/vumi'})
+        self.assertEqual(get_spec_cache_dir(), '/home/vumi/.cache/vumi')
+
+    def test_get_spec_cache_path(self):
+        self.assertEqual(os.path.dirname(self.cache_path), self.cache_dir)
+        self.assertTrue(os.path.basename(self.cache_path).startswith(
+            'amqp-spec-0-8.xml-'))
+        self.assertTrue(self.cache_path.endswith('.pickle'))
+        other_specfile = os.path.join(self.mktemp(), 'amqp-spec-0-8.xml')
+        self.assertNotEqual(
+            get_spec_cache_path(other_specfile), self.cache_path)
+
+    def test_load_spec_writes_cache(self):
+        self.assertFalse(os.path.exists(self.cache_path))
+        spec = load_spec(self.specfile)
+        self.assert_spec_works(spec)
+        self.assertEqual(self.parsed, [self.specfile])
+        self.assertTrue(os.path.exists(self.cache_path))
+        self.assertEqual(os.listdir(self.cache_dir), [
+            os.path.basename(self.cache_path)])
+        # Nothing is written next to the spec file.
+        self.assertEqual(os.listdir(self.spec_dir), ['amqp-spec-0-8.xml'])
+
+    def test_load_spec_reads_cache(self):
+        spec = load_spec(self.specfile)
+        cached_spec = load_spec(self.specfile)
+        self.assertEqual(self.parsed, [self.specfile])
+        self.assertNotEqual(cached_spec, spec)
+        self.assert_spec_works(cached_spec)
+        self.assertEqual(
+            cached_spec.klass.basic_publish.__doc__,
+            spec.klass.basic_publish.__doc__)
+
+    def test_load_spec_stale_cache(self):
+        load_spec(self.specfile)
+        with open(self.specfile, 'a') as f:
+            f.write('\n')
+        spec = load_spec(self.specfile)
+        self.assert_spec_works(spec)
+        self.assertEqual(self.parsed, [self.specfile, self.specfile])
+        load_spec(self.specfile)
+        self.assertEqual(self.parsed, [self.specfile, self.specfile])
+
+    def test_load_spec_broken_cache(self):
+        os.makedirs(self.cache_dir)
+        with open(self.cache_path, 'wb') as f:
+            f.write('not a pickle')
+        spec = load_spec(self.specfile)
+        self.assert_spec_works(spec)
+        self.assertEqual(self.parsed, [self.specfile])
+        load_spec(self.specfile)
+        self.assertEqual(self.parsed, [self.specfile])
+
+    def test_load_spec_ignores_shared_cache_dir(self):
+        load_spec(self.specfile)
+        os.chmod(self.cache_dir, 0o770)
+        self.assert_spec_works(load_spec(self.specfile))
+        self.assertEqual(self.parsed, [self.specfile, self.specfile])
+
+    def test_load_spec_ignores_shared_cache_file(self):
+        load_spec(self.specfile)
+        os.chmod(self.cache_path, 0o606)
+        self.assert_spec_works(load_spec(self.specfile))
+        self.assertEqual(self.parsed, [self.specfile, self.specfile])
+
+    def test_load_spec_ignores_cache_owned_by_others(self):
+        load_spec(self.specfile)
+        uid = os.getuid()
+        self.patch(os, 'getuid', lambda: uid + 1)
+        self.assert_spec_works(load_spec(self.specfile))
+        self.assertEqual(self.parsed, [self.specfile, self.specfile])
+
+    def test_load_spec_unwritable_dir(self):
+        def mkstemp(*args, **kw):
+            raise OSError(13, "Permission denied")
+
+        self.patch(tempfile, 'mkstemp', mkstemp)
+        spec = load_spec(self.specfile)
+        self.assert_spec_works(spec)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_load_spec_uncreatable_dir(self):
+        with open(os.path.dirname(self.cache_dir), 'w') as f:
+            f.write('not a directory')
+        spec = load_spec(self.specfile)
+        self.assert_spec_works(spec)
+        self.assertFalse(os.path.exists(self.cache_path))
+
+
 class TestWorkerCreator(VumiTestCase):
     def get_creator(self, **options):
         vumi_options = {
@@ -1,9 +1,12 @@
 import os
 
+from twisted.internet.defer import succeed
+
 from vumi.servicemaker import (
-    VumiOptions, StartWorkerOptions, VumiWorkerServiceMaker)
-from vumi import servicemaker
+    VumiOptions, StartWorkerOptions, VumiWorkerServiceMaker, StartupProfiler)
+from vumi import sentry
 from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
 
 
 class OptionsTestCase(VumiTestCase):
@@ -180,6 +183,24 @@ class TestStartWorkerOptions(OptionsTestCase):
         self.assertEqual(len(exits), 1)
         self.assertEqual(emits, expected_emits)
 
+    def test_profile_startup(self):
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'foo.FooWorker',
+                              '--config', self.config_file['worker'],
+                              ])
+        self.assertEqual(options.profile_startup, False)
+        self.assertEqual(
+            [name for name, _ in options.startup_profiler.phases],
+            ["read vumi config", "read worker config"])
+
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'foo.FooWorker',
+                              '--profile-startup',
+                              ])
+        self.assertEqual(options.profile_startup, True)
+        self.assertEqual({}, options.opts)
+
     def test_old_style_config_worker_help(self):
         self.check_worker_help('vumi.tests.test_servicemaker.OldConfigWorker',
                                [OldConfigWorker.__doc__, ""])
@@ -215,7 +236,7 @@ class TestVumiWorkerServiceMaker(OptionsTestCase):
             services.append((a, kw))
             return dummy_service
 
-        self.patch(servicemaker, 'SentryLoggerService', service)
+        self.patch(sentry, 'SentryLoggerService', service)
         self.mk_config_file('worker', ["transport_name: sphex"])
         options = StartWorkerOptions()
         options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
@@ -266,3 +287,79 @@ class TestVumiWorkerServiceMaker(OptionsTestCase):
         worker = maker.makeService(options_mt)
         self.assertEqual({'transport_name': 'sphex'}, worker.config)
         self.assertEqual(reactor.getThreadPool().max, 2)
+
+    def test_make_worker_with_profile_startup(self):
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              '--profile-startup',
+                              ])
+        maker = VumiWorkerServiceMaker()
+        worker = maker.makeService(options)
+        self.assertEqual({'transport_name': 'sphex'}, worker.config)
+        self.assertEqual(
+            [name for name, _ in options.startup_profiler.phases], [
+                "read vumi config", "read worker config", "import vumi",
+                "import worker class", "load AMQP spec", "create worker",
+            ])
+
+    def test_profile_worker_start(self):
+        connected = []
+
+        class DummyWorker(object):
+            def _amqp_connected(self, amqp_client):
+                connected.append(amqp_client)
+                return succeed(None)
+
+        clock_times = [0, 1.5, 2.0, 2.25]
+        profiler = StartupProfiler(clock=lambda: clock_times.pop(0))
+        worker = DummyWorker()
+        VumiWorkerServiceMaker().profile_worker_start(worker, profiler)
+
+        with LogCatcher() as lc:
+            worker._amqp_connected("client")
+        self.assertEqual(connected, ["client"])
+        self.assertEqual(profiler.phases, [
+            ("connect to AMQP", 1.5),
+            ("start worker", 0.25),
+        ])
+        self.assertEqual(lc.messages(), [
+            "Worker startup profile:\n"
+            "  connect to AMQP: 1.500s\n"
+            "  start worker: 0.250s\n"
+            "  total: 1.750s"])
+
+        # Reconnecting isn't part of starting up.
+        with LogCatcher() as lc:
+            worker._amqp_connected("client2")
+        self.assertEqual(connected, ["client", "client2"])
+        self.assertEqual(lc.messages(), [])
+
+
+class TestStartupProfiler(VumiTestCase):
+
+    def test_phase(self):
+        clock_times = [0, 0.5, 1, 3]
+        profiler = StartupProfiler(clock=lambda: clock_times.pop(0))
+        with profiler.phase("one"):
+            pass
+        with profiler.phase("two"):
+            pass
+        self.assertEqual(profiler.phases, [("one", 0.5), ("two", 2)])
+        self.assertEqual(profiler.report(), "\n".join([
+            "Worker startup profile:",
+            "  one: 0.500s",
+            "  two: 2.000s",
+            "  total: 2.500s",
+        ]))
+
+    def test_phase_error(self):
+        clock_times = [0, 0.5]
+        profiler = StartupProfiler(clock=lambda: clock_times.pop(0))
+        try:
+            with profiler.phase("broken"):
+                raise ValueError("oops")
+        except ValueError:
+            pass
+        self.assertEqual(profiler.phases, [("broken", 0.5)])
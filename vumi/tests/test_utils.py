@@ -14,7 +14,8 @@ from vumi.utils import (
     normalize_msisdn, vumi_resource_path, cleanup_msisdn, get_operator_name,
     http_request, http_request_full, get_first_word, redis_from_config,
     build_web_site, LogFilterSite, PkgResources, HttpTimeoutError,
-    StatusEdgeDetector)
+    StatusEdgeDetector, HttpConnectionPool, listen_tcp_reuse_port)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.message import TransportStatus
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.fake_connection import (
@@ -133,6 +134,16 @@ class TestUtils(VumiTestCase):
         self.assertTrue(isinstance(site, Site))
         self.assertFalse(isinstance(site, LogFilterSite))
 
+    def test_listen_tcp_reuse_port(self):
+        site = build_web_site({})
+        port1 = listen_tcp_reuse_port(0, site, interface='127.0.0.1')
+        self.add_cleanup(port1.stopListening)
+        port_number = port1.getHost().port
+        port2 = listen_tcp_reuse_port(
+            port_number, site, interface='127.0.0.1')
+        self.add_cleanup(port2.stopListening)
+        self.assertEqual(port2.getHost().port, port_number)
+
 
 class FakeHTTP10(Protocol):
     def dataReceived(self, data):
@@ -428,6 +439,111 @@ class TestHttpUtils(VumiTestCase):
             failure.getErrorMessage(), "Timeout while receiving data")
         yield self.assertFailure(request_done, ConnectionDone)
 
+    def make_pool(self, **kw):
+        pool = HttpConnectionPool(reactor, **kw)
+        self.add_cleanup(pool.closeCachedConnections)
+        return pool
+
+    def test_http_connection_pool_key_for_url(self):
+        self.assertEqual(
+            HttpConnectionPool.key_for_url('http://example.com/foo'),
+            ('http', 'example.com', 80))
+        self.assertEqual(
+            HttpConnectionPool.key_for_url('https://example.com/foo'),
+            ('https', 'example.com', 443))
+        self.assertEqual(
+            HttpConnectionPool.key_for_url('http://example.com:9980/'),
+            ('http', 'example.com', 9980))
+
+    @inlineCallbacks
+    def test_http_request_full_pool_reuses_connections(self):
+        """
+        Make requests over the network (localhost) to check that connections
+        are reused. The fake agent's endpoints can't be pooled.
+        """
+        url = yield self.make_real_webserver()
+        self.set_render(lambda r: "Yay")
+        pool = self.make_pool()
+        request = yield http_request_full(url, '', pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+        yield wait0()
+        request = yield http_request_full(url, '', pool=pool)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_http_request_pool(self):
+        self.set_render(lambda r: "Yay")
+        pool = self.make_pool()
+        data = yield self.with_agent(http_request, self.url, '', pool=pool)
+        self.assertEqual(data, "Yay")
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+
+    @inlineCallbacks
+    def test_http_request_full_pool_queues_requests(self):
+        got_request = self.set_async_render()
+        pool = self.make_pool(max_connections_per_host=1)
+        d1 = self.with_agent(http_request_full, self.url, '', pool=pool)
+        d2 = self.with_agent(http_request_full, self.url, '', pool=pool)
+        self.assertEqual(pool.queue_depth, 1)
+        request = yield got_request
+
+        self.set_render(lambda r: "Second")
+        request.setResponseCode(http.OK)
+        request.write("First")
+        request.finish()
+        response = yield d1
+        self.assertEqual(response.delivered_body, "First")
+        self.assertEqual(pool.queue_depth, 0)
+        response = yield d2
+        self.assertEqual(response.delivered_body, "Second")
+        self.assertEqual(pool._active, {})
+
+    @inlineCallbacks
+    def test_http_request_full_pool_queued_request_timeout(self):
+        clock = Clock()
+        got_request = self.set_async_render()
+        pool = self.make_pool(max_connections_per_host=1)
+        d1 = self.with_agent(http_request_full, self.url, '', pool=pool)
+        d2 = self.with_agent(
+            http_request_full, self.url, '', timeout=30, reactor=clock,
+            pool=pool)
+        self.assertEqual(pool.queue_depth, 1)
+        clock.advance(30)
+        self.failureResultOf(d2, HttpTimeoutError)
+        self.assertEqual(pool.queue_depth, 0)
+
+        request = yield got_request
+        request.setResponseCode(http.OK)
+        request.finish()
+        yield d1
+        self.assertEqual(pool._active, {})
+
+    @inlineCallbacks
+    def test_http_connection_pool_metrics(self):
+        url = yield self.make_real_webserver()
+        got_request = self.set_async_render()
+        mm = MetricManager("vumi.test.")
+        pool = self.make_pool(max_connections_per_host=1)
+        pool.register_metrics(mm)
+        d1 = http_request_full(url, '', pool=pool)
+        d2 = http_request_full(url, '', pool=pool)
+        request = yield got_request
+        self.set_render(lambda r: "Second")
+        request.setResponseCode(http.OK)
+        request.finish()
+        yield d1
+        yield d2
+
+        [hits] = mm['http_pool.hits'].poll()
+        self.assertEqual(hits[1], 1.0)
+        [misses] = mm['http_pool.misses'].poll()
+        self.assertEqual(misses[1], 1.0)
+        self.assertEqual(
+            [value for _, value in mm['http_pool.queue_depth'].poll()],
+            [1, 0])
+
 
 class TestPkgResources(VumiTestCase):
 
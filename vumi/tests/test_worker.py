@@ -1,6 +1,7 @@
 from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 
 from vumi.worker import BaseConfig, BaseWorker
+from vumi.utils import HttpConnectionPool
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
@@ -52,6 +53,10 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_publisher_confirm_window(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_publisher_confirm_window, 0)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -66,6 +71,7 @@ class TestBaseWorker(VumiTestCase):
     def test_start_worker(self):
         worker, calls = self.worker, []
         worker.setup_heartbeat = CallRecorder(worker.setup_heartbeat, calls)
+        worker.setup_http_pool = CallRecorder(worker.setup_http_pool, calls)
         worker.setup_middleware = CallRecorder(worker.setup_middleware, calls)
         worker.setup_connectors = CallRecorder(worker.setup_connectors, calls)
         worker.setup_worker = CallRecorder(worker.setup_worker, calls)
@@ -79,6 +85,7 @@ class TestBaseWorker(VumiTestCase):
                               'Started the publisher'])
         self.assertEqual(calls, [
             ('setup_heartbeat', (), {}),
+            ('setup_http_pool', (), {}),
             ('setup_middleware', (), {}),
             ('setup_connectors', (), {}),
             ('setup_worker', (), {}),
@@ -93,6 +100,8 @@ class TestBaseWorker(VumiTestCase):
                                                   calls)
         worker.teardown_connectors = CallRecorder(worker.teardown_connectors,
                                                   calls)
+        worker.teardown_http_pool = CallRecorder(worker.teardown_http_pool,
+                                                 calls)
         worker.teardown_worker = CallRecorder(worker.teardown_worker, calls)
         yield worker.startWorker()
         with LogCatcher() as lc:
@@ -102,9 +111,46 @@ class TestBaseWorker(VumiTestCase):
             ('teardown_worker', (), {}),
             ('teardown_connectors', (), {}),
             ('teardown_middleware', (), {}),
+            ('teardown_http_pool', (), {}),
             ('teardown_heartbeat', (), {}),
         ])
 
+    @inlineCallbacks
+    def test_no_http_pool(self):
+        yield self.worker.startWorker()
+        self.assertEqual(self.worker.http_pool, None)
+
+    @inlineCallbacks
+    def test_http_pool(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'http_connection_pool': {
+                'max_connections_per_host': 5,
+                'idle_timeout': 30,
+            },
+        }, False)
+        yield worker.startWorker()
+        pool = worker.http_pool
+        self.assertTrue(isinstance(pool, HttpConnectionPool))
+        self.assertEqual(pool.max_connections_per_host, 5)
+        self.assertEqual(pool.maxPersistentPerHost, 5)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+        self.assertEqual(pool._metrics, None)
+        yield worker.stopWorker()
+        self.assertEqual(worker.http_pool, None)
+
+    @inlineCallbacks
+    def test_http_pool_metrics(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'http_connection_pool': {'metrics_prefix': 'vumi.test.'},
+        }, False)
+        yield worker.startWorker()
+        self.assertEqual(
+            sorted(worker.http_pool._metrics.keys()),
+            ['hits', 'misses', 'queue_depth'])
+        self.assertEqual(worker._http_pool_metrics.prefix, 'vumi.test.')
+        yield worker.stopWorker()
+        self.assertEqual(worker._http_pool_metrics, None)
+
     def test_setup_connectors_raises(self):
         worker = self.worker_helper.get_worker_raw(BaseWorker, {})
         self.assertRaises(NotImplementedError, worker.setup_connectors)
@@ -154,6 +200,49 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertTrue(cfg1 is cfg2)
+
+    def test_get_cached_config_overrides(self):
+        cfg = self.worker.get_cached_config(amqp_prefetch_count=5)
+        self.assertEqual(cfg.amqp_prefetch_count, 5)
+        self.assertTrue(
+            self.worker.get_cached_config(amqp_prefetch_count=5) is cfg)
+        self.assertEqual(
+            self.worker.get_cached_config().amqp_prefetch_count, 20)
+        self.assertFalse('amqp_prefetch_count' in self.worker.config)
+
+    def test_get_cached_config_unhashable_overrides(self):
+        cfg = self.worker.get_cached_config(foo=[1])
+        self.assertEqual(cfg.amqp_prefetch_count, 20)
+        self.assertFalse(self.worker.get_cached_config(foo=[1]) is cfg)
+        self.assertEqual(len(self.worker._config_cache), 0)
+
+    def test_get_cached_config_evicts_least_recently_used(self):
+        self.worker.CONFIG_CACHE_SIZE = 2
+        cfg1 = self.worker.get_cached_config(amqp_prefetch_count=1)
+        cfg2 = self.worker.get_cached_config(amqp_prefetch_count=2)
+        self.assertTrue(
+            self.worker.get_cached_config(amqp_prefetch_count=1) is cfg1)
+        self.worker.get_cached_config(amqp_prefetch_count=3)
+        self.assertEqual(len(self.worker._config_cache), 2)
+        self.assertTrue(
+            self.worker.get_cached_config(amqp_prefetch_count=1) is cfg1)
+        self.assertFalse(
+            self.worker.get_cached_config(amqp_prefetch_count=2) is cfg2)
+
+    def test_clear_config_cache(self):
+        cfg = self.worker.get_cached_config()
+        self.worker.config['amqp_prefetch_count'] = 7
+        self.assertTrue(self.worker.get_cached_config() is cfg)
+        self.worker.clear_config_cache()
+        self.assertEqual(
+            self.worker.get_cached_config().amqp_prefetch_count, 7)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -174,6 +263,17 @@ class TestBaseWorker(VumiTestCase):
         self.assertTrue(isinstance(connector, ReceiveInboundConnector))
         # test setup happened
         self.assertTrue(connector._consumers['inbound'].keep_consuming)
+        publisher = connector._publishers['outbound']
+        self.assertEqual(publisher.confirm_window, None)
+
+    @inlineCallbacks
+    def test_setup_connector_with_publisher_confirms(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_publisher_confirm_window': 10}, False)
+        connector = yield worker.setup_connector(
+            ReceiveInboundConnector, 'foo')
+        window = connector._publishers['outbound'].confirm_window
+        self.assertEqual(window.size, 10)
 
     @inlineCallbacks
     def test_teardown_connector(self):
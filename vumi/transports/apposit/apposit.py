@@ -142,7 +142,8 @@ class AppositTransport(HttpRpcTransport):
             data=urlencode(params),
             method='POST',
             headers={'Content-Type': self.CONTENT_TYPE},
-            agent_class=self.agent_factory)
+            agent_class=self.agent_factory,
+            pool=self.http_pool)
 
         self.emit("Response: (%s) %r" %
                   (response.code, response.delivered_body))
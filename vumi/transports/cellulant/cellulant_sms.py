@@ -66,7 +66,8 @@ class CellulantSmsTransport(HttpRpcTransport):
         url = '%s?%s' % (self._outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
         response = yield http_request_full(
-            url, '', method='GET', agent_class=self.agent_factory)
+            url, '', method='GET', agent_class=self.agent_factory,
+            pool=self.http_pool)
         log.msg("Response: (%s) %r" % (response.code, response.delivered_body))
         content = response.delivered_body.strip()
 
@@ -4,9 +4,11 @@ import time
 from datetime import datetime
 from uuid import uuid4
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.task import LoopingCall
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults, FirstError)
+from twisted.internet.task import LoopingCall, deferLater
 
+from vumi import log
 from vumi.service import Worker
 from vumi.message import TransportMessage, to_json
 from vumi.persist.txredis_manager import TxRedisManager
@@ -57,10 +59,16 @@ class FailureWorker(Worker):
     Base class for transport failure handlers.
 
     Subclasses should implement :meth:`handle_failure`.
+
+    Due retries are delivered in batches of up to ``retry_batch_size``
+    messages, with at most ``retry_delivery_rate`` messages published per
+    second (``0`` means no limit).
     """
 
     GRANULARITY = 5  # seconds
     DELIVERY_PERIOD = 3
+    BATCH_SIZE = 100
+    DELIVERY_RATE = 0  # messages per second
 
     MAX_DELAY = 3600
     INITIAL_DELAY = 1
@@ -69,6 +77,9 @@ class FailureWorker(Worker):
     @inlineCallbacks
     def startWorker(self):
         self.configure_retries()
+        self.clock = self.get_clock()
+        self._rate_window_start = None
+        self._rate_window_count = 0
         yield self.set_up_redis()
         retry_rkey = self.get_rkey('retry')
         failures_rkey = self.get_rkey('failures')
@@ -87,7 +98,8 @@ class FailureWorker(Worker):
 
     def configure_retries(self):
         for param in ['GRANULARITY', 'MAX_DELAY', 'INITIAL_DELAY',
-                      'DELAY_FACTOR', 'DELIVERY_PERIOD']:
+                      'DELAY_FACTOR', 'DELIVERY_PERIOD', 'BATCH_SIZE',
+                      'DELIVERY_RATE']:
             setattr(self, param, self.config.get('retry_' + param.lower(),
                                                  getattr(self, param)))
 
@@ -98,6 +110,13 @@ class FailureWorker(Worker):
         self.redis = redis.sub_manager("failures:%s" % (
                 self.config['transport_name'],))
 
+    def get_clock(self):
+        """
+        For easier stubbing in tests
+        """
+        from twisted.internet import reactor
+        return reactor
+
     def start_retry_delivery(self):
         self.delivery_loop = None
         if self.DELIVERY_PERIOD:
@@ -181,16 +200,61 @@ class FailureWorker(Worker):
             returnValue(next_timestamp[0])
         returnValue(None)
 
+    @inlineCallbacks
+    def get_next_retry_keys(self, count):
+        """
+        Remove and return up to ``count`` failure keys from the earliest due
+        retry bucket.
+
+        The keys are popped with one pipelined request. Each ``SPOP`` is
+        atomic, so several workers may share the same retry buckets.
+        """
+        while True:
+            timestamp = yield self.get_next_read_timestamp()
+            if not timestamp:
+                returnValue([])
+            bucket_key = "retry_keys." + timestamp
+            pipe = self.redis.pipeline()
+            for _ in xrange(count):
+                pipe.spop(bucket_key)
+            pipe.scard(bucket_key)
+            results = yield pipe.execute()
+            if results[-1] < 1:
+                yield self.redis.zrem('retry_timestamps', timestamp)
+            keys = [key for key in results[:-1] if key is not None]
+            if keys:
+                returnValue(keys)
+
     @inlineCallbacks
     def get_next_retry_key(self):
-        timestamp = yield self.get_next_read_timestamp()
-        if not timestamp:
+        keys = yield self.get_next_retry_keys(1)
+        returnValue(keys[0] if keys else None)
+
+    def get_failures(self, failure_keys):
+        pipe = self.redis.pipeline()
+        for failure_key in failure_keys:
+            pipe.hgetall(failure_key)
+        return pipe.execute()
+
+    @inlineCallbacks
+    def wait_for_delivery_slot(self):
+        """
+        Wait until another retry may be published without exceeding
+        ``DELIVERY_RATE``.
+        """
+        if not self.DELIVERY_RATE:
             return
-        bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
-            yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
+        now = self.clock.seconds()
+        window_start = self._rate_window_start
+        if window_start is None or now - window_start >= 1:
+            self._rate_window_start = now
+            self._rate_window_count = 0
+        if self._rate_window_count >= self.DELIVERY_RATE:
+            yield deferLater(
+                self.clock, self._rate_window_start + 1 - now, lambda: None)
+            self._rate_window_start = self.clock.seconds()
+            self._rate_window_count = 0
+        self._rate_window_count += 1
 
     @inlineCallbacks
     def deliver_retry(self, retry_key, publisher):
@@ -198,13 +262,43 @@ class FailureWorker(Worker):
         published = yield publisher.publish_raw(failure['message'])
         returnValue(published)
 
+    @inlineCallbacks
+    def deliver_retry_batch(self, retry_keys, publisher):
+        """
+        Publish the failed messages for a batch of retry keys that have
+        already been removed from their bucket.
+
+        Every message in the batch is published even if some of them fail.
+        Each failure is logged with its retry key and the first one is
+        raised once they have all been tried.
+        """
+        failures = yield self.get_failures(retry_keys)
+        published = []
+        for retry_key, failure in zip(retry_keys, failures):
+            if 'message' not in failure:
+                log.warning("Failure %r due for retry not found." % (
+                    retry_key,))
+                continue
+            yield self.wait_for_delivery_slot()
+            d = maybeDeferred(publisher.publish_raw, failure['message'])
+            d.addErrback(self._log_retry_error, retry_key)
+            published.append(d)
+        try:
+            yield gatherResults(published, consumeErrors=True)
+        except FirstError as e:
+            e.subFailure.raiseException()
+
+    def _log_retry_error(self, failure, retry_key):
+        log.err(failure, "Error delivering retry %r" % (retry_key,))
+        return failure
+
     @inlineCallbacks
     def deliver_retries(self):
         while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
+            retry_keys = yield self.get_next_retry_keys(self.BATCH_SIZE)
+            if not retry_keys:
                 return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
+            yield self.deliver_retry_batch(retry_keys, self.retry_publisher)
 
     def next_retry_delay(self, delay):
         if not delay:
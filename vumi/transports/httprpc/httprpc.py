@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
+import heapq
 import json
 
 from twisted.cred.portal import Portal
@@ -80,12 +81,29 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         "The maximum time allowed for a response before the service is "
         "considered `degraded`",
         default=1.0, static=True)
+    web_reuse_port = ConfigBool(
+        "Listen on `web_port` with `SO_REUSEPORT` so that several processes"
+        " running this transport can share the port. Each process should"
+        " have a different `process_id`. Defaults to `False`.",
+        default=False, static=True)
+    process_id = ConfigText(
+        "Identifies this process among the processes running this"
+        " transport. If set, inbound messages record the process that holds"
+        " the HTTP request in their transport metadata, and replies received"
+        " by other processes are forwarded to it on the"
+        " `<transport_name>.<process_id>.outbound` routing key. Must be"
+        " lower case and stay the same when the process is restarted."
+        " Defaults to `None`, which means that replies must be received by"
+        " this process.", default=None, static=True)
 
     def post_validate(self):
         auth_supplied = (self.web_username is None, self.web_password is None)
         if any(auth_supplied) and not all(auth_supplied):
             raise ConfigError("If either web_username or web_password is"
                               " specified, both must be specified")
+        if self.process_id is not None and (
+                self.process_id != self.process_id.lower()):
+            raise ConfigError("process_id must be lower case")
 
 
 class HttpRpcHealthResource(Resource):
@@ -130,10 +148,18 @@ class HttpRpcTransport(Transport):
 
     Because a reply from an application worker is needed before the HTTP
     response can be completed, a reply needs to be returned to the same
-    transport worker that generated the inbound message. This means that
-    currently there many only be one transport worker for each instance
+    transport worker that generated the inbound message. By default this
+    means that there may only be one transport worker for each instance
     of this transport of a given name.
+
+    Several processes may run the same transport if each is given a
+    different `process_id`. Replies then record the process that received
+    the request and are forwarded to it by whichever process consumes them.
+    With `web_reuse_port` set the processes can also share a port.
     """
+
+    PROCESS_ID_METADATA_KEY = 'httprpc_process_id'
+
     content_type = 'text/plain'
 
     CONFIG_CLASS = HttpRpcTransportConfig
@@ -157,6 +183,9 @@ class HttpRpcTransport(Transport):
         self.request_timeout_body = config.request_timeout_body
         self.gc_requests_interval = config.request_cleanup_interval
         self._validation_mode = config.validation_mode
+        self.web_reuse_port = config.web_reuse_port
+        self.process_id = config.process_id
+        self._process_publishers = {}
         self.response_time_down = config.response_time_down
         self.response_time_degraded = config.response_time_degraded
         if self._validation_mode not in self.KNOWN_VALIDATION_MODES:
@@ -190,6 +219,11 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
+        # A heap of (timestamp, request_id) pairs so that requests can be
+        # timed out without looking at the ones that haven't expired yet.
+        # Entries for requests that have already been finished are skipped
+        # when they are popped.
+        self._request_timestamps = []
         self.request_gc = LoopingCall(self.manually_close_requests)
         self.clock = self.get_clock()
         self.request_gc.clock = self.clock
@@ -204,10 +238,52 @@ class HttpRpcTransport(Transport):
                 (rpc_resource, self.web_path),
                 (HttpRpcHealthResource(self), self.health_path),
             ],
-            self.web_port)
+            self.web_port, reuse_port=self.web_reuse_port)
 
         self.status_detect = StatusEdgeDetector()
 
+    @property
+    def process_connector_name(self):
+        return "%s.%s" % (self.transport_name, self.process_id)
+
+    @inlineCallbacks
+    def setup_connectors(self):
+        yield super(HttpRpcTransport, self).setup_connectors()
+        if self.process_id is not None:
+            self.add_outbound_handler(self.route_outbound_message)
+            # Middleware has already been applied to forwarded messages by
+            # the process that forwarded them.
+            process_connector = yield self.setup_ro_connector(
+                self.process_connector_name, middleware=False)
+            self.add_outbound_handler(
+                self.handle_outbound_message, connector=process_connector)
+
+    def get_process_id(self, message):
+        """Return the id of the process that holds the request a message is
+        a reply to, or `None` if it isn't known."""
+        if message['in_reply_to'] is None:
+            return None
+        return message['transport_metadata'].get(
+            self.PROCESS_ID_METADATA_KEY)
+
+    def route_outbound_message(self, message):
+        process_id = self.get_process_id(message)
+        if process_id is None or process_id == self.process_id:
+            return self.handle_outbound_message(message)
+        return self.forward_outbound_message(process_id, message)
+
+    @inlineCallbacks
+    def forward_outbound_message(self, process_id, message):
+        """Send a reply to the process that holds its request."""
+        publisher = self._process_publishers.get(process_id)
+        if publisher is None:
+            publisher = yield self.publish_to("%s.%s.outbound" % (
+                self.transport_name, process_id))
+            self._process_publishers[process_id] = publisher
+        self.emit("HttpRpcTransport forwarding %s to process %s" % (
+            message['message_id'], process_id))
+        yield publisher.publish_message(message)
+
     def add_status(self, **kw):
         '''Publishes a status if it is not a repeat of the previously
         published status.'''
@@ -251,12 +327,30 @@ class HttpRpcTransport(Transport):
         return missing_fields
 
     def manually_close_requests(self):
-        for request_id, request_data in self._requests.items():
-            timestamp = request_data['timestamp']
-            response_time = self.clock.seconds() - timestamp
-            if response_time > self.request_timeout:
-                self.on_timeout(request_id, response_time)
-                self.close_request(request_id)
+        now = self.clock.seconds()
+        timestamps = self._request_timestamps
+        while timestamps and now - timestamps[0][0] > self.request_timeout:
+            timestamp, request_id = heapq.heappop(timestamps)
+            request_data = self._requests.get(request_id)
+            if request_data is None or request_data['timestamp'] != timestamp:
+                # This request has been finished or set again since.
+                continue
+            response_time = now - timestamp
+            self.on_timeout(request_id, response_time)
+            self.close_request(request_id)
+        if len(timestamps) > 2 * len(self._requests):
+            self._compact_request_timestamps()
+
+    def _compact_request_timestamps(self):
+        """Remove the entries for finished requests from the timeout heap.
+
+        This is only done once more than half the entries are for finished
+        requests, so the cost is spread over the requests removed.
+        """
+        self._request_timestamps = [
+            (request_data['timestamp'], request_id)
+            for request_id, request_data in self._requests.iteritems()]
+        heapq.heapify(self._request_timestamps)
 
     def close_request(self, request_id):
         log.warning('Timing out %s' % (self.get_request_to_addr(request_id),))
@@ -275,6 +369,7 @@ class HttpRpcTransport(Transport):
             'timestamp': timestamp,
             'request': request_object,
         }
+        heapq.heappush(self._request_timestamps, (timestamp, request_id))
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -336,6 +431,10 @@ class HttpRpcTransport(Transport):
     #       in a consistent manner.
     def publish_message(self, **kwargs):
         self.set_request_to_addr(kwargs['message_id'], kwargs['to_addr'])
+        if self.process_id is not None:
+            transport_metadata = dict(kwargs.get('transport_metadata') or {})
+            transport_metadata[self.PROCESS_ID_METADATA_KEY] = self.process_id
+            kwargs['transport_metadata'] = transport_metadata
         return super(HttpRpcTransport, self).publish_message(**kwargs)
 
     def get_request_to_addr(self, request_id):
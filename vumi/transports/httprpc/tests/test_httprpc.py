@@ -3,6 +3,7 @@ import json
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
 
+from vumi.config import ConfigError
 from vumi.utils import http_request, http_request_full, basic_auth_string
 from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
@@ -84,6 +85,54 @@ class TestTransport(VumiTestCase):
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
 
+    def patch_close_request(self):
+        closed = []
+
+        def close_request(request_id):
+            closed.append(request_id)
+            self.transport.remove_request(request_id)
+
+        self.patch(self.transport, 'close_request', close_request)
+        return closed
+
+    def test_timeout_only_expired_requests(self):
+        closed = self.patch_close_request()
+        self.transport.set_request('r1', object(), timestamp=0)
+        self.transport.set_request('r2', object(), timestamp=3)
+        self.transport.set_request('r3', object(), timestamp=8)
+        self.clock.advance(13.1)
+        self.assertEqual(closed, ['r1', 'r2'])
+        self.assertEqual(self.transport._requests.keys(), ['r3'])
+        self.clock.advance(5)
+        self.assertEqual(closed, ['r1', 'r2', 'r3'])
+
+    def test_timeout_skips_finished_requests(self):
+        closed = self.patch_close_request()
+        self.transport.set_request('r1', object(), timestamp=0)
+        self.transport.set_request('r2', object(), timestamp=0)
+        self.transport.remove_request('r1')
+        self.clock.advance(10.1)
+        self.assertEqual(closed, ['r2'])
+
+    def test_timeout_request_set_again(self):
+        closed = self.patch_close_request()
+        self.transport.set_request('r1', object(), timestamp=0)
+        self.transport.set_request('r1', object(), timestamp=5)
+        self.clock.advance(10.1)
+        self.assertEqual(closed, [])
+        self.clock.advance(5)
+        self.assertEqual(closed, ['r1'])
+
+    def test_timeout_heap_compacted(self):
+        for i in range(10):
+            self.transport.set_request('r%d' % (i,), object())
+        for i in range(6):
+            self.transport.remove_request('r%d' % (i,))
+        self.assertEqual(len(self.transport._request_timestamps), 10)
+        self.clock.advance(5)
+        self.assertEqual(sorted(self.transport._request_timestamps), [
+            (0, 'r6'), (0, 'r7'), (0, 'r8'), (0, 'r9')])
+
     @inlineCallbacks
     def test_publish_health_status_repeated(self):
         '''Repeated statuses should not be published, new ones should be.'''
@@ -113,6 +162,86 @@ class TestTransport(VumiTestCase):
         self.assertEqual(status['status'], 'degraded')
 
 
+class TestMultiProcessTransport(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(OkTransport))
+        self.transport_a = yield self.get_transport('proc-a')
+        self.transport_b = yield self.get_transport('proc-b')
+
+    def get_transport(self, process_id, **config):
+        config.setdefault('web_path', 'foo')
+        config.setdefault('web_port', 0)
+        config['process_id'] = process_id
+        return self.tx_helper.get_transport(config)
+
+    def dispatch_to(self, transport, msg):
+        """Deliver an outbound message to a particular process."""
+        connector = transport.connectors[transport.transport_name]
+        return connector._consume_message('outbound', msg)
+
+    @inlineCallbacks
+    def test_inbound_records_process_id(self):
+        d = http_request(self.transport_a.get_transport_url('foo'), '',
+                         method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['transport_metadata'], {
+            'httprpc_process_id': 'proc-a',
+        })
+        yield self.dispatch_to(self.transport_a, msg.reply("OK"))
+        yield d
+
+    @inlineCallbacks
+    def test_reply_handled_by_owner(self):
+        d = http_request(self.transport_a.get_transport_url('foo'), '',
+                         method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.dispatch_to(self.transport_a, msg.reply("OK"))
+        response = yield d
+        self.assertEqual(response, 'OK')
+        self.assertEqual(self.transport_a._process_publishers, {})
+
+    @inlineCallbacks
+    def test_reply_forwarded_to_owner(self):
+        d = http_request(self.transport_a.get_transport_url('foo'), '',
+                         method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply("OK")
+        yield self.dispatch_to(self.transport_b, reply)
+        response = yield d
+        self.assertEqual(response, 'OK')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], reply['message_id'])
+        self.assertEqual(
+            self.transport_b._process_publishers.keys(), ['proc-a'])
+
+    @inlineCallbacks
+    def test_non_reply_not_forwarded(self):
+        msg = self.tx_helper.make_outbound("outbound")
+        yield self.dispatch_to(self.transport_b, msg)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(self.transport_b._process_publishers, {})
+
+    @inlineCallbacks
+    def test_shared_port(self):
+        transport_c = yield self.get_transport('proc-c', web_reuse_port=True)
+        port = transport_c.web_resource.getHost().port
+        transport_d = yield self.get_transport(
+            'proc-d', web_reuse_port=True, web_port=port)
+        self.assertEqual(transport_d.web_resource.getHost().port, port)
+        d = http_request(transport_d.get_transport_url('foo'), '',
+                         method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        response = yield d
+        self.assertEqual(response, 'OK')
+
+    def test_process_id_must_be_lower_case(self):
+        self.assertRaises(ConfigError, self.get_transport, 'Proc-E')
+
+
 class TestTransportWithAuthentication(VumiTestCase):
 
     @inlineCallbacks
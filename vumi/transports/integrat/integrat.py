@@ -136,7 +136,7 @@ class IntegratTransport(Transport):
             'UserID': self.integrat_username,
         }), headers={
             'Content-Type': ['text/xml; charset=utf-8']
-        }, agent_class=self.agent_factory)
+        }, agent_class=self.agent_factory, pool=self.http_pool)
         error = hxg.parse_response(response)
         if not error:
             yield self.publish_ack(user_message_id=message['message_id'],
@@ -69,7 +69,8 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
 
             url = '%s?%s' % (self._outbound_url, urlencode(params))
             response = yield http_request_full(
-                url, '', method='GET', agent_class=self.agent_factory)
+                url, '', method='GET', agent_class=self.agent_factory,
+                pool=self.http_pool)
             log.msg("Response: (%s) %r" % (
                 response.code, response.delivered_body))
             if response.code == http.OK:
@@ -43,7 +43,8 @@ class MTechKenyaTransport(HttpRpcTransport):
         url = '%s?%s' % (config.outbound_url, urlencode(params))
         log.msg("Making HTTP request: %s" % (url,))
         return http_request_full(
-            url, '', method='POST', agent_class=self.agent_factory)
+            url, '', method='POST', agent_class=self.agent_factory,
+            pool=self.http_pool)
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
@@ -105,4 +106,5 @@ class MTechKenyaTransportV2(MTechKenyaTransport):
         config = self.get_static_config()
         return http_request_full(
             config.outbound_url, urlencode(params), method='POST',
-            headers=self.headers, agent_class=self.agent_factory)
+            headers=self.headers, agent_class=self.agent_factory,
+            pool=self.http_pool)
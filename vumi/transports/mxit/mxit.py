@@ -198,7 +198,7 @@ class MxitTransport(HttpRpcTransport):
         })
         response = yield http_request_full(
             url=url, method='POST', headers=headers, data=data,
-            agent_class=self.agent_factory)
+            agent_class=self.agent_factory, pool=self.http_pool)
         data = json.loads(response.delivered_body)
         if 'error' in data:
             raise MxitTransportException(
@@ -227,7 +227,8 @@ class MxitTransport(HttpRpcTransport):
         yield http_request_full(
             config.api_send_url, data=json.dumps(data), headers=headers,
             method="POST", timeout=config.timeout,
-            context_factory=context_factory, agent_class=self.agent_factory)
+            context_factory=context_factory, agent_class=self.agent_factory,
+            pool=self.http_pool)
 
     @inlineCallbacks
     def render_response(self, message):
@@ -7,10 +7,11 @@ from datetime import datetime
 from uuid import uuid4
 import warnings
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults)
 from twisted.internet.task import LoopingCall
 
-from vumi import message
+from vumi import message, log
 
 
 warnings.warn("vumi.transport.scheduler is deprecated. A replacement is coming"
@@ -21,15 +22,26 @@ class Scheduler(object):
     """
     Base class for stuff that needs to be published to a given queue
     at a given time.
+
+    :param redis:
+        A :class:`vumi.persist.txredis_manager.TxRedisManager`.
+    :param callback:
+        Called with ``(scheduled_at, payload)`` for each item delivered.
+        May return a deferred.
+    :param int batch_size:
+        The maximum number of items fetched from Redis at a time when
+        delivering. All the items in every bucket that is due are delivered
+        each tick.
     """
 
     def __init__(self, redis, callback, prefix='scheduler',
                     granularity=5, delivery_period=3, json_encoder=None,
-                    json_decoder=None):
-        self.r_server = redis
+                    json_decoder=None, batch_size=100):
+        self.redis = redis
         self.r_prefix = prefix
         self.granularity = granularity
         self.delivery_period = delivery_period
+        self.batch_size = batch_size
         self._scheduled_timestamps_key = self.r_key("scheduled_timestamps")
         self.callback = callback
         self.json_encoder = json_encoder or message.JSONMessageEncoder
@@ -64,7 +76,7 @@ class Scheduler(object):
         return self.r_key(".".join(("scheduled", timestamp, unique_id)))
 
     def get_scheduled(self, scheduled_key):
-        return self.r_server.hgetall(scheduled_key)
+        return self.redis.hgetall(scheduled_key)
 
     def get_next_write_timestamp(self, delta, now):
         now = int(now)
@@ -74,30 +86,53 @@ class Scheduler(object):
         timestamp += self.granularity - (timestamp % self.granularity)
         return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
 
+    @inlineCallbacks
     def get_read_timestamp(self, now):
         now = int(now)
         timestamp = datetime.utcfromtimestamp(now).replace(tzinfo=pytz.UTC)
-        next_timestamp = self.r_server.zrange(self._scheduled_timestamps_key,
-                                                0, 0)
+        next_timestamp = yield self.redis.zrange(
+            self._scheduled_timestamps_key, 0, 0)
         if next_timestamp:
             if iso8601.parse_date(next_timestamp[0]) <= timestamp:
-                return next_timestamp[0]
-        return None
+                returnValue(next_timestamp[0])
+        returnValue(None)
 
     def get_next_read_timestamp(self):
         return self.get_read_timestamp(time.time())
 
-    def get_scheduled_key(self, time):
-        timestamp = self.get_time_bucket(time)
+    def get_scheduled_keys(self, time, count):
+        """
+        Remove and return up to ``count`` keys from the bucket for ``time``.
+        """
+        return self.pop_bucket_keys(self.get_time_bucket(time), count)
+
+    @inlineCallbacks
+    def pop_bucket_keys(self, timestamp, count):
+        """
+        Remove and return up to ``count`` keys from the bucket for
+        ``timestamp``.
+
+        The keys are popped with a single pipelined request. Each ``SPOP``
+        is atomic, so no key is returned twice.
+        """
         bucket_key = self.r_key("scheduled_keys." + timestamp)
-        # key of message to be delivered
-        scheduled_key = self.r_server.spop(bucket_key)
+        pipe = self.redis.pipeline()
+        for _ in xrange(count):
+            pipe.spop(bucket_key)
+        pipe.scard(bucket_key)
+        results = yield pipe.execute()
         # if the set is empty, remove the timestamp entry from the
         # scheduled timestamps key
-        if self.r_server.scard(bucket_key) < 1:
-            self.r_server.zrem(self._scheduled_timestamps_key, timestamp)
-        return scheduled_key
+        if results[-1] < 1:
+            yield self.redis.zrem(self._scheduled_timestamps_key, timestamp)
+        returnValue([key for key in results[:-1] if key is not None])
 
+    @inlineCallbacks
+    def get_scheduled_key(self, time):
+        keys = yield self.get_scheduled_keys(time, 1)
+        returnValue(keys[0] if keys else None)
+
+    @inlineCallbacks
     def schedule(self, delta, payload, now=None):
         """
         Store the payload in Redis and call `self.callback` after
@@ -110,58 +145,122 @@ class Scheduler(object):
                     seconds since epoch)
 
         If ``now`` is ``None`` then it will default to ``time.time()``
+
+        Returns a deferred that fires with ``(key, bucket_key)``.
         """
         # do this first as we want it to blow up before any keys
         # are set should the content not be JSON encodable
+        payload_json = json.dumps(payload, cls=self.json_encoder)
         if not now:
             now = int(time.time())
 
         key = self.scheduled_key()
-        self.add_to_scheduled_set(key)
-        bucket_key = self.store_scheduled(key, delta, now)
-        self.r_server.hmset(key, {
-            'payload': json.dumps(payload, cls=self.json_encoder),
+        pipe = self.redis.pipeline()
+        self.add_to_scheduled_set(key, pipe)
+        bucket_key = self.store_scheduled(key, delta, now, pipe)
+        pipe.hmset(key, {
+            'payload': payload_json,
             'scheduled_at': datetime.utcnow().isoformat(),
             'bucket_key': bucket_key,
         })
-        return key, bucket_key
+        yield pipe.execute()
+        returnValue((key, bucket_key))
+
+    def add_to_scheduled_set(self, key, redis=None):
+        redis = self.redis if redis is None else redis
+        return redis.sadd(self.r_key("scheduled_keys"), key)
 
-    def add_to_scheduled_set(self, key):
-        self.r_server.sadd(self.r_key("scheduled_keys"), key)
+    def store_scheduled(self, scheduled_key, delta, now, redis=None):
+        """
+        Add ``scheduled_key`` to its bucket and return the bucket key.
 
-    def store_scheduled(self, scheduled_key, delta, now):
+        If ``redis`` is a pipeline, the writes are only queued on it.
+        """
+        redis = self.redis if redis is None else redis
         timestamp = self.get_next_write_timestamp(delta, now)
         bucket_key = self.r_key("scheduled_keys." + timestamp)
-        self.r_server.sadd(bucket_key, scheduled_key)
-        self.store_read_timestamp(timestamp)
+        redis.sadd(bucket_key, scheduled_key)
+        self.store_read_timestamp(timestamp, redis)
         return bucket_key
 
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        self.r_server.zadd(self._scheduled_timestamps_key, **{
-            timestamp: score
+    def store_read_timestamp(self, timestamp, redis=None):
+        redis = self.redis if redis is None else redis
+        return redis.zadd(self._scheduled_timestamps_key, **{
+            timestamp: self.get_timestamp_score(timestamp)
         })
 
+    def get_timestamp_score(self, timestamp):
+        return time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+
     def get_all_scheduled_keys(self):
-        return self.r_server.smembers(self.r_key("scheduled_keys"))
+        return self.redis.smembers(self.r_key("scheduled_keys"))
 
     @inlineCallbacks
     def deliver_scheduled(self, _time=None):
+        """
+        Deliver everything in the buckets that are due at ``_time``. This
+        includes older buckets that were missed because a tick ran late or
+        the scheduler wasn't running.
+        """
         _time = _time or int(time.time())
-        while True:
-            scheduled_key = self.get_scheduled_key(_time - self.granularity)
-            if not scheduled_key:
-                return
-            scheduled_data = self.get_scheduled(scheduled_key)
-            scheduled_at = scheduled_data['scheduled_at']
-            payload = json.loads(scheduled_data['payload'],
-                                    object_hook=self.json_decoder)
-            yield self.callback(scheduled_at, payload)
-            self.clear_scheduled(scheduled_key)
+        last_timestamp = self.get_time_bucket(_time - self.granularity)
+        timestamps = yield self.redis.zrangebyscore(
+            self._scheduled_timestamps_key, '-inf',
+            self.get_timestamp_score(last_timestamp))
+        for timestamp in timestamps:
+            while True:
+                scheduled_keys = yield self.pop_bucket_keys(
+                    timestamp, self.batch_size)
+                if not scheduled_keys:
+                    break
+                yield self.deliver_scheduled_batch(scheduled_keys)
 
+    @inlineCallbacks
+    def deliver_scheduled_batch(self, scheduled_keys):
+        """
+        Load, deliver and clear a batch of scheduled items that have already
+        been removed from their bucket.
+
+        Items are cleared even if delivering them fails, since they can't be
+        delivered again once they're out of their bucket. Each failure is
+        logged.
+        """
+        try:
+            pipe = self.redis.pipeline()
+            for scheduled_key in scheduled_keys:
+                pipe.hgetall(scheduled_key)
+            scheduled_items = yield pipe.execute()
+            delivered = []
+            for scheduled_key, scheduled_data in zip(
+                    scheduled_keys, scheduled_items):
+                if not scheduled_data:
+                    # Cleared after it was taken from its bucket.
+                    continue
+                d = maybeDeferred(self._deliver_scheduled_item, scheduled_data)
+                d.addErrback(
+                    log.err, "Error delivering scheduled item %r" % (
+                        scheduled_key,))
+                delivered.append(d)
+            yield gatherResults(delivered, consumeErrors=True)
+        finally:
+            pipe = self.redis.pipeline()
+            for scheduled_key in scheduled_keys:
+                pipe.srem(self.r_key("scheduled_keys"), scheduled_key)
+                pipe.delete(scheduled_key)
+            yield pipe.execute()
+
+    def _deliver_scheduled_item(self, scheduled_data):
+        scheduled_at = scheduled_data['scheduled_at']
+        payload = json.loads(scheduled_data['payload'],
+                             object_hook=self.json_decoder)
+        return self.callback(scheduled_at, payload)
+
+    @inlineCallbacks
     def clear_scheduled(self, key):
-        self.r_server.srem(self.r_key("scheduled_keys"), key)
-        message_data = self.get_scheduled(key)
-        bucket_key = message_data['bucket_key']
-        self.r_server.srem(bucket_key, key)
-        self.r_server.delete(key)
+        bucket_key = yield self.redis.hget(key, 'bucket_key')
+        pipe = self.redis.pipeline()
+        pipe.srem(self.r_key("scheduled_keys"), key)
+        if bucket_key is not None:
+            pipe.srem(bucket_key, key)
+        pipe.delete(key)
+        yield pipe.execute()
@@ -3,10 +3,12 @@ import json
 from datetime import datetime, timedelta
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from vumi.message import Message
 from vumi.transports.failures import FailureWorker
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper, WorkerHelper
+from vumi.tests.utils import LogCatcher
 
 
 def mktimestamp(delta=0):
@@ -21,14 +23,14 @@ class TestFailureWorker(VumiTestCase):
         return self.make_worker()
 
     @inlineCallbacks
-    def make_worker(self, retry_delivery_period=0):
+    def make_worker(self, retry_delivery_period=0, **config):
         self.worker_helper = self.add_helper(WorkerHelper('sphex'))
-        config = self.persistence_helper.mk_config({
+        config = self.persistence_helper.mk_config(dict({
             'transport_name': 'sphex',
             'retry_routing_key': 'sms.outbound.%(transport_name)s',
             'failures_routing_key': 'sms.failures.%(transport_name)s',
             'retry_delivery_period': retry_delivery_period,
-        })
+        }, **config))
         self.worker = yield self.worker_helper.get_worker(
             FailureWorker, config)
         self.redis = self.worker.redis
@@ -329,6 +331,133 @@ class TestFailureWorker(VumiTestCase):
                     'reason': 'bad stuff happened',
                     }] * 3)
 
+    @inlineCallbacks
+    def test_get_retry_keys_batch(self):
+        """
+        Get several retries from the same bucket at once.
+        """
+        for _ in range(3):
+            yield self.store_retry(0, -5)
+        keys = yield self.worker.get_next_retry_keys(2)
+        self.assertEqual(len(keys), 2)
+        yield self.assert_zcard(1, 'retry_timestamps')
+        keys = yield self.worker.get_next_retry_keys(2)
+        self.assertEqual(len(keys), 1)
+        yield self.assert_zcard(0, 'retry_timestamps')
+        self.assertEqual((yield self.worker.get_next_retry_keys(2)), [])
+
+    @inlineCallbacks
+    def test_get_retry_keys_skips_empty_bucket(self):
+        """
+        An empty bucket doesn't hide retries in later buckets.
+        """
+        yield self.store_retry(0, -5)
+        yield self.worker.store_read_timestamp(mktimestamp(-60))
+        yield self.assert_zcard(2, 'retry_timestamps')
+        keys = yield self.worker.get_next_retry_keys(10)
+        self.assertEqual(len(keys), 1)
+        yield self.assert_zcard(0, 'retry_timestamps')
+
+    @inlineCallbacks
+    def test_deliver_retries_in_batches(self):
+        """
+        Delivering more retries than fit in a batch should deliver all
+        messages.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(retry_batch_size=2)
+        for _ in range(5):
+            yield self.store_retry(0, -5)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 5)
+        yield self.assert_zcard(0, 'retry_timestamps')
+
+    @inlineCallbacks
+    def test_deliver_retries_missing_failure(self):
+        """
+        A retry whose failure is missing is skipped.
+        """
+        yield self.store_retry(0, -5)
+        [key] = yield self.worker.get_failure_keys()
+        yield self.redis.delete(key)
+        yield self.store_retry(0, -5)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
+
+    @inlineCallbacks
+    def test_deliver_retry_batch_with_failures(self):
+        """
+        Every retry in a batch is published even if some of them fail. Each
+        failure is logged and the first one is raised.
+        """
+        for i in range(3):
+            yield self.store_retry(0, -5, message_json={'message': str(i)})
+        retry_keys = yield self.worker.get_next_retry_keys(10)
+        failures = yield self.worker.get_failures(retry_keys)
+        keys_by_message = dict(
+            (json.loads(failure['message'])['message'], key)
+            for key, failure in zip(retry_keys, failures))
+        published = []
+
+        class Publisher(object):
+            def publish_raw(self, raw_message):
+                message = json.loads(raw_message)['message']
+                published.append(message)
+                if message != '1':
+                    raise ValueError("Publishing %s failed." % (message,))
+
+        with LogCatcher() as lc:
+            yield self.assertFailure(
+                self.worker.deliver_retry_batch(retry_keys, Publisher()),
+                ValueError)
+        self.assertEqual(sorted(published), ['0', '1', '2'])
+        self.assertEqual(
+            sorted(error['why'] for error in lc.errors),
+            sorted("Error delivering retry %r" % (keys_by_message[m],)
+                   for m in ['0', '2']))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+
+    @inlineCallbacks
+    def test_delivery_rate_limit(self):
+        """
+        No more than ``retry_delivery_rate`` messages are published each
+        second.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(retry_delivery_rate=2)
+        clock = self.worker.clock = Clock()
+        clock.advance(10)
+        self.assertTrue(self.worker.wait_for_delivery_slot().called)
+        self.assertTrue(self.worker.wait_for_delivery_slot().called)
+        d = self.worker.wait_for_delivery_slot()
+        clock.advance(0.5)
+        self.assertFalse(d.called)
+        clock.advance(0.5)
+        self.assertTrue(d.called)
+        self.assertTrue(self.worker.wait_for_delivery_slot().called)
+        self.assertFalse(self.worker.wait_for_delivery_slot().called)
+
+    @inlineCallbacks
+    def test_deliver_retries_rate_limited(self):
+        """
+        Rate limited delivery still delivers all messages.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(retry_delivery_rate=2)
+        for _ in range(3):
+            yield self.store_retry(0, -5)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 3)
+
     def test_update_retry_metadata(self):
         """
         Retry metadata should be updated as appropriate.
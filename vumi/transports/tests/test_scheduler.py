@@ -3,18 +3,20 @@ from datetime import datetime
 
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
 from vumi.transports.scheduler import Scheduler
 from vumi.message import TransportUserMessage
 from vumi.utils import to_kwargs
-from vumi.tests.helpers import VumiTestCase, MessageHelper
+from vumi.tests.helpers import VumiTestCase, MessageHelper, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 
 
 class TestScheduler(VumiTestCase):
 
+    @inlineCallbacks
     def setUp(self):
-        self.r_server = FakeRedis()
-        self.scheduler = Scheduler(self.r_server, self._scheduler_callback)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.scheduler = Scheduler(self.redis, self._scheduler_callback)
         self.add_cleanup(self.stop_scheduler)
         self._delivery_history = []
         self.msg_helper = self.add_helper(MessageHelper())
@@ -36,38 +38,114 @@ class TestScheduler(VumiTestCase):
     def assertNumDelivered(self, number):
         self.assertEqual(number, len(self._delivery_history))
 
+    @inlineCallbacks
+    def assert_scheduled_keys(self, expected):
+        self.assertEqual(
+            set(expected), (yield self.scheduler.get_all_scheduled_keys()))
+
     def get_pending_messages(self):
         scheduled_timestamps = self.scheduler.r_key('scheduled_timestamps')
-        return self.r_server.zrange(scheduled_timestamps, 0, -1)
+        return self.redis.zrange(scheduled_timestamps, 0, -1)
 
+    @inlineCallbacks
     def test_scheduling(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 10  # seconds from now
-        key, bucket_key = self.scheduler.schedule(delta, msg.payload, now)
+        key, bucket_key = yield self.scheduler.schedule(
+            delta, msg.payload, now)
         self.assertEqual(bucket_key, '%s#%s.%s' % (
             self.scheduler.r_prefix,
             'scheduled_keys',
             self.scheduler.get_next_write_timestamp(delta, now)
         ))
-        scheduled_key = self.scheduler.get_scheduled_key(now)
+        scheduled_key = yield self.scheduler.get_scheduled_key(now)
         self.assertEqual(scheduled_key, None)
         scheduled_time = now + delta
-        scheduled_key = self.scheduler.get_scheduled_key(scheduled_time)
+        scheduled_key = yield self.scheduler.get_scheduled_key(
+            scheduled_time)
         self.assertTrue(scheduled_key)
-        self.assertEqual(set([scheduled_key]),
-                        self.scheduler.get_all_scheduled_keys())
+        yield self.assert_scheduled_keys([scheduled_key])
+
+    @inlineCallbacks
+    def test_scheduling_unencodable_payload(self):
+        yield self.assertFailure(
+            self.scheduler.schedule(10, {'foo': object()}), TypeError)
+        self.assertEqual((yield self.redis.keys()), [])
+
+    @inlineCallbacks
+    def test_get_scheduled_keys(self):
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        keys = set()
+        for i in range(3):
+            key, _ = yield self.scheduler.schedule(10, {'i': i}, now)
+            keys.add(key)
+        batch = yield self.scheduler.get_scheduled_keys(now + 10, 2)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(len((yield self.get_pending_messages())), 1)
+        rest = yield self.scheduler.get_scheduled_keys(now + 10, 2)
+        self.assertEqual(set(batch + rest), keys)
+        self.assertEqual((yield self.get_pending_messages()), [])
 
     @inlineCallbacks
     def test_delivery_loop(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 16  # seconds from now
-        self.scheduler.schedule(delta, msg.payload, now)
+        yield self.scheduler.schedule(delta, msg.payload, now)
         scheduled_time = now + delta + self.scheduler.granularity
         yield self.scheduler.deliver_scheduled(scheduled_time)
         self.assertDelivered(msg)
 
+    @inlineCallbacks
+    def test_deliver_many_in_batches(self):
+        self.scheduler.batch_size = 2
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        msgs = [self.msg_helper.make_inbound("inbound %s" % (i,))
+                for i in range(5)]
+        for msg in msgs:
+            yield self.scheduler.schedule(10, msg.payload, now)
+        yield self.scheduler.deliver_scheduled(
+            now + 10 + self.scheduler.granularity)
+        self.assertNumDelivered(5)
+        for msg in msgs:
+            self.assertDelivered(msg)
+        yield self.assert_scheduled_keys([])
+        self.assertEqual((yield self.get_pending_messages()), [])
+
+    @inlineCallbacks
+    def test_deliver_with_failures(self):
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        msgs = [self.msg_helper.make_inbound("inbound %s" % (i,))
+                for i in range(3)]
+        keys = []
+        for msg in msgs:
+            key, _ = yield self.scheduler.schedule(10, msg.payload, now)
+            keys.append(key)
+
+        def callback(scheduled_at, payload):
+            self._delivery_history.append((scheduled_at, payload))
+            if payload['content'] != "inbound 1":
+                raise ValueError("Delivery failed: %s" % (payload['content'],))
+
+        self.scheduler.callback = callback
+        with LogCatcher() as lc:
+            yield self.scheduler.deliver_scheduled(
+                now + 10 + self.scheduler.granularity)
+        self.assertNumDelivered(3)
+        errors = lc.errors
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(
+            sorted(error['why'] for error in errors),
+            sorted("Error delivering scheduled item %r" % (key,)
+                   for key in [keys[0], keys[2]]))
+        self.flushLoggedErrors(ValueError)
+        # Failed items are cleared too.
+        yield self.assert_scheduled_keys([])
+        self.assertEqual((yield self.get_pending_messages()), [])
+        for key in keys:
+            self.assertEqual((yield self.redis.exists(key)), False)
+
     @inlineCallbacks
     def test_deliver_loop_future(self):
         now = time.mktime(datetime(2012, 1, 1).timetuple())
@@ -75,13 +153,12 @@ class TestScheduler(VumiTestCase):
             msg = self.msg_helper.make_inbound(
                 "inbound", message_id='message_%s' % (i,))
             delta = i * 10
-            key, _ = self.scheduler.schedule(delta, msg.payload, now)
+            key, _ = yield self.scheduler.schedule(delta, msg.payload, now)
             scheduled_time = now + delta + self.scheduler.granularity
-            self.assertEqual(set([key]),
-                self.scheduler.get_all_scheduled_keys())
+            yield self.assert_scheduled_keys([key])
             yield self.scheduler.deliver_scheduled(scheduled_time)
             self.assertNumDelivered(i + 1)
-            self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+            yield self.assert_scheduled_keys([])
 
     @inlineCallbacks
     def test_deliver_ancient_messages(self):
@@ -89,30 +166,45 @@ class TestScheduler(VumiTestCase):
         # been running since 1912
         msg = self.msg_helper.make_inbound("inbound")
         way_back = time.mktime(datetime(1912, 1, 1).timetuple())
-        scheduled_key, _ = self.scheduler.schedule(0, msg.payload, way_back)
+        scheduled_key, _ = yield self.scheduler.schedule(
+            0, msg.payload, way_back)
         self.assertTrue(scheduled_key)
         now = time.mktime(datetime.now().timetuple())
         yield self.scheduler.deliver_scheduled(now)
-        self.assertEqual(set([scheduled_key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.assertEqual(len(self.get_pending_messages()), 1)
-        yield self.scheduler.deliver_scheduled(
-            way_back + self.scheduler.granularity)
         self.assertDelivered(msg)
-        self.assertEqual(self.get_pending_messages(), [])
-        self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+        self.assertEqual((yield self.get_pending_messages()), [])
+        yield self.assert_scheduled_keys([])
+
+    @inlineCallbacks
+    def test_deliver_missed_buckets(self):
+        self.scheduler.batch_size = 2
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        msgs = [self.msg_helper.make_inbound("inbound %s" % (i,))
+                for i in range(6)]
+        for i, msg in enumerate(msgs):
+            yield self.scheduler.schedule(i * 10, msg.payload, now)
+        late_msg = self.msg_helper.make_inbound("late")
+        yield self.scheduler.schedule(100, late_msg.payload, now)
+        self.assertEqual(len((yield self.get_pending_messages())), 7)
+        # The ticks for all but the last of these buckets were missed.
+        yield self.scheduler.deliver_scheduled(
+            now + 50 + self.scheduler.granularity)
+        self.assertNumDelivered(6)
+        for msg in msgs:
+            self.assertDelivered(msg)
+        self.assertEqual(len((yield self.get_pending_messages())), 1)
 
     @inlineCallbacks
     def test_clear_scheduled_messages(self):
         msg = self.msg_helper.make_inbound("inbound")
         now = time.mktime(datetime.now().timetuple())
         scheduled_time = now + self.scheduler.granularity
-        key, bucket = self.scheduler.schedule(0, msg.payload, scheduled_time)
-        self.assertEqual(len(self.get_pending_messages()), 1)
-        self.assertEqual(set([key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.scheduler.clear_scheduled(key)
+        key, bucket = yield self.scheduler.schedule(
+            0, msg.payload, scheduled_time)
+        self.assertEqual(len((yield self.get_pending_messages())), 1)
+        yield self.assert_scheduled_keys([key])
+        yield self.scheduler.clear_scheduled(key)
         yield self.scheduler.deliver_scheduled()
-        self.assertEqual(self.r_server.hgetall(key), {})
-        self.assertEqual(self.r_server.smembers(bucket), set())
+        self.assertEqual((yield self.redis.hgetall(key)), {})
+        self.assertEqual((yield self.redis.smembers(bucket)), set())
         self.assertNumDelivered(0)
@@ -274,7 +274,8 @@ class Vas2NetsTransport(Transport):
                 self.config['url'], urlencode(params), {
                     'User-Agent': ['Vumi Vas2Net Transport'],
                     'Content-Type': ['application/x-www-form-urlencoded'],
-                    }, 'POST', agent_class=self.agent_factory)
+                    }, 'POST', agent_class=self.agent_factory,
+                pool=self.http_pool)
         except ConnectionRefusedError:
             log.msg("Connection failed sending message:", message)
             raise TemporaryFailure('connection refused')
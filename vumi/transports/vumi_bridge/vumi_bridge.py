@@ -75,9 +75,9 @@ class VumiBridgeTransportConfig(Transport.CONFIG_CLASS):
 class GoConversationTransportBase(Transport):
 
     @classmethod
-    def agent_factory(cls):
+    def agent_factory(cls, pool=None):
         """For swapping out the Agent we use in tests."""
-        return Agent(reactor)
+        return Agent(reactor, pool=pool)
 
     def get_url(self, path):
         config = self.get_static_config()
@@ -122,7 +122,7 @@ class GoConversationTransportBase(Transport):
         if 'helper_metadata' in message:
             params['helper_metadata'] = message['helper_metadata']
 
-        http_client = HTTPClient(self.agent_factory())
+        http_client = HTTPClient(self.agent_factory(pool=self.http_pool))
         resp = yield http_client.put(
             self.get_url('messages.json'),
             data=json.dumps(params).encode('utf-8'),
@@ -260,6 +260,7 @@ class WeChatTransport(Transport):
 
     def http_request_full(self, *args, **kw):
         kw['agent_class'] = self.agent_factory
+        kw['pool'] = self.http_pool
         return http_request_full(*args, **kw)
 
     @inlineCallbacks
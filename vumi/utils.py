@@ -2,18 +2,22 @@
 
 import os.path
 import re
+import socket
 import sys
 import base64
 import pkg_resources
 import warnings
+from collections import deque
 from functools import wraps
+from urlparse import urlparse
 
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet import protocol
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, Deferred
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, ResponseDone, WebClientContextFactory
+from twisted.web.client import (
+    Agent, ResponseDone, WebClientContextFactory, HTTPConnectionPool)
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
@@ -116,25 +120,159 @@ class SimplishReceiver(protocol.Protocol):
             self.deferred.errback(reason)
 
 
+class HttpConnectionPool(HTTPConnectionPool):
+    """
+    Persistent HTTP connection pool for :func:`http_request_full`.
+
+    Connections are kept open once a request has completed and are reused by
+    later requests to the same host. Requests made through the pool are
+    limited to `max_connections_per_host` at a time for each host, and any
+    others are queued until an earlier request completes.
+
+    :param reactor:
+        The reactor to make connections with.
+    :param int max_connections_per_host:
+        The maximum number of requests in progress and idle connections kept
+        for each host.
+    :param float idle_timeout:
+        The number of seconds an idle connection is kept open for.
+    """
+
+    def __init__(self, reactor, max_connections_per_host=2,
+                 idle_timeout=240):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_connections_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.hits = 0
+        self.misses = 0
+        self._active = {}  # host key -> number of requests in progress
+        self._waiting = {}  # host key -> deque of queued requests
+        self._metrics = None
+
+    @property
+    def queue_depth(self):
+        """The number of requests waiting for a connection."""
+        return sum(len(waiting) for waiting in self._waiting.itervalues())
+
+    def register_metrics(self, metric_manager, prefix='http_pool.'):
+        """
+        Register pool hit, miss and queue depth metrics with a
+        :class:`vumi.blinkenlights.metrics.MetricManager`.
+        """
+        from vumi.blinkenlights.metrics import Count, Metric, MAX
+        self._metrics = {
+            'hits': metric_manager.register(Count(prefix + 'hits')),
+            'misses': metric_manager.register(Count(prefix + 'misses')),
+            'queue_depth': metric_manager.register(
+                Metric(prefix + 'queue_depth', aggregators=[MAX])),
+        }
+
+    @staticmethod
+    def key_for_url(url):
+        uri = urlparse(url)
+        port = uri.port
+        if port is None:
+            port = 443 if uri.scheme == 'https' else 80
+        return (uri.scheme, uri.hostname, port)
+
+    def getConnection(self, key, endpoint):
+        if self._connections.get(key):
+            self.hits += 1
+            metric = 'hits'
+        else:
+            self.misses += 1
+            metric = 'misses'
+        if self._metrics is not None:
+            self._metrics[metric].inc()
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def acquire(self, key):
+        """
+        Return a Deferred that fires when a request may be made to the host
+        identified by `key`. Each successful acquisition must be followed by
+        a call to :meth:`release` once the request has completed.
+        """
+        active = self._active.get(key, 0)
+        if active < self.max_connections_per_host:
+            self._active[key] = active + 1
+            return succeed(None)
+        d = Deferred(lambda d: self._remove_waiting(key, d))
+        self._waiting.setdefault(key, deque()).append(d)
+        self._record_queue_depth()
+        return d
+
+    def release(self, key):
+        waiting = self._waiting.get(key)
+        if waiting:
+            # Hand the slot straight over to the next queued request.
+            d = waiting.popleft()
+            if not waiting:
+                del self._waiting[key]
+            self._record_queue_depth()
+            d.callback(None)
+            return
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+
+    def _remove_waiting(self, key, d):
+        waiting = self._waiting[key]
+        waiting.remove(d)
+        if not waiting:
+            del self._waiting[key]
+        self._record_queue_depth()
+
+    def _record_queue_depth(self):
+        if self._metrics is not None:
+            self._metrics['queue_depth'].set(self.queue_depth)
+
+
 def http_request_full(url, data=None, headers={}, method='POST',
                       timeout=None, data_limit=None, context_factory=None,
-                      agent_class=None, reactor=None):
+                      agent_class=None, reactor=None, pool=None):
+    """
+    Make an HTTP request and return a Deferred that fires with the response
+    once its body has been received.
+
+    If `pool` is an :class:`HttpConnectionPool`, the request reuses the
+    pool's persistent connections and waits for a free connection if the
+    pool's per-host limit has been reached. Otherwise a new connection is
+    made for the request.
+    """
     if reactor is None:
         # The import replaces the local variable.
         from twisted.internet import reactor
     if agent_class is None:
         agent_class = Agent
     context_factory = context_factory or WebClientContextFactory()
-    agent = agent_class(reactor, contextFactory=context_factory)
-    d = agent.request(method,
-                      url,
-                      mkheaders(headers),
-                      StringProducer(data) if data else None)
+    if pool is None:
+        agent = agent_class(reactor, contextFactory=context_factory)
+    else:
+        agent = agent_class(
+            reactor, contextFactory=context_factory, pool=pool)
 
     def handle_response(response):
         return SimplishReceiver(response, data_limit).deferred
 
-    d.addCallback(handle_response)
+    def make_request(_):
+        d = agent.request(method,
+                          url,
+                          mkheaders(headers),
+                          StringProducer(data) if data else None)
+        return d.addCallback(handle_response)
+
+    def release(r, key):
+        pool.release(key)
+        return r
+
+    if pool is None:
+        d = make_request(None)
+    else:
+        key = pool.key_for_url(url)
+        d = pool.acquire(key)
+        d.addCallback(
+            lambda _: make_request(_).addBoth(release, key))
 
     if timeout is not None:
         cancelling_on_timeout = [False]
@@ -175,9 +313,11 @@ def mkheaders(headers):
     return Headers(raw_headers)
 
 
-def http_request(url, data, headers={}, method='POST', agent_class=None):
+def http_request(url, data, headers={}, method='POST', agent_class=None,
+                 pool=None):
     d = http_request_full(
-        url, data, headers=headers, method=method, agent_class=agent_class)
+        url, data, headers=headers, method=method, agent_class=agent_class,
+        pool=pool)
     return d.addCallback(lambda r: r.delivered_body)
 
 
@@ -267,6 +407,39 @@ def build_web_site(resources, site_class=None):
     return site_factory
 
 
+# Python 2 doesn't define SO_REUSEPORT, but Linux has supported it since 3.9.
+SO_REUSEPORT = getattr(
+    socket, 'SO_REUSEPORT',
+    15 if sys.platform.startswith('linux') else None)
+
+
+def listen_tcp_reuse_port(port, factory, interface='', backlog=50,
+                          reactor=None):
+    """Listen on a TCP port that other processes may also listen on.
+
+    The socket is bound with `SO_REUSEPORT`, so several processes can each
+    call this for the same port and the kernel spreads new connections
+    between them.
+
+    :returns: The listening port, as returned by ``reactor.listenTCP``.
+    """
+    if SO_REUSEPORT is None:
+        raise VumiError("SO_REUSEPORT is not supported on this platform.")
+    if reactor is None:
+        from twisted.internet import reactor
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        # The reactor uses a copy of the file descriptor.
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        sock.close()
+
+
 class LogFilterSite(Site):
     def log(self, request):
         if getattr(request, 'do_not_log', None):
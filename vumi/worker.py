@@ -5,6 +5,7 @@
 import time
 import os
 import socket
+from collections import OrderedDict
 
 from twisted.internet.defer import (
     inlineCallbacks, succeed, maybeDeferred, gatherResults)
@@ -15,11 +16,12 @@ from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigInt, ConfigDict
 from vumi.errors import DuplicateConnectorError
-from vumi.utils import generate_worker_id
+from vumi.utils import generate_worker_id, HttpConnectionPool
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
+from vumi.blinkenlights.metrics import MetricManager
 
 
 def then_call(d, func, *args, **kw):
@@ -36,6 +38,21 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_publisher_confirm_window = ConfigInt(
+        "If set, messages are published with publisher confirms and at most"
+        " this many messages on each connector may be waiting for the broker"
+        " to confirm them. When a window is full, further messages are held"
+        " and the connector's consumers are paused until half the window has"
+        " been confirmed. Requires a RabbitMQ broker.",
+        default=0, static=True)
+    http_connection_pool = ConfigDict(
+        "Options for a persistent HTTP connection pool to use for outbound"
+        " HTTP requests made by this worker. If this isn't set, each request"
+        " uses a new connection. The options are `max_connections_per_host`"
+        " (default 2), `idle_timeout` in seconds (default 240) and"
+        " `metrics_prefix`. If `metrics_prefix` is set, pool hit, miss and"
+        " queue depth metrics are published with that prefix.",
+        static=True)
 
 
 class BaseWorker(Worker):
@@ -47,14 +64,18 @@ class BaseWorker(Worker):
     """
 
     CONFIG_CLASS = BaseConfig
+    CONFIG_CACHE_SIZE = 100
 
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = OrderedDict()
         self._hb_pub = None
         self._worker_id = None
+        self.http_pool = None
+        self._http_pool_metrics = None
         self.log = WrappingLogger(system=self.config.get('worker_name'))
 
     def startWorker(self):
@@ -63,6 +84,7 @@ class BaseWorker(Worker):
             % (self.__class__.__name__, self.config))
         d = maybeDeferred(self._validate_config)
         then_call(d, self.setup_heartbeat)
+        then_call(d, self.setup_http_pool)
         then_call(d, self.setup_middleware)
         then_call(d, self.setup_connectors)
         then_call(d, self.setup_worker)
@@ -74,6 +96,7 @@ class BaseWorker(Worker):
         then_call(d, self.teardown_worker)
         then_call(d, self.teardown_connectors)
         then_call(d, self.teardown_middleware)
+        then_call(d, self.teardown_http_pool)
         then_call(d, self.teardown_heartbeat)
         return d
 
@@ -123,6 +146,32 @@ class BaseWorker(Worker):
         """Worker subclasses can override this to add custom attributes"""
         return {}
 
+    @inlineCallbacks
+    def setup_http_pool(self):
+        """Create the HTTP connection pool if one is configured."""
+        pool_config = self.get_static_config().http_connection_pool
+        if pool_config is None:
+            return
+        from twisted.internet import reactor
+        self.http_pool = HttpConnectionPool(
+            reactor,
+            max_connections_per_host=pool_config.get(
+                'max_connections_per_host', 2),
+            idle_timeout=pool_config.get('idle_timeout', 240))
+        metrics_prefix = pool_config.get('metrics_prefix')
+        if metrics_prefix is not None:
+            self._http_pool_metrics = yield self.start_publisher(
+                MetricManager, metrics_prefix)
+            self.http_pool.register_metrics(self._http_pool_metrics)
+
+    def teardown_http_pool(self):
+        if self._http_pool_metrics is not None:
+            self._http_pool_metrics.stop()
+            self._http_pool_metrics = None
+        if self.http_pool is not None:
+            pool, self.http_pool = self.http_pool, None
+            return pool.closeCachedConnections()
+
     def teardown_connectors(self):
         d = succeed(None)
         for connector_name in self.connectors.keys():
@@ -159,7 +208,44 @@ class BaseWorker(Worker):
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return succeed(self.get_cached_config())
+
+    def get_cached_config(self, **overrides):
+        """Return a config object for the worker config with `overrides`
+        applied to it.
+
+        Config objects are cached, keyed by `overrides`, so that building a
+        config for each message doesn't validate all the config fields every
+        time. The least recently used config is evicted once there are more
+        than `CONFIG_CACHE_SIZE` of them. Overrides with unhashable values
+        bypass the cache.
+
+        The cache doesn't notice changes to the worker config, so anything
+        that modifies `self.config` after startup should call
+        :meth:`clear_config_cache`.
+        """
+        try:
+            key = tuple(sorted(overrides.iteritems()))
+            config = self._config_cache.pop(key, None)
+        except TypeError:
+            return self._build_config(overrides)
+        if config is None:
+            config = self._build_config(overrides)
+            if len(self._config_cache) >= self.CONFIG_CACHE_SIZE:
+                self._config_cache.popitem(last=False)
+        self._config_cache[key] = config
+        return config
+
+    def clear_config_cache(self):
+        """Discard all cached config objects."""
+        self._config_cache.clear()
+
+    def _build_config(self, overrides):
+        config = self.config
+        if overrides:
+            config = config.copy()
+            config.update(overrides)
+        return self.CONFIG_CLASS(config)
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -183,12 +269,15 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
+        prefetch_count = static_config.amqp_prefetch_count
+        confirm_window = static_config.amqp_publisher_confirm_window
         middlewares = self.middlewares if middleware else None
 
         connector = connector_cls(self, connector_name,
                                   prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+                                  middlewares=middlewares,
+                                  confirm_window=confirm_window)
         self.connectors[connector_name] = connector
 
         d = connector.setup()